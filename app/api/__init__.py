@@ -3,11 +3,15 @@
 The API service package.
 """
 
+import json
+import time
 import textwrap
 import cherrypy
 import logging
 import appInfo
-from lib import componentConfig, keyManagement
+from lib import componentConfig, iterJsonRecords, keyManagement, queryAudit
+from lib import backup, changes, writeQueue
+from lib.admission import RetryLater
 # This is needed here to make the auth tool checkpassword function get access to
 # the auth module
 from lib import auth
@@ -15,6 +19,30 @@ from lib import auth
 # Set up the module logger
 logger = logging.getLogger(__name__)
 
+def etag(kind, objId, revision):
+    """
+    Returns a strong entity tag for a revisioned resource.
+
+    @param kind: A short string identifying the type of resource.
+    @param objId: The id of the object the resource represents.
+    @param revision: The resource revision.
+    """
+    return '"{0}{1}-{2}"'.format(kind, objId, revision)
+
+def notModified(tag):
+    """
+    Sets the C{ETag} response header, and ends the request with a C{304 Not
+    Modified} response if the request C{If-None-Match} header matches L{tag}.
+
+    @param tag: The current entity tag for the resource.
+    """
+    cherrypy.response.headers['ETag'] = tag
+    inm = cherrypy.request.headers.get('If-None-Match')
+    if inm:
+        tags = [t.strip() for t in inm.split(',')]
+        if tag in tags or '*' in tags:
+            raise cherrypy.HTTPRedirect([], 304)
+
 class API(object):
     """
     The API services root controller class.
@@ -42,28 +70,440 @@ class Key(object):
 
     exposed = True
 
+    @cherrypy.tools.queryAudit(budget=3)
     def GET(self, uhd, *args, **kwargs):
         """
         Retrieves the key for C{user@host.domain}
 
+        The response carries an C{ETag} for the key revision. If the request
+        C{If-None-Match} header matches the current revision, a C{304 Not
+        Modified} response is returned without loading the key.
+
         @param uhd: The user@host.domain string for which to retrieve the key.
         """
-        return {uhd: "some key"}
+        try:
+            if 'If-None-Match' in cherrypy.request.headers:
+                rev = keyManagement.keyRevision(uhd)
+                if rev is not None:
+                    notModified(etag('k', *rev))
+            res = keyManagement.getKey(uhd)
+        except ValueError, exc:
+            raise cherrypy.HTTPError(400, str(exc))
+
+        if res is None:
+            raise cherrypy.HTTPError(404, "No key for: {0}".format(uhd))
+
+        userId, revision, pubKey = res
+        notModified(etag('k', userId, revision))
+        return {uhd: pubKey}
 
+    @cherrypy.tools.queryAudit(budget=6)
     def POST(self, uhd, key=None, *args, **kwargs):
         """
         Creates the key for C{user@host.domain}.
 
+        When the write queue is enabled, the key is added by the queue writer,
+        and a C{503} response with a C{Retry-After} header is returned if the
+        queue is full.
+
         @param uhd: The user@host.domain string for which to retrieve the key.
         """
+        retryAfter = writeQueue.queueConf.get('retryAfter', 1)
         try:
-            res = keyManagement.addUserAndKey(uhd, key)
+            res = writeQueue.run(keyManagement.addUserAndKey, uhd, key)
         except ValueError, exc:
             cherrypy.response.errorInfo = {'foo': 'bar', 'bar': 'baz'}
             raise cherrypy.HTTPError(400, str(exc))
+        except writeQueue.QueueFull:
+            raise RetryLater(retryAfter, "Too many writes queued.")
+        except writeQueue.Timeout:
+            raise RetryLater(retryAfter, "The write is still queued.")
+
+        # The key is returned as text instead of the stored blob
+        data = dict(res._data, pubKey=res.pubKey)
+        del data['keyBlob']
+
+        return data
+
+class AuthorizedKeys(object):
+    """
+    The .../authorized_keys/{user@host.domain} API
+    """
+
+    exposed = True
+
+    # The credentials, the revision for conditional requests, and the stored
+    # file, or the revision, unless already looked up, and the entries to
+    # render it from
+    @cherrypy.tools.queryAudit(budget=4)
+    def GET(self, uhd, *args, **kwargs):
+        """
+        Retrieves the ready to install C{authorized_keys} file for
+        C{user@host.domain} as plain text.
+
+        The stored file and its revision are fetched together, so the response
+        carries an C{ETag} for the file revision. For a conditional request,
+        only the revision is looked up first, and if the C{If-None-Match}
+        header matches it, a C{304 Not Modified} response is returned without
+        loading the file.
+
+        @param uhd: The user@host.domain string for the file owner.
+        """
+        rev = None
+        try:
+            if 'If-None-Match' in cherrypy.request.headers:
+                rev = keyManagement.authorizedKeysRevision(uhd)
+                if rev is not None:
+                    notModified(etag('a', *rev))
+            res = keyManagement.getAuthorizedKeys(uhd, rev)
+        except ValueError, exc:
+            raise cherrypy.HTTPError(400, str(exc))
+
+        if res is None:
+            raise cherrypy.HTTPError(404, "No user: {0}".format(uhd))
+
+        ownerId, authRevision, content = res
+        notModified(etag('a', ownerId, authRevision))
+        cherrypy.response.headers['Content-Type'] = 'text/plain'
+        return content
+
+class Fingerprint(object):
+    """
+    The .../fingerprint/{sha256} API
+    """
+
+    exposed = True
+
+    @cherrypy.tools.queryAudit(budget=2)
+    def GET(self, *fp, **kwargs):
+        """
+        Finds all users holding the public key with the given SHA256
+        fingerprint.
+
+        The fingerprint is base64 encoded and may contain '/' characters, so
+        all path segments are joined to form the fingerprint. Since empty path
+        segments are dropped, a fingerprint starting with '/' must be passed
+        with the 'SHA256:' prefix.
+
+        @param fp: The fingerprint as shown by C{ssh-keygen -l}, with or
+               without the 'SHA256:' prefix.
+        """
+        if not fp:
+            raise cherrypy.HTTPError(400, "No fingerprint supplied.")
+        fp = '/'.join(fp)
+
+        return {'fingerprint': fp,
+                'uhds': keyManagement.findByFingerprint(fp)}
+
+class Keys(object):
+    """
+    The .../keys API
+    """
+
+    exposed = True
+
+    #: Content types for the listing formats
+    FORMATS = {'json': 'application/json',
+               'ndjson': 'application/x-ndjson'}
+
+    #: The number of listed keys to send per response chunk
+    CHUNK_SIZE = 100
+
+    # The listing runs the same query once per batch
+    @cherrypy.tools.queryAudit(maxRepeats=None)
+    def GET(self, domain=None, host=None, after=None, limit=None,
+            format='json', *args, **kwargs):
+        """
+        Lists users and their keys in (domain, host, user) order.
+
+        The response is streamed as the keys are read, so any number of keys
+        can be listed without building the full response in memory.
+
+        For the C{json} format, the response is a C{{"keys": [...], "next":
+        cursor}} object, with each key as a C{{"uhd": uhd, "key": key}} object.
+        For C{ndjson}, each key object is on its own line, followed by a
+        C{{"next": cursor}} line if there are more keys.
+
+        @param domain: Only list users in this domain.
+        @param host: Only list users on hosts with this name.
+        @param after: The cursor from the C{next} value of a previous page, to
+               list the keys after that page.
+        @param limit: The maximum number of keys to list. All keys are listed
+               if not supplied.
+        @param format: C{json} (the default) or C{ndjson}.
+        """
+        if format not in self.FORMATS:
+            raise cherrypy.HTTPError(400, "Invalid format: {0}".format(format))
+        try:
+            if after is not None:
+                after = keyManagement.parseCursor(after)
+            if limit is not None:
+                limit = int(limit)
+                if limit < 1:
+                    raise ValueError("Invalid limit: {0}".format(limit))
+        except ValueError, exc:
+            raise cherrypy.HTTPError(400, str(exc))
+
+        cherrypy.response.headers['Content-Type'] = self.FORMATS[format]
+        # One extra key tells us if there is a next page
+        keys = keyManagement.listKeys(domain, host, after,
+                                      limit + 1 if limit else None)
+
+        return self._stream(keys, limit, format == 'ndjson')
+
+    def _stream(self, keys, limit, ndjson):
+        """
+        Generator returning the response body chunks for L{GET}.
+        """
+        sep = '\n' if ndjson else ','
+        chunk = [] if ndjson else ['{"keys":[']
+        count, cursor, more = 0, None, False
+
+        for ids, uhd, pubKey in keys:
+            if count == limit:
+                more = True
+                break
+            record = json.dumps({'uhd': uhd, 'key': pubKey},
+                                separators=(',', ':'))
+            chunk.append(record if ndjson or not count else sep + record)
+            count += 1
+            cursor = ids
+            if len(chunk) >= self.CHUNK_SIZE:
+                yield sep.join(chunk) + sep if ndjson else ''.join(chunk)
+                chunk = []
+
+        nextCursor = '.'.join(str(i) for i in cursor) if more else None
+        if ndjson:
+            if nextCursor:
+                chunk.append(json.dumps({'next': nextCursor}))
+            yield ''.join(c + sep for c in chunk)
+        else:
+            chunk.append('],"next":{0}}}'.format(json.dumps(nextCursor)))
+            yield ''.join(chunk)
+
+class KeysBulk(object):
+    """
+    The .../keys/bulk API
+    """
+
+    exposed = True
+
+    # Imports run the same statements for every record
+    @cherrypy.tools.queryAudit(maxRepeats=None)
+    def POST(self, policy='skip', dryRun='false', *args, **kwargs):
+        """
+        Adds keys in bulk.
+
+        The request body is a stream of C{{"uhd": "user@host.domain", "key":
+        "key"}} records, either as newline delimited JSON or as a JSON array.
+        The body is processed as it is received, and is never read into memory
+        completely.
+
+        @param policy: What to do when a user exists already. One of C{skip},
+               C{update} or C{fail}. See
+               L{keyManagement.bulkAddUsersAndKeys}.
+        @param dryRun: If C{true}, nothing is changed, but the results show
+               what would have happened.
+
+        @return: The import results. See L{keyManagement.bulkAddUsersAndKeys}.
+        """
+        headers = cherrypy.request.headers
+        if 'Content-Length' not in headers and \
+           'Transfer-Encoding' not in headers:
+            raise cherrypy.HTTPError(411)
+
+        dryRun = dryRun.lower() in ('1', 'true', 'yes')
+        records = iterJsonRecords(cherrypy.request.rfile)
+        try:
+            return keyManagement.bulkAddUsersAndKeys(records, policy=policy,
+                                                     dryRun=dryRun)
+        except ValueError, exc:
+            raise cherrypy.HTTPError(400, str(exc))
+
+class Domain(object):
+    """
+    The .../domain[/{name}[/host/{host}]] API
+    """
+
+    exposed = True
+
+    # The credentials, and the listing
+    @cherrypy.tools.queryAudit(budget=2)
+    def GET(self, name=None, hostPart=None, host=None, *args, **kwargs):
+        """
+        Browses the domains, the hosts in a domain, or the users on a host,
+        with counts for the level below. Every level is a single query,
+        however many hosts or users there are.
+
+        Without a C{name}, all domains are listed as C{{"domains": [...]}},
+        with C{hosts}, C{users} and C{authorizedKeys} counts for each.
+
+        For C{domain/{name}}, the hosts in the domain are listed as C{{"name":
+        name, "hosts": [...]}}, with C{users} and C{authorizedKeys} counts for
+        each.
+
+        For C{domain/{name}/host/{host}}, the users on the host are listed as
+        C{{"name": "host.domain", "users": [...]}}, with C{authorizedKeys}
+        counts for the entries in their C{authorized_keys} files, and
+        C{authorizedOn} counts for the files their keys are in.
+
+        @param name: The domain name.
+        @param host: The host name.
+        @param keys: If C{true}, the users' public keys are included. Passed
+               as a query parameter.
+        """
+        if args or (hostPart is not None and (hostPart != 'host' or
+                                               host is None)):
+            raise cherrypy.NotFound()
+
+        if name is None:
+            return {'domains': keyManagement.listDomains()}
+        if host is None:
+            hosts = keyManagement.listHosts(name)
+            if hosts is None:
+                raise cherrypy.HTTPError(404, "No domain: {0}".format(name))
+            return {'name': name, 'hosts': hosts}
+
+        keys = kwargs.get('keys', 'false').lower() in ('1', 'true', 'yes')
+        users = keyManagement.listUsers(name, host, keys=keys)
+        if users is None:
+            raise cherrypy.HTTPError(404, "No host: {0}.{1}".format(host, name))
+        return {'name': "{0}.{1}".format(host, name), 'users': users}
+
+class Grant(object):
+    """
+    The .../grant API
+    """
+
+    exposed = True
+
+    # The stored files are refreshed in batches of a repeated statement
+    @cherrypy.tools.queryAudit(maxRepeats=None)
+    def POST(self, grantee=None, scope=None, name=None, options=None,
+             *args, **kwargs):
+        """
+        Authorizes the key of the C{grantee} user in the C{authorized_keys}
+        files of a single user, all users on a host, or all users in a domain,
+        in one statement. Users that have the grantee authorized already keep
+        their entry, so repeated grants change nothing.
+
+        @param grantee: The user@host.domain to authorize.
+        @param scope: C{user}, C{host} or C{domain}.
+        @param name: The user@host.domain, host.domain or domain for the
+               C{scope}.
+        @param options: Optional SSH options for the new entries.
+
+        @return: C{{"granted": count}}, with the number of new entries.
+        """
+        try:
+            granted = keyManagement.grantAuthorization(grantee, scope, name,
+                                                       options)
+        except ValueError, exc:
+            raise cherrypy.HTTPError(400, str(exc))
+
+        if granted is None:
+            raise cherrypy.HTTPError(404, "No user: {0}".format(grantee))
+        return {'granted': granted}
+
+    @cherrypy.tools.queryAudit(maxRepeats=None)
+    def DELETE(self, grantee=None, scope=None, name=None, *args, **kwargs):
+        """
+        Removes the key of the C{grantee} user from the C{authorized_keys}
+        files of the users targeted as for L{POST}, in one statement.
+
+        @return: C{{"revoked": count}}, with the number of removed entries.
+        """
+        try:
+            revoked = keyManagement.revokeAuthorization(grantee, scope, name)
+        except ValueError, exc:
+            raise cherrypy.HTTPError(400, str(exc))
+
+        if revoked is None:
+            raise cherrypy.HTTPError(404, "No user: {0}".format(grantee))
+        return {'revoked': revoked}
+
+class Changes(object):
+    """
+    The .../changes API
+    """
+
+    exposed = True
+
+    # Every wake up runs the same queries again
+    @cherrypy.tools.queryAudit(maxRepeats=None)
+    def GET(self, since='0', scope=None, name=None, timeout=None, limit=None,
+            *args, **kwargs):
+        """
+        Returns the key and C{authorized_keys} changes after sequence number
+        C{since}, waiting up to C{timeout} seconds for changes if there are
+        none yet.
+
+        Clients start with C{since=0} or a C{snapshotRequired} response, and
+        pass the C{next} value from each response as C{since} for the next
+        request. See L{changes.changesSince} for the response.
+
+        If too many requests are waiting for changes already, a C{503}
+        response with a C{Retry-After} header is returned.
+
+        @param since: The last sequence number seen.
+        @param scope: C{domain} or C{host} to only return changes for users in
+               the domain or on the host.domain given by C{name}.
+        @param name: The domain or host.domain for the C{scope}.
+        @param timeout: The maximum seconds to wait. Defaults to, and is
+               capped at, the C{[changes]} pollTimeout and maxPollTimeout
+               settings.
+        @param limit: The maximum number of changes to return.
+        """
+        changesConf = changes.changesConf
+        try:
+            since = int(since)
+            timeout = float(timeout) if timeout is not None \
+                      else changesConf.get('pollTimeout', 30)
+            limit = int(limit) if limit is not None \
+                    else changesConf.get('maxLimit', 1000)
+            if since < 0 or timeout < 0 or limit < 1:
+                raise ValueError("Invalid since, timeout or limit.")
+            return changes.waitForChanges(
+                    since, scope, name,
+                    limit=min(limit, changesConf.get('maxLimit', 1000)),
+                    timeout=min(timeout,
+                                changesConf.get('maxPollTimeout', 120)))
+        except ValueError, exc:
+            raise cherrypy.HTTPError(400, str(exc))
+        except changes.TooManyWaiters:
+            raise RetryLater(1, "Too many requests waiting for changes.")
+
+class Backup(object):
+    """
+    The .../backup API
+    """
 
-        return res._data
+    exposed = True
+
+    # The credentials. The snapshot runs on a connection of its own
+    @cherrypy.tools.queryAudit(budget=1)
+    def GET(self, *args, **kwargs):
+        """
+        Returns a gzip compressed backup of the database, taken from a
+        consistent snapshot while writes carry on. See L{backup}.
 
+        The snapshot is taken before the response starts, and the backup is
+        streamed as it is compressed.
+
+        Backups include the API credentials, so only the API users in the
+        C{[backup]} users config may download them. Others get a C{403}.
+        """
+        if cherrypy.request.login not in backup.backupConf()['users']:
+            raise cherrypy.HTTPError(403, "Backups are restricted to "
+                                          "operators.")
+        body = backup.stream()
+        headers = cherrypy.response.headers
+        headers['Content-Type'] = 'application/gzip'
+        headers['Content-Disposition'] = \
+                'attachment; filename="backup-{0}.sqlite.gz"'.format(
+                        time.strftime('%Y%m%d%H%M%S', time.gmtime()))
+
+        return body
 
 def setup():
     """
@@ -75,9 +515,26 @@ def setup():
     Configuration is read from the C{app[.site].conf} config files.
     """
 
+    # Make sure the configured API users exist
+    auth.bootstrap()
+
     # Create the API instance
     api = API()
     api.key = Key()
+    api.authorized_keys = AuthorizedKeys()
+    api.fingerprint = Fingerprint()
+    api.keys = Keys()
+    api.keys.bulk = KeysBulk()
+    api.changes = Changes()
+    api.domain = Domain()
+    api.grant = Grant()
+    api.backup = Backup()
+
+    # Compact the change log regularly
+    changes.setup()
+
+    # Group commit key writes if enabled
+    writeQueue.setup()
 
     # Mount as CP app
     cherrypy.tree.mount(api, '/api', componentConfig('api'))
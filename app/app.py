@@ -4,14 +4,23 @@
 Main sshKeyServer application.
 """
 
-from lib import conf, configFiles, logger, database as db
+import sys
+import argparse
+from lib import conf, configApp, configFiles, logger, metrics, generation
+from lib import workers, database as db
 import cherrypy
 
-def parseArgs():
+def parseArgs(argv=None):
     """
     Parses command line args.
     """
     logger.debug("In parseArgs...")
+    parser = argparse.ArgumentParser(description="sshKeyServer.")
+    parser.add_argument('-w', '--workers', type=int,
+                        help="The number of worker processes. Defaults to "
+                             "the server.workers config, or 1.")
+
+    return parser.parse_args(argv)
 
 def setup():
     """
@@ -32,31 +41,56 @@ def setup():
     # Set it up
     app = api.setup()
 
+    # Add the metrics page
+    metrics.setup()
+
 def initialize():
     """
     Initializes the system before startup.
     """
     logger.debug("In initialize...")
 
-def run():
+def serve(ready=None):
+    """
+    Serves requests until the CherryPy engine exits.
+
+    @param ready: An optional function to call once serving.
+    """
+    cherrypy.engine.start()
+    if ready is not None:
+        ready()
+    cherrypy.engine.block()
+
+def run(workerCount=1):
     """
     Run the main system
+
+    @param workerCount: The number of worker processes to serve with. With 1,
+           requests are served by this process.
     """
     logger.debug("In run....")
     logger.debug("Full config %s", conf)
 
+    if workerCount > 1:
+        # The workers open their own connections
+        db.closeConnections()
+        return workers.Master(workerCount, serve).serve()
+
+    # Still share the cache generations, with management commands
+    generation.share()
     # Start the server
-    cherrypy.engine.start()
-    cherrypy.engine.block()
+    serve()
 
-def main():
+def main(argv=None):
     """
     Main system startup.
     """
+    # Config and logging before anything else
+    configApp()
     logger.debug("In main...")
 
     # Command line args...
-    parseArgs()
+    args = parseArgs(argv)
 
     # Set up...
     setup()
@@ -65,7 +99,7 @@ def main():
     initialize()
 
     # Run...
-    run()
+    return run(args.workers or cherrypy.config.get('server.workers', 1))
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
@@ -0,0 +1,11 @@
+# -*- coding: utf-8 -*-
+"""
+Vendored external packages.
+"""
+
+import sys
+from external import peewee
+
+# The vendored playhouse modules import peewee as a top level module, so we make
+# sure they find the vendored copy
+sys.modules['peewee'] = peewee
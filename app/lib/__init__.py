@@ -1,10 +1,13 @@
 # -*- coding: utf-8 -*-
 """
 Application library module
+
+Importing this module has no side effects. The app config is read on first use
+of L{conf}, and logging is set up by L{configApp}, which the application entry
+points call on startup. CherryPy is only imported by the functions needing it,
+so tooling importing this module starts fast.
 """
-import os, errno
-import cherrypy
-from cherrypy._cpcompat import ntou, json_decode, json_encode
+import os, re, errno, json, codecs
 import logging
 import appInfo
 
@@ -14,8 +17,56 @@ logger = logging.getLogger('main')
 #: The full path to the application base dir.
 appDir = os.path.realpath(os.path.join(os.path.dirname(__file__), '..'))
 
-#: The app config dict. It will be initialized by L{configApp}.
-conf = {}
+class LazyConfig(dict):
+    """
+    A dictionary that is filled by a loader function on first use.
+    """
+
+    def __init__(self, loader):
+        """
+        Instance initialization.
+
+        @param loader: Called without arguments on first use, and must return
+               the dictionary to fill this one with.
+        """
+        dict.__init__(self)
+        self._loader = loader
+        self._loaded = False
+
+    def load(self):
+        """
+        Fills the dictionary from the loader if not done yet.
+
+        @return: The dictionary.
+        """
+        if not self._loaded:
+            dict.update(self, self._loader())
+            self._loaded = True
+
+        return self
+
+def _loading(name):
+    """
+    Returns a L{LazyConfig} method that loads the config before calling the
+    dict method L{name}.
+    """
+    method = getattr(dict, name)
+
+    def loading(self, *args, **kwargs):
+        self.load()
+        return method(self, *args, **kwargs)
+    loading.__name__ = name
+    loading.__doc__ = method.__doc__
+
+    return loading
+
+for _name in ('__getitem__', '__setitem__', '__delitem__', '__contains__',
+              '__iter__', '__len__', '__eq__', '__ne__', '__repr__', 'get',
+              'has_key', 'keys', 'values', 'items', 'iterkeys', 'itervalues',
+              'iteritems', 'setdefault', 'update', 'pop', 'copy'):
+    setattr(LazyConfig, _name, _loading(_name))
+del _name
+
 
 class ConfigError(Exception):
     """
@@ -151,6 +202,8 @@ def componentConfig(component, required=True):
 
     @return: A dictionary consisting of the config options.
     """
+    import cherrypy
+
     # The component config dict
     compConf = {}
 
@@ -162,15 +215,22 @@ def componentConfig(component, required=True):
 
     return compConf
 
-def configApp():
+#: The app config dict, read from the C{app.conf} and C{app.site.conf} config
+#: files in C{etc} on first use.
+conf = LazyConfig(lambda: componentConfig('app', required=True))
+
+#: True once logging has been set up by L{configLogging}
+_loggingConfigured = False
+
+def configLogging():
     """
-    Sets up the app L{conf}ig dictionary from the C{app.conf} and
-    C{app.site.conf} config files in C{etc}.
+    Sets logging up from the C{logging.conf} config file in C{etc}. Only the
+    first call does anything.
     """
-    global conf
+    global _loggingConfigured
+    if _loggingConfigured:
+        return
 
-    # Set logging up before anything else. Anything that needs logging should
-    # import lib very early
     from logging.config import fileConfig
     # Logging config file
     logConf = os.path.join(getConfigDir(), 'logging.conf')
@@ -178,9 +238,15 @@ def configApp():
     # handlers can know the path to the log dir
     logging.logDir = getLogDir()
     fileConfig(logConf, disable_existing_loggers=False)
+    _loggingConfigured = True
 
-    # Get component configs into config
-    conf = componentConfig('app', required=True)
+def configApp():
+    """
+    Sets logging up and reads the app L{conf}ig. Entry points should call this
+    before anything else, so that everything is logged.
+    """
+    configLogging()
+    conf.load()
 
 def json_processor(entity):
     """
@@ -194,6 +260,9 @@ def json_processor(entity):
     This makes JSON and normal form input data completely indistinguishable
     fvrom each other as far as the request handlers go.
     """
+    import cherrypy
+    from cherrypy._cpcompat import ntou, json_decode
+
     if not entity.headers.get(ntou("Content-Length"), ntou("")):
         raise cherrypy.HTTPError(411)
 
@@ -203,6 +272,64 @@ def json_processor(entity):
     except ValueError:
         raise cherrypy.HTTPError(400, 'Invalid JSON document')
 
+#: Regex matching the whitespace and separators between streamed JSON records
+_jsonSkip = re.compile(r'[\s,]*')
+
+def iterJsonRecords(fp, blockSize=65536):
+    """
+    Generator returning the JSON values from a stream, without reading the full
+    stream into memory.
+
+    The stream may be newline delimited JSON (NDJSON) with one value per line,
+    or a single JSON array of values. Only L{blockSize} bytes are read at a
+    time, and each value is returned as soon as it has been decoded completely.
+
+    @param fp: A file like object with a C{read(size)} method.
+    @param blockSize: The number of bytes to read from L{fp} at a time.
+
+    @raises ValueError: If the stream is not valid JSON.
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    buf, pos, eof = u'', 0, False
+    # None until we know if this is an array or NDJSON
+    inArray = None
+
+    while True:
+        # Skip whitespace and array element separators
+        pos = _jsonSkip.match(buf, pos).end()
+        if pos == len(buf) or inArray is None:
+            if pos == len(buf):
+                if eof:
+                    break
+                # Drop what was consumed and read the next block
+                data = fp.read(blockSize)
+                eof = not data
+                buf, pos = buf[pos:] + utf8.decode(data, final=eof), 0
+                continue
+            inArray = buf[pos] == u'['
+            if inArray:
+                pos += 1
+            continue
+
+        if inArray and buf[pos] == u']':
+            # End of the array
+            break
+
+        try:
+            value, end = decoder.raw_decode(buf, pos)
+        except ValueError:
+            # Could be a partial value, so try reading more
+            if eof:
+                raise ValueError("Invalid JSON document")
+            data = fp.read(blockSize)
+            eof = not data
+            buf, pos = buf[pos:] + utf8.decode(data, final=eof), 0
+            continue
+
+        pos = end
+        yield value
+
 def errorHandler(status, message, traceback, version):
     """
     Error handler for services.
@@ -222,6 +349,9 @@ def errorHandler(status, message, traceback, version):
 
     @see: U{http://cherrypy.readthedocs.org/en/latest/pkg/cherrypy.html?highlight=_cperror#module-cherrypy._cperror}
     """
+    import cherrypy
+    from cherrypy._cpcompat import json_encode
+
     # The status and message data to return
     dat = {'status': status, 'msg': message}
     # The caller may have added the errorInfo attribute to the response object.
@@ -242,7 +372,3 @@ def errorHandler(status, message, traceback, version):
     cherrypy.response.headers['Content-Type'] = 'application/json'
     # Return the serialized data
     return dat
-
-
-# Always run configApp when importing or using this file
-configApp()
@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+"""
+Admission control for the API: per client rate limits and per route caps on
+the requests in progress.
+
+The C{admission} CherryPy tool, configured in C{api.conf}, admits a request
+only if:
+
+    - the client IP has a token left in its read or write token bucket. This
+      is checked before authentication, so password guessing is limited too,
+    - the authenticated user has a token left in their read or write bucket,
+    - the route has fewer than C{maxInFlight} requests in progress.
+
+GET, HEAD and OPTIONS requests are reads, and all others are writes. Rate
+limits are given as (rate, burst) tuples, where rate is the tokens added per
+second, and burst the bucket size. A client over its rate gets a
+C{429 Too Many Requests}, and a route at its cap a C{503 Service Unavailable},
+both with a C{Retry-After} header and the usual JSON error body.
+
+Buckets are kept in memory per process, and striped over a few locks that are
+only held to update a single bucket, so admitting a request costs a few
+microseconds. Rejections, the requests in progress and the number of buckets
+are exposed as metrics.
+"""
+
+import math
+import time
+import heapq
+import threading
+import cherrypy
+from lib import metrics
+
+#: The number of locks the token buckets are striped over
+LOCK_STRIPES = 16
+
+#: Idle buckets are dropped once there are more buckets than this
+MAX_BUCKETS = 100000
+
+#: The fraction of the buckets a prune frees at least, dropping the least
+#: recently used buckets if not enough of them are idle
+PRUNE_FRACTION = 0.1
+
+#: The methods that use the read rate limits
+READ_METHODS = frozenset(('GET', 'HEAD', 'OPTIONS'))
+
+metrics.registry.counter('admission_rejected_total',
+                         "Requests rejected by admission control.")
+
+class RetryLater(cherrypy.HTTPError):
+    """
+    A C{503 Service Unavailable}, or other, error with a C{Retry-After}
+    header.
+
+    CherryPy removes any C{Retry-After} header set before an error is raised,
+    so it is added when the error response is set.
+    """
+
+    def __init__(self, retryAfter, message=None, status=503):
+        """
+        Instance initialization.
+
+        @param retryAfter: The number of seconds the client should wait
+               before retrying.
+        @param message: The error message.
+        @param status: The error status.
+        """
+        self.retryAfter = retryAfter
+        super(RetryLater, self).__init__(status, message)
+
+    def set_response(self):
+        super(RetryLater, self).set_response()
+        cherrypy.serving.response.headers['Retry-After'] = \
+                str(self.retryAfter)
+
+class TokenBuckets(object):
+    """
+    Token buckets keyed by client.
+
+    A bucket is a [tokens, updated, fullAt] list, where fullAt is the time the
+    bucket is full again, after which it is the same as a new bucket and can
+    be dropped.
+    """
+
+    def __init__(self, maxBuckets=MAX_BUCKETS):
+        """
+        Instance initialization.
+
+        @param maxBuckets: The number of buckets above which the idle ones are
+               dropped.
+        """
+        self.maxBuckets = maxBuckets
+        self._buckets = {}
+        self._locks = [threading.Lock() for _ in range(LOCK_STRIPES)]
+        self._pruneLock = threading.Lock()
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def take(self, key, rate, burst, now=None):
+        """
+        Takes a token from the bucket for L{key}.
+
+        @param key: The client key.
+        @param rate: The tokens added to the bucket per second.
+        @param burst: The size of the bucket.
+        @param now: The current time, for tests.
+
+        @return: 0 if a token was taken, or else the number of seconds until
+            one is available.
+        """
+        if now is None:
+            now = time.time()
+        rate = float(rate)
+        with self._locks[hash(key) % LOCK_STRIPES]:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                if len(self._buckets) >= self.maxBuckets:
+                    self._prune(now)
+                tokens = burst
+                bucket = self._buckets[key] = [burst, now, now]
+            else:
+                tokens = min(burst, bucket[0] + (now - bucket[1]) * rate)
+            wait = (1 - tokens) / rate if tokens < 1 else 0
+            if not wait:
+                tokens -= 1
+            bucket[:] = [tokens, now, now + (burst - tokens) / rate]
+            return wait
+
+    def _prune(self, now):
+        """
+        Drops the buckets that are full again. If that does not free
+        L{PRUNE_FRACTION} of L{maxBuckets}, the least recently used buckets are
+        dropped as well, so that clients that keep their buckets from filling
+        up can not grow the buckets without bound. Only one thread prunes at a
+        time, while the others carry on.
+        """
+        if not self._pruneLock.acquire(False):
+            return
+        try:
+            # items() copies the buckets atomically under the GIL. A bucket
+            # taken from while being dropped is lost, which only lets that
+            # client have one token more.
+            for key, bucket in self._buckets.items():
+                if bucket[2] <= now:
+                    self._buckets.pop(key, None)
+            keep = self.maxBuckets - max(1, int(self.maxBuckets *
+                                                PRUNE_FRACTION))
+            excess = len(self._buckets) - keep
+            if excess > 0:
+                for key, _ in heapq.nsmallest(excess, self._buckets.items(),
+                                              key=lambda item: item[1][1]):
+                    self._buckets.pop(key, None)
+        finally:
+            self._pruneLock.release()
+
+class InFlight(object):
+    """
+    Counts the requests in progress per route.
+    """
+
+    def __init__(self):
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def enter(self, route, limit):
+        """
+        Counts a request for L{route} if it has fewer than L{limit} in
+        progress.
+
+        @return: True if the request was counted, and must L{leave} later.
+        """
+        with self._lock:
+            count = self._counts.get(route, 0)
+            if count >= limit:
+                return False
+            self._counts[route] = count + 1
+            return True
+
+    def leave(self, route):
+        """
+        Uncounts a request counted by L{enter}.
+        """
+        with self._lock:
+            self._counts[route] -= 1
+
+    def counts(self):
+        """
+        Returns a dictionary mapping routes to their requests in progress.
+        """
+        with self._lock:
+            return dict(self._counts)
+
+#: The token buckets for all clients
+buckets = TokenBuckets()
+
+#: The requests in progress
+inFlight = InFlight()
+
+def reject(limit, route, retryAfter, status=429):
+    """
+    Counts a rejected request and raises the error for it.
+
+    @param limit: The limit the request is over: 'ip', 'user' or 'inFlight'.
+    @param route: The route of the request.
+    @param retryAfter: The seconds until the request may be admitted.
+
+    @raises RetryLater: Always.
+    """
+    metrics.registry.inc('admission_rejected_total',
+                         (('limit', limit), ('route', route)))
+    retryAfter = max(1, int(math.ceil(retryAfter)))
+    cherrypy.serving.response.errorInfo = {'limit': limit,
+                                           'retryAfter': retryAfter}
+    if status == 429:
+        raise RetryLater(retryAfter, "Too many requests.", status)
+    raise RetryLater(retryAfter, "Too many requests in progress.", status)
+
+def admit(userRead=None, userWrite=None, ipRead=None, ipWrite=None,
+          maxInFlight=None, retryAfter=1):
+    """
+    The C{admission} tool callable. Checks the client IP rate limit and the
+    route cap, and attaches L{admitUser} to check the user rate limit once
+    the request is authenticated.
+
+    @param userRead: The (rate, burst) limit on reads per user, or None.
+    @param userWrite: The (rate, burst) limit on writes per user, or None.
+    @param ipRead: The (rate, burst) limit on reads per client IP, or None.
+    @param ipWrite: The (rate, burst) limit on writes per client IP, or None.
+    @param maxInFlight: The maximum number of requests in progress per route,
+           or None for no limit.
+    @param retryAfter: The seconds to retry after when a route is at its cap.
+    """
+    request = cherrypy.serving.request
+    route = metrics.routeName(request)
+    if request.method in READ_METHODS:
+        ipLimit, userLimit, cls = ipRead, userRead, 'read'
+    else:
+        ipLimit, userLimit, cls = ipWrite, userWrite, 'write'
+
+    if ipLimit:
+        wait = buckets.take(('ip', cls, request.remote.ip), *ipLimit)
+        if wait:
+            reject('ip', route, wait)
+    if userLimit:
+        # After authentication, which runs before_handler with priority 1
+        request.hooks.attach('before_handler', admitUser, priority=2,
+                             route=route, cls=cls, limit=userLimit)
+    if maxInFlight:
+        if not inFlight.enter(route, maxInFlight):
+            reject('inFlight', route, retryAfter, 503)
+        request.hooks.attach('on_end_request', inFlight.leave, route=route)
+
+def admitUser(route, cls, limit):
+    """
+    Checks the rate limit for the authenticated user, if any.
+    """
+    login = cherrypy.serving.request.login
+    if login:
+        wait = buckets.take(('user', cls, login), *limit)
+        if wait:
+            reject('user', route, wait)
+
+# After the metrics and queryAudit tools, so rejections are recorded
+cherrypy.tools.admission = cherrypy.Tool('on_start_resource', admit,
+                                         priority=60)
+
+def collect():
+    """
+    Returns the admission control gauges for the metrics registry.
+    """
+    return [('admission_in_flight', 'gauge', "Requests in progress.",
+             [((('route', route),), count)
+              for route, count in sorted(inFlight.counts().items())]),
+            ('admission_buckets', 'gauge', "Client token buckets.",
+             [((), len(buckets))])]
+
+metrics.registry.collector(collect)
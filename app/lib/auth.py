@@ -1,11 +1,204 @@
 # -*- coding: utf-8 -*-
 """
 Authentication and access control module.
+
+API user credentials are kept in the L{db.Credential} table as salted PBKDF2
+hashes, with the HTTP Digest HA1 value next to it for Digest authentication.
+
+Hashing a password is deliberately slow, so successful verifications are kept
+in a bounded, time limited cache. The cache is keyed by an HMAC of the
+credentials with a random per process key, so no plaintext password is ever
+held in memory beyond the request that supplied it.
 """
 
-USERS = {'admin': 'admin'}
+import os
+import hmac
+import base64
+import hashlib
+import logging
+from lib import conf, database as db, metrics
+from lib.cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+#: The C{[auth]} config section
+authConf = conf.get('auth', {})
+
+#: The hash algorithm identifier stored with each password hash
+ALGORITHM = 'pbkdf2_sha256'
+
+#: The number of PBKDF2 iterations for new password hashes
+iterations = authConf.get('iterations', 100000)
+
+#: The realm the HTTP Digest HA1 values are calculated for. This must match the
+#: C{tools.auth_digest.realm} setting in C{api.conf}.
+realm = authConf.get('realm', 'localhost')
+
+#: The secret used for creating HTTP Digest nonces
+digestKey = authConf.get('digestKey') or base64.b16encode(os.urandom(16))
+
+#: The secret the verified credentials cache keys are derived with
+_cacheSecret = os.urandom(32)
+
+#: Cache of recently verified credentials, or None if switched off by setting
+#: the C{[auth]} cacheSize to 0
+verifiedCache = None
+if authConf.get('cacheSize', 1024):
+    verifiedCache = LRUCache(maxSize=authConf.get('cacheSize', 1024),
+                             ttl=authConf.get('cacheTtl', 300),
+                             shared='auth')
+    metrics.cacheCollector('auth', verifiedCache)
+
+def _utf8(s):
+    return s.encode('utf-8') if isinstance(s, unicode) else s
+
+def hashPassword(password, salt=None, rounds=None):
+    """
+    Returns the salted hash for a password.
+
+    @param password: The plaintext password.
+    @param salt: The salt to use. A new random salt is used if None.
+    @param rounds: The number of PBKDF2 iterations. Defaults to L{iterations}.
+
+    @return: The hash as 'pbkdf2_sha256$iterations$salt$hash'.
+    """
+    if salt is None:
+        salt = base64.b64encode(os.urandom(12))
+    rounds = rounds or iterations
+    digest = hashlib.pbkdf2_hmac('sha256', _utf8(password), salt, rounds)
+
+    return '$'.join((ALGORITHM, str(rounds), salt,
+                     base64.b64encode(digest)))
+
+def checkPassword(password, pwHash):
+    """
+    Verifies a password against a hash from L{hashPassword}.
+
+    @return: True if the password matches, False otherwise.
+    """
+    try:
+        algorithm, rounds, salt, _ = pwHash.split('$')
+    except ValueError:
+        return False
+    if algorithm != ALGORITHM:
+        return False
+    expected = hashPassword(password, salt=str(salt), rounds=int(rounds))
+
+    return hmac.compare_digest(str(pwHash), expected)
+
+def digestHA1(username, password, digestRealm=None):
+    """
+    Returns the HTTP Digest HA1 value: MD5('username:realm:password').
+
+    @param digestRealm: The realm. Defaults to L{realm}.
+    """
+    return hashlib.md5(':'.join((_utf8(username), _utf8(digestRealm or realm),
+                                 _utf8(password)))).hexdigest()
+
+def _cacheKey(authRealm, username, password):
+    """
+    Returns the verified credentials cache key for a set of credentials.
+    """
+    msg = '\0'.join((_utf8(authRealm or ''), _utf8(username), _utf8(password)))
+    return hmac.new(_cacheSecret, msg, hashlib.sha256).digest()
+
+def setPassword(username, password):
+    """
+    Adds or replaces the credentials for an API user.
+
+    @param username: The API username.
+    @param password: The plaintext password.
+    """
+    fields = {'pwHash': hashPassword(password), 'realm': realm,
+              'ha1': digestHA1(username, password)}
+    with db.transaction():
+        updated = db.Credential.update(**fields)\
+                    .where(db.Credential.name == username).execute()
+        if not updated:
+            db.Credential.insert(name=username, **fields).execute()
+    # The cache keys do not tell us whose credentials they are for, so we can
+    # not only drop this user's entries
+    if verifiedCache is not None:
+        verifiedCache.clear()
+
+def deleteUser(username):
+    """
+    Removes the credentials for an API user.
+
+    @return: True if the user existed, False otherwise.
+    """
+    deleted = db.Credential.delete()\
+                .where(db.Credential.name == username).execute()
+    if verifiedCache is not None:
+        verifiedCache.clear()
+
+    return bool(deleted)
+
+def bootstrap():
+    """
+    Adds the users in the C{[auth]} users config that are not in the credential
+    store yet. Existing credentials are never changed.
+    """
+    users = authConf.get('users') or {}
+    if not users:
+        return
+    existing = set(n for n, in db.Credential.select(db.Credential.name)\
+                                 .where(db.Credential.name << users.keys())\
+                                 .tuples())
+    for username in sorted(set(users) - existing):
+        logger.info("Adding bootstrap API user: %s", username)
+        setPassword(username, users[username])
+
+@db.prepared
+def _pwHashQuery():
+    """
+    The password hash lookup for L{validate_password}.
+    """
+    return db.Credential.select(db.Credential.pwHash)\
+            .where(db.Credential.name == db.Placeholder('name'))
+
+@db.prepared
+def _ha1Query():
+    """
+    The HA1 lookup for L{get_ha1}.
+    """
+    return db.Credential.select(db.Credential.realm, db.Credential.ha1)\
+            .where(db.Credential.name == db.Placeholder('name'))\
+            .limit(1)\
+            .tuples()
+
+def validate_password(authRealm, username, password):
+    """
+    Checks Basic authentication credentials. Used as the C{checkpassword}
+    function for the CherryPy C{auth_basic} tool.
+
+    @return: True if the credentials are valid, False otherwise.
+    """
+    if verifiedCache is not None:
+        key = _cacheKey(authRealm, username, password)
+        if verifiedCache.get(key):
+            return True
+        version = verifiedCache.version()
+
+    pwHash = _pwHashQuery.scalar(name=username)
+    if pwHash is None or not checkPassword(password, pwHash):
+        return False
+
+    if verifiedCache is not None:
+        verifiedCache.set(key, True, version)
+    return True
+
+def get_ha1(authRealm, username):
+    """
+    Returns the HTTP Digest HA1 value for a user. Used as the C{get_ha1}
+    function for the CherryPy C{auth_digest} tool.
+
+    @return: The HA1 value, or None if the user is unknown, or the HA1 value was
+             calculated for a different realm.
+    """
+    row = next(iter(_ha1Query.execute(name=username)), None)
+    if row is None or row[0] != authRealm:
+        return None
 
-def validate_password(realm, username, password):
-    if username in USERS and USERS[username] == password:
-       return True
-    return False
+    # The digest tool only accepts native strings
+    return str(row[1])
@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+"""
+Online backups and restores of the database.
+
+A backup is a gzip compressed copy of the database file. It is made from a
+snapshot taken with C{VACUUM INTO} on a connection of its own, which copies
+the database as of a single read transaction into a new, compacted file.
+Python 2's sqlite3 module has no binding for the SQLite online backup API, but
+in WAL mode a read transaction never blocks the writer, so writes carry on
+while the snapshot is taken. Only checkpoints can not move past the snapshot
+until it is done.
+
+The snapshot is written to a temporary file next to the database, and
+compressed from there in chunks, so a backup never holds the database in
+memory. The file is deleted as soon as it is opened for compressing, so it is
+never left behind, even if the backup is not read to the end, or at all.
+
+Restoring replaces the database file with a verified backup. It needs the
+server to be stopped, and refuses to run while any other connection has the
+database open.
+"""
+
+import os
+import zlib
+import sqlite3
+import logging
+import tempfile
+from functools import partial
+from lib import conf, generation, database as db
+
+logger = logging.getLogger(__name__)
+
+#: The tables a backup must have
+REQUIRED_TABLES = ('domain', 'host', 'user', 'authorizedkeys', 'schemaversion')
+
+#: The gzip magic number
+GZIP_MAGIC = '\x1f\x8b'
+
+class BackupError(Exception):
+    """
+    Raised when a backup can not be made or restored.
+    """
+
+def backupConf():
+    """
+    Returns the C{[backup]} config, with defaults for missing settings.
+    """
+    settings = {'chunkSize': 65536, 'compressLevel': 6, 'users': []}
+    settings.update(conf.get('backup', {}))
+
+    return settings
+
+def _tempFile(prefix):
+    """
+    Returns the path of a new, empty, temporary file next to the database.
+    """
+    fd, path = tempfile.mkstemp(prefix=prefix, suffix='.sqlite',
+                                dir=os.path.dirname(os.path.abspath(db.path())))
+    os.close(fd)
+
+    return path
+
+def snapshot():
+    """
+    Takes a consistent snapshot of the database.
+
+    @return: The path of the snapshot file. The caller must delete it.
+    """
+    path = _tempFile('backup-')
+    try:
+        conn = sqlite3.connect(db.path(), isolation_level=None,
+                               timeout=conf['database'].get('busyTimeout',
+                                                            5000) / 1000.0)
+        try:
+            conn.execute('VACUUM INTO ?', (path,))
+        finally:
+            conn.close()
+    except:
+        os.unlink(path)
+        raise
+    logger.info("Took a database snapshot of %s bytes",
+                os.path.getsize(path))
+
+    return path
+
+def compress(path, remove=True):
+    """
+    Returns a generator returning the gzip compressed contents of the file
+    L{path} in chunks.
+
+    @param remove: If True, the file is deleted once it is opened, before the
+           generator is returned. The open file can still be read, and its
+           space is freed when the generator is done, closed or discarded.
+    """
+    try:
+        f = open(path, 'rb')
+    finally:
+        if remove:
+            os.unlink(path)
+
+    return _compress(f)
+
+def _compress(f):
+    """
+    Generator returning the gzip compressed contents of the open file L{f} in
+    chunks, and closing it when done.
+    """
+    settings = backupConf()
+    with f:
+        compressor = zlib.compressobj(settings['compressLevel'], zlib.DEFLATED,
+                                      16 + zlib.MAX_WBITS)
+        for data in iter(partial(f.read, settings['chunkSize']), ''):
+            chunk = compressor.compress(data)
+            if chunk:
+                yield chunk
+        yield compressor.flush()
+
+def stream():
+    """
+    Takes a snapshot of the database, and returns a generator returning the
+    gzip compressed backup in chunks. The snapshot file is deleted before the
+    generator is returned. See L{compress}.
+    """
+    return compress(snapshot())
+
+def backup(out):
+    """
+    Writes a gzip compressed backup of the database to L{out}.
+
+    @param out: A file object, or a path. A path is written to through a
+           temporary file next to it, so it either holds a complete backup or
+           is left as it was.
+
+    @return: The number of compressed bytes written.
+    """
+    if not isinstance(out, basestring):
+        size = 0
+        for chunk in stream():
+            out.write(chunk)
+            size += len(chunk)
+        return size
+
+    tmp = out + '.tmp'
+    try:
+        with open(tmp, 'wb') as f:
+            size = backup(f)
+        os.rename(tmp, out)
+    except:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
+    return size
+
+def _decompress(source, path):
+    """
+    Writes the backup file L{source}, gzip compressed or not, to L{path}.
+    """
+    chunkSize = backupConf()['chunkSize']
+    with open(source, 'rb') as f, open(path, 'wb') as out:
+        data = f.read(chunkSize)
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS) \
+                       if data.startswith(GZIP_MAGIC) else None
+        while data:
+            out.write(decompressor.decompress(data) if decompressor else data)
+            data = f.read(chunkSize)
+        if decompressor is not None:
+            out.write(decompressor.flush())
+
+def verify(path):
+    """
+    Checks the uncompressed database file L{path} with the SQLite integrity
+    and foreign key checks, and for the tables a backup must have.
+
+    @return: A list of problem descriptions, which is empty if there are none.
+    """
+    try:
+        conn = sqlite3.connect(path, isolation_level=None)
+        try:
+            problems = [row[0] for row in
+                        conn.execute('PRAGMA integrity_check')
+                        if row[0] != 'ok']
+            if problems:
+                return problems
+            tables = set(row[0] for row in conn.execute(
+                    "SELECT name FROM sqlite_master WHERE type='table'"))
+            problems.extend("Missing table: {0}".format(t)
+                            for t in REQUIRED_TABLES if t not in tables)
+            problems.extend(
+                    "Foreign key violation: {0} row {1} references {2}"\
+                            .format(*row)
+                    for row in conn.execute('PRAGMA foreign_key_check'))
+        finally:
+            conn.close()
+    except sqlite3.DatabaseError, exc:
+        return [str(exc)]
+
+    return problems
+
+def check(source):
+    """
+    Verifies the backup file L{source}, gzip compressed or not.
+
+    @return: A list of problem descriptions. See L{verify}.
+    """
+    path = _tempFile('restore-')
+    try:
+        try:
+            _decompress(source, path)
+        except zlib.error, exc:
+            return ["Invalid compressed data: {0}".format(exc)]
+        return verify(path)
+    finally:
+        os.unlink(path)
+
+def restore(source):
+    """
+    Replaces the database with the backup file L{source}, gzip compressed or
+    not, after verifying it.
+
+    The database connections of this process must be closed, and the server
+    must be stopped. Backups of older schema versions are migrated when the
+    database is next set up.
+
+    @raises BackupError: If the backup has problems, or the database is in
+            use.
+    """
+    path = _tempFile('restore-')
+    try:
+        try:
+            _decompress(source, path)
+        except zlib.error, exc:
+            raise BackupError("Invalid compressed data: {0}".format(exc))
+        problems = verify(path)
+        if problems:
+            raise BackupError("Invalid backup: {0}".format('; '.join(problems)))
+
+        dbPath = db.path()
+        conn = None
+        if os.path.exists(dbPath):
+            conn = sqlite3.connect(dbPath, isolation_level=None, timeout=0)
+        try:
+            if conn is not None:
+                # Leaving WAL mode needs the only connection to the database,
+                # and checkpoints and removes the WAL file. The exclusive lock
+                # keeps anything else from writing until it is replaced.
+                try:
+                    conn.execute('PRAGMA journal_mode=DELETE')
+                    conn.execute('BEGIN EXCLUSIVE')
+                except sqlite3.OperationalError:
+                    raise BackupError("The database is in use. Stop the "
+                                      "server first.")
+            os.rename(path, dbPath)
+        finally:
+            if conn is not None:
+                conn.close()
+    finally:
+        if os.path.exists(path):
+            os.unlink(path)
+
+    # Any processes sharing the counters drop their cached data
+    for name in generation.SLOTS:
+        generation.bump(name)
+    logger.info("Restored the database from %s", source)
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""
+In-process caching library.
+"""
+
+import time
+import threading
+from collections import OrderedDict
+from lib import generation
+
+class LRUCache(object):
+    """
+    A bounded, thread safe, least recently used cache with an optional time to
+    live for entries.
+
+    When the cache is full, the least recently used entry is evicted to make
+    space for a new entry. Entries older than L{ttl} seconds are treated as
+    missing and removed when next accessed.
+
+    Hit, miss, eviction and invalidation counters are kept and can be retrieved
+    with L{stats}.
+
+    A value read from the source after a miss may be stale by the time it is
+    cached, if the source changed and the entry was invalidated in between.
+    Callers take the L{version} before reading the source, and pass it to
+    L{set}, which drops the value if anything was invalidated since.
+
+    A cache of data that other processes change as well can follow a shared
+    L{generation} counter. Invalidating entries bumps the counter, and when
+    another process bumped it, all entries are dropped on the next access.
+    """
+
+    def __init__(self, maxSize=1024, ttl=None, shared=None):
+        """
+        Instance initialization.
+
+        @param maxSize: The maximum number of entries to hold in the cache.
+        @param ttl: The number of seconds an entry stays valid. If None, entries
+               only leave the cache when evicted or invalidated.
+        @param shared: The name of the L{generation} counter for the cached
+               data, or None if only this process changes it.
+        """
+        if maxSize < 1:
+            raise ValueError("Cache size must be at least 1.")
+
+        self.maxSize = maxSize
+        self.ttl = ttl
+        self.shared = shared
+        self._generation = None
+        # Incremented whenever entries are invalidated
+        self._version = 0
+
+        # Maps key to (expiry, value) tuples, in least to most recently used
+        # order
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def get(self, key, default=None):
+        """
+        Returns the cached value for L{key}.
+
+        @param key: The key to look up.
+        @param default: The value to return if the key is not in the cache, or
+               has expired.
+
+        @return: The cached value, or L{default}.
+        """
+        with self._lock:
+            self._sync()
+            try:
+                expiry, value = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+
+            if expiry is not None and expiry <= time.time():
+                # Stale, so we leave it out of the cache
+                self.expirations += 1
+                self.misses += 1
+                return default
+
+            # Re-inserting marks it as the most recently used entry
+            self._entries[key] = (expiry, value)
+            self.hits += 1
+            return value
+
+    def version(self):
+        """
+        Returns the current version of the cache, to pass to L{set} for a
+        value read from the source after this call.
+        """
+        with self._lock:
+            self._sync()
+            return self._version
+
+    def set(self, key, value, version=None):
+        """
+        Adds or replaces the cache entry for L{key}, evicting the least recently
+        used entry if the cache is full.
+
+        @param key: The key to cache the value for.
+        @param value: The value to cache.
+        @param version: The L{version} taken before the value was read. If
+               entries were invalidated since, the value may be stale, and is
+               not cached.
+        """
+        expiry = time.time() + self.ttl if self.ttl else None
+
+        with self._lock:
+            if not self._sync():
+                # The value may have been read before the change, so it is
+                # not cached until the next one
+                return
+            if version is not None and version != self._version:
+                return
+            self._entries.pop(key, None)
+            self._entries[key] = (expiry, value)
+            while len(self._entries) > self.maxSize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        """
+        Removes L{key} from the cache if present.
+
+        @param key: The key to remove.
+        """
+        with self._lock:
+            if self._entries.pop(key, None) is not None:
+                self.invalidations += 1
+            self._version += 1
+            self._bump()
+
+    def clear(self):
+        """
+        Removes all entries from the cache.
+        """
+        with self._lock:
+            self._clear()
+            self._bump()
+
+    def _clear(self):
+        self.invalidations += len(self._entries)
+        self._entries.clear()
+        self._version += 1
+
+    def _sync(self):
+        """
+        Drops all entries if another process bumped the L{shared} generation
+        since the last access.
+
+        @return: False if the entries were dropped, True otherwise.
+        """
+        if self.shared is None:
+            return True
+        current = generation.current(self.shared)
+        if current == self._generation:
+            return True
+        self._clear()
+        self._generation = current
+        return False
+
+    def _bump(self):
+        """
+        Bumps the L{shared} generation after entries were invalidated, and
+        drops all entries if another process bumped it first.
+        """
+        if self.shared is None:
+            return
+        bumped = generation.bump(self.shared)
+        if bumped is not None and bumped != (self._generation or 0) + 1:
+            self._clear()
+        self._generation = bumped
+
+    def stats(self):
+        """
+        Returns the cache counters.
+
+        @return: A dictionary with the current size and limits of the cache, and
+                 the hit, miss, eviction, expiration and invalidation counters.
+        """
+        with self._lock:
+            return {'size': len(self._entries),
+                    'maxSize': self.maxSize,
+                    'ttl': self.ttl,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'expirations': self.expirations,
+                    'invalidations': self.invalidations}
+
+    def __len__(self):
+        return len(self._entries)
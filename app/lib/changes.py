@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+"""
+The change feed.
+
+Every change to a user's key, or to the C{authorized_keys} file of a user, is
+appended to the L{db.Change} log in the same transaction as the change itself,
+with L{record}. The entry ids are the change sequence numbers, so clients can
+fetch only the changes after the last sequence number they have seen with
+L{changesSince}, instead of fetching all keys again.
+
+L{waitForChanges} long-polls: when there are no new changes, it waits on a
+condition that is notified when a transaction adding changes commits in this
+process, instead of polling the database. Changes committed by other processes,
+such as the other workers when serving with several, bump the shared
+C{changes} L{generation} counter, which waiting requests check every
+C{[changes] pollInterval} seconds.
+
+The log is compacted by L{compact}, which keeps the most recent entries. A
+client that is behind the compacted entries can no longer catch up from the
+log, and is told to fetch a full snapshot instead.
+
+Entry ids are SQLite rowids, which only stay increasing as long as the newest
+entry is never deleted, so compaction always keeps it.
+"""
+
+import time
+import logging
+import threading
+from lib import conf, generation, database as db, sshKey
+from external.peewee import Param, fn
+
+logger = logging.getLogger(__name__)
+
+#: The C{[changes]} config section
+changesConf = conf.get('changes', {})
+
+#: Change kinds
+KEY = 'key'
+AUTHORIZED_KEYS = 'authorized_keys'
+
+#: The scopes changes can be filtered on
+SCOPES = ('domain', 'host')
+
+#: Notified whenever a transaction adding changes commits in this process
+_changed = threading.Condition()
+#: Incremented on every notification, so waiters can tell if they missed one
+_generation = 0
+#: The number of requests currently waiting in L{waitForChanges}
+_waiters = 0
+#: The compaction engine plugin, once set up
+_compactor = None
+
+class TooManyWaiters(Exception):
+    """
+    Raised by L{waitForChanges} when the maximum number of waiting requests is
+    reached.
+    """
+
+def record(kind, where):
+    """
+    Appends a change of L{kind} for every user selected by L{where}, in one
+    C{INSERT INTO ... SELECT} statement. Must be called in the transaction
+    making the change.
+
+    @param kind: L{KEY} or L{AUTHORIZED_KEYS}.
+    @param where: An expression on L{db.User} selecting the changed users.
+    """
+    db.insertFromSelect(db.Change, (db.Change.kind, db.Change.user),
+                        db.User.select(Param(kind), db.User.id).where(where))
+    db.afterCommit(notify)
+
+def notify():
+    """
+    Wakes up all requests waiting in L{waitForChanges}, in this process and,
+    through the shared generation, in other processes.
+    """
+    global _generation
+    with _changed:
+        _generation += 1
+        _changed.notify_all()
+    generation.bump('changes')
+
+def bounds():
+    """
+    Returns the (first, last) sequence numbers in the log, or (None, None) if
+    the log is empty.
+    """
+    return tuple(db.Change.select(fn.Min(db.Change.id), fn.Max(db.Change.id))\
+                          .tuples().first())
+
+def _scopeWhere(scope, name):
+    """
+    Returns the expression restricting changes to L{scope}, or None for all
+    changes.
+
+    @raises ValueError: If the scope or name is invalid.
+    """
+    if scope is None:
+        return None
+    if scope not in SCOPES:
+        raise ValueError("Invalid scope: {0}".format(scope))
+    if not name:
+        raise ValueError("A name is required for the {0} scope".format(scope))
+    if scope == 'domain':
+        return db.Domain.name == name
+    host, _, domain = name.partition('.')
+    if not domain:
+        raise ValueError("Invalid host.domain: {0}".format(name))
+
+    return (db.Host.name == host) & (db.Domain.name == domain)
+
+def changesSince(since, scope=None, name=None, limit=1000):
+    """
+    Returns the changes after sequence number L{since}.
+
+    Keys are returned as they are now, and not as they were at the time of the
+    change, so a user with several changes in the result has the same key in
+    all of them.
+
+    @param since: The last sequence number seen by the client, or 0 to start
+           from the beginning of the log.
+    @param scope: None for all changes, C{domain} for changes to users in the
+           domain L{name}, or C{host} for changes to users on the host.domain
+           L{name}.
+    @param name: The domain or host.domain name for the L{scope}.
+    @param limit: The maximum number of changes to return.
+
+    @return: A dictionary with:
+        - C{changes}: A list of C{{'seq', 'kind', 'uhd'}} dictionaries,
+          with the public key as C{key} for key changes. For
+          C{authorized_keys} changes, the file should be fetched again.
+        - C{next}: The sequence number to pass as L{since} next time.
+        - C{more}: True if there are more changes than L{limit}.
+        - C{last}: The last sequence number in the log, which clients taking a
+          full snapshot continue from.
+        - C{snapshotRequired}: True if changes after L{since} have been
+          compacted away, or L{since} is past the end of the log. No changes
+          are returned, and the client must fetch all keys it needs, and then
+          continue from C{next}.
+
+    @raises ValueError: If the scope or name is invalid.
+    """
+    scopeWhere = _scopeWhere(scope, name)
+    first, last = bounds()
+    res = {'changes': [], 'next': since, 'more': False, 'last': last or 0,
+           'snapshotRequired': False}
+    if since > (last or 0) or (first is not None and since < first - 1):
+        # The client is ahead of the log, which only happens if the database
+        # was restored, or changes it needs were compacted away
+        res.update(next=last or 0, snapshotRequired=True)
+        return res
+    if last is None or last == since:
+        return res
+
+    query = db.Change.select(db.Change.id, db.Change.kind, db.User.name,
+                             db.Host.name, db.Domain.name, db.User.keyType,
+                             db.User.keyBlob, db.User.keyComment)\
+            .join(db.User, on=(db.User.id == db.Change.user))\
+            .join(db.Host)\
+            .join(db.Domain)\
+            .where(db.Change.id > since)
+    if scopeWhere is not None:
+        query = query.where(scopeWhere)
+    rows = query.order_by(db.Change.id).limit(limit).tuples()
+
+    for seq, kind, u, h, d, keyType, keyBlob, keyComment in rows:
+        change = {'seq': seq, 'kind': kind,
+                  'uhd': "{0}@{1}.{2}".format(u, h, d)}
+        if kind == KEY:
+            change['key'] = sshKey.pubKeyText(keyType, keyBlob, keyComment)
+        res['changes'].append(change)
+
+    if len(res['changes']) == limit:
+        res.update(next=res['changes'][-1]['seq'], more=True)
+    else:
+        # All changes up to the end of the log were scanned. Changes
+        # committed since the bounds were read may have been included.
+        res['next'] = max([last] + [c['seq'] for c in res['changes']])
+
+    return res
+
+def waitForChanges(since, scope=None, name=None, limit=1000, timeout=30):
+    """
+    Returns the changes after sequence number L{since}, waiting up to
+    L{timeout} seconds for changes if there are none yet.
+
+    Waiting requests are woken up by L{notify} when changes are committed in
+    this process. Changes committed by other processes are picked up within
+    C{[changes] pollInterval} seconds if the L{generation} counters are
+    shared, or else when the wait times out.
+
+    See L{changesSince} for the arguments and return value.
+
+    @param timeout: The maximum number of seconds to wait for changes.
+
+    @raises TooManyWaiters: If the C{[changes] maxWaiters} number of requests
+            are waiting already.
+    """
+    global _waiters
+    deadline = time.time() + timeout
+    interval = changesConf.get('pollInterval', 0.25)
+    with _changed:
+        seen = (_generation, generation.current('changes'))
+    res = changesSince(since, scope, name, limit)
+    if res['changes'] or res['snapshotRequired'] or timeout <= 0:
+        return res
+
+    with _changed:
+        if _waiters >= changesConf.get('maxWaiters', 5):
+            raise TooManyWaiters()
+        _waiters += 1
+    try:
+        while True:
+            with _changed:
+                while True:
+                    current = (_generation, generation.current('changes'))
+                    remaining = deadline - time.time()
+                    if current != seen or remaining <= 0:
+                        break
+                    if current[1] is not None:
+                        remaining = min(remaining, interval)
+                    _changed.wait(remaining)
+                seen = current
+            # Changes out of the scope wake us up as well, but move next on
+            res = changesSince(res['next'], scope, name, limit)
+            if res['changes'] or res['snapshotRequired'] or \
+               time.time() >= deadline:
+                return res
+    finally:
+        with _changed:
+            _waiters -= 1
+
+def compact(retain=None):
+    """
+    Deletes all but the L{retain} most recent entries from the change log.
+
+    @param retain: The number of entries to keep, at least 1. Defaults to the
+           C{[changes] retain} config.
+
+    @return: The number of entries deleted.
+    """
+    if retain is None:
+        retain = changesConf.get('retain', 100000)
+    retain = max(1, retain)
+    with db.transaction():
+        last = db.Change.select(fn.Max(db.Change.id)).scalar()
+        if last is None:
+            return 0
+        deleted = db.Change.delete().where(db.Change.id <= last - retain)\
+                .execute()
+    if deleted:
+        logger.info("Compacted %s change log entries", deleted)
+
+    return deleted
+
+def setup():
+    """
+    Schedules L{compact} on the CherryPy engine every C{[changes]
+    compactInterval} seconds, unless that is 0.
+    """
+    global _compactor
+    import cherrypy
+    from cherrypy.process.plugins import Monitor
+
+    interval = changesConf.get('compactInterval', 3600)
+    if interval and _compactor is None:
+        _compactor = Monitor(cherrypy.engine, compact, frequency=interval,
+                             name='changeLogCompaction')
+        _compactor.subscribe()
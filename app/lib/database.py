@@ -3,14 +3,393 @@
 Databse access library
 """
 
-from lib import conf, appDir
+import time
+import hashlib
+import logging
+import threading
+import cherrypy
+from lib import conf, appDir, metrics, queryAudit
 from external import peewee
 from models import *
 
+logger = logging.getLogger(__name__)
+
+class Placeholder(peewee.Node):
+    """
+    A named parameter in a L{PreparedQuery}, given a new value every time the
+    query is executed. It is used in queries where a value would be, as in
+    C{db.User.name == Placeholder('user')}.
+    """
+
+    def __init__(self, name):
+        super(Placeholder, self).__init__()
+        self.name = name
+
+class _Slot(object):
+    """
+    The compiled form of a L{Placeholder}, in the parameters of a compiled
+    query.
+    """
+
+    __slots__ = ('name', 'conv')
+
+    def __init__(self, name, conv):
+        self.name = name
+        self.conv = conv
+
+class QueryCompiler(peewee.QueryCompiler):
+    """
+    The peewee query compiler, compiling a L{Placeholder} to a parameter slot.
+
+    The compiler converts values for the database as it compiles them, so the
+    conversion for a placeholder is kept in its slot, and applied to each value
+    when the query is executed instead.
+    """
+
+    def _parse(self, node, alias_map, conv):
+        if isinstance(node, peewee.Param) and \
+           isinstance(node.value, Placeholder):
+            return self.interpolation, [_Slot(node.value.name, node.conv)], \
+                   False
+        if isinstance(node, Placeholder):
+            return self.interpolation, \
+                   [_Slot(node.name, conv.db_value if conv else None)], False
+        return super(QueryCompiler, self)._parse(node, alias_map, conv)
+
+class SqliteDatabase(peewee.SqliteDatabase):
+    """
+    SQLite database that applies a set of pragmas to every new connection,
+    records query timing in L{metrics}, and passes statements to the
+    L{queryAudit} when it is enabled.
+
+    Functions to run once the current transaction commits can be added with
+    L{afterCommit}.
+
+    Transactions are begun explicitly with C{BEGIN IMMEDIATE}, instead of
+    leaving that to the sqlite3 module, which commits any open transaction
+    before statements it does not recognize, such as C{SAVEPOINT}. Nested
+    transactions are savepoints. See L{nestableTransaction}.
+
+    Only writes run in transactions, and most of them read before they write.
+    A deferred C{BEGIN} would start them as readers, and upgrading to a writer
+    fails right away with "database is locked" when another connection writes,
+    without waiting for the busy timeout. An immediate transaction takes the
+    write lock up front, waiting for it as long as the busy timeout allows.
+
+    Queries are compiled with the L{QueryCompiler}, for L{PreparedQuery}.
+    """
+
+    compiler_class = QueryCompiler
+
+    def __init__(self, database, pragmas=(), **kwargs):
+        """
+        Instance initialization.
+
+        @param database: The database file name.
+        @param pragmas: A list of (pragma, value) tuples to apply to each new
+               connection.
+        @param kwargs: Any other peewee database arguments.
+        """
+        self.pragmas = list(pragmas)
+        self._pending = threading.local()
+        kwargs['isolation_level'] = None
+        super(SqliteDatabase, self).__init__(database, **kwargs)
+
+    def _connect(self, database, **kwargs):
+        conn = super(SqliteDatabase, self)._connect(database, **kwargs)
+        for pragma, value in self.pragmas:
+            conn.execute('PRAGMA {0} = {1}'.format(pragma, value))
+        metrics.registry.inc('db_connections_opened_total')
+        return conn
+
+    def _close(self, conn):
+        super(SqliteDatabase, self)._close(conn)
+        metrics.registry.inc('db_connections_closed_total')
+
+    def execute_sql(self, sql, params=None, require_commit=True):
+        if queryAudit.enabled:
+            queryAudit.record(sql)
+        start = time.time()
+        try:
+            return super(SqliteDatabase, self).execute_sql(sql, params,
+                                                           require_commit)
+        finally:
+            metrics.recordQuery(sql, time.time() - start)
+
+    def begin(self):
+        # Like commit and rollback, this is not counted as a query
+        self.get_conn().execute('BEGIN IMMEDIATE')
+
+    def transaction(self):
+        return nestableTransaction(self)
+
+    def afterCommit(self, func):
+        """
+        Calls L{func} without arguments once the current transaction for this
+        thread commits, or right away when not in a transaction. Nothing is
+        called if the transaction is rolled back.
+
+        Errors raised by L{func} are logged, and do not affect the commit.
+        """
+        if not self.transaction_depth():
+            func()
+            return
+        if not hasattr(self._pending, 'funcs'):
+            self._pending.funcs = []
+        self._pending.funcs.append(func)
+
+    def commit(self):
+        super(SqliteDatabase, self).commit()
+        funcs = getattr(self._pending, 'funcs', None)
+        if funcs:
+            self._pending.funcs = []
+            for func in funcs:
+                try:
+                    func()
+                except Exception:
+                    logger.exception("Error in after commit function %r",
+                                     func)
+
+    def rollback(self):
+        super(SqliteDatabase, self).rollback()
+        self._pending.funcs = []
+
+class WriterDatabase(SqliteDatabase):
+    """
+    SQLite database for a single connection shared by all threads: the writer
+    when reads and writes are split, or the only connection in C{shared} mode.
+
+    Statements and transactions are serialized on a lock, so a transaction
+    holds the connection until it ends. The autocommit and transaction state is
+    kept per thread, so a thread only sees its own transactions.
+    """
+
+    def __init__(self, database, pragmas=(), **kwargs):
+        """
+        Instance initialization.
+
+        @param database: The database file name.
+        @param pragmas: A list of (pragma, value) tuples to apply to the
+               connection.
+        @param kwargs: Any other peewee database arguments.
+        """
+        self.writeLock = threading.RLock()
+        self._state = threading.local()
+        kwargs.update(threadlocals=False, check_same_thread=False)
+        super(WriterDatabase, self).__init__(database, pragmas, **kwargs)
+
+    def execute_sql(self, sql, params=None, require_commit=True):
+        with self.writeLock:
+            return super(WriterDatabase, self).execute_sql(sql, params,
+                                                           require_commit)
+
+    def set_autocommit(self, autocommit):
+        self._state.autocommit = autocommit
+
+    def get_autocommit(self):
+        if not hasattr(self._state, 'autocommit'):
+            self.set_autocommit(self.autocommit)
+        return self._state.autocommit
+
+    def push_transaction(self, transaction):
+        if not hasattr(self._state, 'transactions'):
+            self._state.transactions = []
+        self._state.transactions.append(transaction)
+
+    def pop_transaction(self):
+        self._state.transactions.pop()
+
+    def transaction_depth(self):
+        return len(getattr(self._state, 'transactions', ()))
+
+    def transaction(self):
+        return lockedTransaction(self)
+
+class nestableTransaction(peewee.transaction):
+    """
+    Transaction that is a savepoint when nested in another transaction.
+
+    A nested transaction that fails only rolls its own changes back, and leaves
+    the error to the code around it, instead of rolling back the outermost
+    transaction. Functions added with L{SqliteDatabase.afterCommit} in a rolled
+    back nested transaction are dropped.
+    """
+
+    def __enter__(self):
+        self.savepoint = None
+        if not self.db.transaction_depth():
+            return super(nestableTransaction, self).__enter__()
+        self._orig = self.db.get_autocommit()
+        self.savepoint = self.db.savepoint()
+        self.savepoint.__enter__()
+        self._pendingMark = len(getattr(self.db._pending, 'funcs', ()))
+        self.db.push_transaction(self)
+        return self
+
+    def rollback(self):
+        if self.savepoint is None:
+            return super(nestableTransaction, self).rollback()
+        self.savepoint.rollback()
+        del getattr(self.db._pending, 'funcs', [])[self._pendingMark:]
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.savepoint is None:
+            return super(nestableTransaction, self).__exit__(exc_type, exc_val,
+                                                             exc_tb)
+        try:
+            if exc_type:
+                self.rollback()
+            self.savepoint.commit()
+        finally:
+            self.db.set_autocommit(self._orig)
+            self.db.pop_transaction()
+
+class lockedTransaction(nestableTransaction):
+    """
+    Transaction holding the L{WriterDatabase} write lock until it ends.
+    """
+
+    def __enter__(self):
+        self.db.writeLock.acquire()
+        try:
+            return super(lockedTransaction, self).__enter__()
+        except:
+            self.db.writeLock.release()
+            raise
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        try:
+            return super(lockedTransaction, self).__exit__(exc_type, exc_val,
+                                                           exc_tb)
+        finally:
+            self.db.writeLock.release()
+
+def pragmas(dbConf):
+    """
+    Returns the list of (pragma, value) tuples to apply to each new connection
+    from the C{[database]} config.
+
+    @param dbConf: The C{[database]} config dictionary.
+    """
+    prags = []
+    if dbConf.get('journalMode'):
+        prags.append(('journal_mode', dbConf['journalMode']))
+    if dbConf.get('synchronous'):
+        prags.append(('synchronous', dbConf['synchronous']))
+    if 'foreignKeys' in dbConf:
+        prags.append(('foreign_keys', 'ON' if dbConf['foreignKeys'] else 'OFF'))
+    if dbConf.get('busyTimeout') is not None:
+        prags.append(('busy_timeout', int(dbConf['busyTimeout'])))
+    if dbConf.get('cacheSize') is not None:
+        prags.append(('cache_size', int(dbConf['cacheSize'])))
+
+    return prags
+
+def readPragmas(dbConf):
+    """
+    Returns the list of (pragma, value) tuples to apply to each new read-only
+    connection from the C{[database]} config.
+
+    The journal mode is left to the writer, and C{query_only} makes SQLite
+    refuse any writes on the connection.
+
+    @param dbConf: The C{[database]} config dictionary.
+    """
+    prags = [p for p in pragmas(dbConf) if p[0] != 'journal_mode']
+    prags.append(('query_only', 'ON'))
+
+    return prags
+
+def connectThread(threadIndex=None):
+    """
+    Opens the database connection for the current thread.
+
+    Subscribed to the CherryPy engine C{start_thread} channel when each thread
+    has its own connection, so that connections are opened as worker threads
+    start instead of on their first request. When reads and writes are split,
+    this opens the read-only connection for the thread.
+    """
+    if read_proxy.obj is not None:
+        read_proxy.get_conn()
+    else:
+        db_proxy.get_conn()
+
+def closeThread(threadIndex=None):
+    """
+    Closes the database connection for the current thread, if open.
+
+    Subscribed to the CherryPy engine C{stop_thread} channel when each thread
+    has its own connection. When reads and writes are split, this closes the
+    read-only connection for the thread, and leaves the shared writer open.
+    The connection shared by all threads in C{shared} mode is left open too.
+    """
+    if read_proxy.obj is not None:
+        database = read_proxy
+    elif not isinstance(db_proxy.obj, WriterDatabase):
+        database = db_proxy
+    else:
+        return
+    if not database.is_closed():
+        database.close()
+
+def closeConnections():
+    """
+    Closes the database connections of the current thread, and the shared
+    writer connection.
+
+    Processes must not use SQLite connections opened before they were forked,
+    so this must be called before forking.
+    """
+    for database in (read_proxy, db_proxy):
+        if database.obj is not None and not database.is_closed():
+            database.close()
+
+def schemaVersion():
+    """
+    Returns the schema version for the current models and migrations.
+
+    The version is a hash of the table, field and index definitions of all
+    models, and of the migration names, so any change to the models or
+    L{lib.migrations} gives a new version without having to bump it by hand.
+    """
+    from models import model
+    from external.peewee import BaseModel
+    from lib import migrations
+
+    sha = hashlib.sha1()
+    for n in model.__all__:
+        obj = getattr(model, n)
+        if isinstance(obj, BaseModel):
+            meta = obj._meta
+            sha.update(repr((meta.db_table, meta.indexes)))
+            for field in meta.get_fields():
+                sha.update(repr((field.db_column, type(field).__name__,
+                                 field.null, field.index, field.unique)))
+    for migration in migrations.MIGRATIONS:
+        sha.update(migration.__name__ + ';')
+
+    return sha.hexdigest()
+
+def storedSchemaVersion():
+    """
+    Returns the schema version the database was last set up for, or None if it
+    was never set up, or set up before versions were stored.
+    """
+    try:
+        return SchemaVersion.select(SchemaVersion.version).scalar()
+    except peewee.OperationalError:
+        # No schema version table yet
+        return None
+
 def initialize(create=True, drop=False):
     """
     Initializes the database by creating and/or dropping tables.
 
+    The schema version is stored in the database after the tables have been
+    created and migrated. When the stored version matches L{schemaVersion}, the
+    schema is up to date, and creating the tables is skipped, so that starting
+    up on a current database only takes a single query.
+
     @param create: If True (the default), then any tables that do not exist yet
            will be created.
     @param drop: If True (the default is False), then any table that currently
@@ -22,6 +401,11 @@ def initialize(create=True, drop=False):
     # A model will be an instance of this base class
     from external.peewee import BaseModel
 
+    # Nothing to do if the schema is up to date
+    version = schemaVersion() if create else None
+    if create and not drop and storedSchemaVersion() == version:
+        return
+
     # First drop the tables if that is required
     if drop:
         # Run through all entries in model.__all__
@@ -43,6 +427,205 @@ def initialize(create=True, drop=False):
                 # It's a table, so create it without errors if exist already.
                 obj.create_table(fail_silently=True)
 
+        # Bring tables created by earlier versions up to date
+        from lib import migrations
+        migrations.run(db_proxy.obj)
+
+        # Record the version so the next start can skip all of this
+        with transaction():
+            SchemaVersion.delete().execute()
+            SchemaVersion.create(version=version)
+        logger.info("Database schema set up at version %s", version)
+
+def transaction():
+    """
+    Returns a transaction context manager for the application database.
+
+    The outermost transaction commits when it exits without error, or rolls
+    everything back otherwise. Nested transactions are savepoints, which only
+    roll their own changes back on errors. See L{nestableTransaction}.
+    """
+    return db_proxy.transaction()
+
+def afterCommit(func):
+    """
+    Calls L{func} once the current transaction commits. See
+    L{SqliteDatabase.afterCommit}.
+    """
+    db_proxy.afterCommit(func)
+
+def rowsAffected(cursor):
+    """
+    Returns the number of rows affected by the statement just executed on
+    L{cursor}.
+    """
+    return db_proxy.rows_affected(cursor)
+
+def insertOrIgnore(query):
+    """
+    Executes an insert query as an C{INSERT OR IGNORE} statement.
+
+    Rows that would violate a unique index are silently skipped by the database
+    instead of raising an L{IntegrityError}, so there is no need for a failed
+    insert followed by a select to find an existing row.
+
+    @param query: A model C{insert()} or C{insert_many()} query.
+
+    @return: The cursor for the executed statement. Use L{rowsAffected} to find
+             out how many rows were inserted, and C{cursor.lastrowid} for the id
+             of a single inserted row.
+    """
+    sql, params = query.sql()
+    sql = sql.replace('INSERT INTO', 'INSERT OR IGNORE INTO', 1)
+
+    return query.database.execute_sql(sql, params, query.require_commit)
+
+def insertFromSelect(model, fields, query, ignore=False):
+    """
+    Executes an C{INSERT INTO ... SELECT} statement, inserting the rows
+    returned by a select query in one statement.
+
+    @param model: The model to insert into.
+    @param fields: A list of L{model} fields to insert values for. The select
+           query must return exactly one column for each of these fields, in
+           the same order.
+    @param query: The select query generating the rows to insert.
+    @param ignore: If True, rows that would violate a unique index are skipped
+           (C{INSERT OR IGNORE}).
+
+    @return: The cursor for the executed statement.
+    """
+    database = model._meta.database
+    compiler = database.compiler()
+    sql, params = query.sql()
+    sql = 'INSERT {0}INTO {1} ({2}) {3}'.format(
+            'OR IGNORE ' if ignore else '',
+            compiler.quote(model._meta.db_table),
+            ', '.join(compiler.quote(f.db_column) for f in fields),
+            sql)
+
+    return database.execute_sql(sql, params)
+
+class PreparedQuery(object):
+    """
+    A select query compiled once, and then executed with new values for its
+    L{Placeholder}s every time.
+
+    peewee compiles the SQL from the query tree on every execution, which
+    costs more than running the statement for the simple lookups on the hot
+    paths. A prepared query skips that, and fills the compiled parameters in
+    instead. Results are read with the same peewee result wrappers as for the
+    query, so rows are returned as model instances, tuples or dictionaries
+    just as the query would.
+
+    Reads are routed as for any select, see L{ModelBase._readDatabase}.
+    """
+
+    def __init__(self, build):
+        """
+        Instance initialization.
+
+        @param build: A function returning the L{peewee.SelectQuery}. It is
+               called on first use, since queries can not be built before the
+               database is set up.
+        """
+        self.build = build
+        self._compiled = None
+
+    def compile(self):
+        """
+        Builds and compiles the query, if not done yet.
+
+        @return: A (query, sql, params, slots, resultWrapper) tuple, with the
+            indexes and L{_Slot}s of the placeholders in C{params} as
+            C{slots}.
+        """
+        compiled = self._compiled
+        if compiled is None:
+            query = self.build()
+            if not isinstance(query, peewee.SelectQuery):
+                raise TypeError("Only select queries can be prepared.")
+            sql, params = query.sql()
+            slots = tuple((n, p) for n, p in enumerate(params)
+                          if isinstance(p, _Slot))
+            # As chosen by SelectQuery.execute
+            if query._tuples:
+                wrapper = peewee.TuplesQueryResultWrapper
+            elif query._dicts:
+                wrapper = peewee.DictQueryResultWrapper
+            elif query._naive or not query._joins or query.verify_naive():
+                wrapper = peewee.NaiveQueryResultWrapper
+            else:
+                wrapper = peewee.ModelQueryResultWrapper
+            compiled = self._compiled = (query, sql, params, slots, wrapper)
+
+        return compiled
+
+    def _execute(self, values):
+        """
+        Executes the query with the placeholder L{values}.
+
+        @return: The cursor.
+        """
+        query, sql, params, slots, _ = self.compile()
+        params = list(params)
+        for n, slot in slots:
+            value = values[slot.name]
+            params[n] = slot.conv(value) if slot.conv else value
+        database = query.model_class._readDatabase()
+
+        return database.execute_sql(sql, params, query.require_commit)
+
+    def execute(self, **values):
+        """
+        Executes the query.
+
+        @param values: The value for each placeholder, by name.
+
+        @return: The peewee result wrapper, to iterate over the results.
+        """
+        query, _, _, _, wrapper = self.compile()
+
+        return wrapper(query.model_class, self._execute(values),
+                       query.get_query_meta())
+
+    def scalar(self, as_tuple=False, **values):
+        """
+        Executes the query, and returns the first column of the first row, or
+        the whole row if L{as_tuple}, without any conversions. Returns None if
+        there are no rows.
+        """
+        row = self._execute(values).fetchone()
+
+        return row if as_tuple or not row else row[0]
+
+    def get(self, **values):
+        """
+        Executes the query, and returns the first result.
+
+        @raises DoesNotExist: The model C{DoesNotExist} error if there are no
+                results.
+        """
+        for result in self.execute(**values):
+            return result
+        query = self.compile()[0]
+        raise query.model_class.DoesNotExist(
+                "Instance matching query does not exist:\nSQL: {0}\n"
+                "VALUES: {1}".format(query.sql()[0], values))
+
+def prepared(build):
+    """
+    Decorator turning a function returning a select query into a
+    L{PreparedQuery}.
+    """
+    return PreparedQuery(build)
+
+def path():
+    """
+    Returns the path of the database file from the C{[database]} config.
+    """
+    return conf['database']['name'].format(appDir=appDir)
+
 def setup(create=True):
     """
     Sets up the database connection and creates any new tables if required.
@@ -51,16 +634,42 @@ def setup(create=True):
            called to create any missing tables after connecting to the database.
     """
     # Get database connection params
-    dbBackend = conf['database']['backend']
-    dbName = conf['database']['name'].format(appDir=appDir)
+    dbConf = conf['database']
+    dbBackend = dbConf['backend']
+    dbName = path()
+    mode = dbConf.get('connectionMode', 'threadlocal')
+    split = dbConf.get('readWriteSplit', False)
+    reader = None
     # Set up database
-    if dbBackend == 'sqlite':
-        database = peewee.SqliteDatabase(dbName, check_same_thread=False)
-    else:
+    if dbBackend != 'sqlite':
         raise ValueError("Unsupported database backend: %s" % dbBackend)
+    if mode == 'threadlocal' and split:
+        # All writes go through one serialized writer connection, while each
+        # thread gets its own read-only connection. Python 2's sqlite3 can not
+        # open 'mode=ro' URIs, so these are made read-only with a pragma. They
+        # never open transactions, so every read sees the latest commit.
+        database = WriterDatabase(dbName, pragmas=pragmas(dbConf))
+        reader = SqliteDatabase(dbName, pragmas=readPragmas(dbConf),
+                                threadlocals=True, isolation_level=None)
+        cherrypy.engine.subscribe('start_thread', connectThread)
+        cherrypy.engine.subscribe('stop_thread', closeThread)
+    elif mode == 'threadlocal':
+        # Each thread gets its own connection
+        database = SqliteDatabase(dbName, pragmas=pragmas(dbConf),
+                                  threadlocals=True)
+        cherrypy.engine.subscribe('start_thread', connectThread)
+        cherrypy.engine.subscribe('stop_thread', closeThread)
+    elif mode == 'shared':
+        # All threads share one connection, so statements and transactions
+        # are serialized on its lock, and each thread keeps its own transaction
+        # state
+        database = WriterDatabase(dbName, pragmas=pragmas(dbConf))
+    else:
+        raise ValueError("Unsupported connection mode: %s" % mode)
     # Replace the proxy database created for model definitions with the real
     # database
     db_proxy.initialize(database)
+    read_proxy.initialize(reader)
 
     if create:
         # Create while making sure not to drop anything.
@@ -4,14 +4,25 @@ Key management library.
 """
 
 import re
+import hashlib
 import logging
-from lib import database as db
+from functools import partial
+from lib import conf, database as db, sshKey, metrics, changes
+from lib.cache import LRUCache
+from external.peewee import Param, fn, JOIN_LEFT_OUTER
 
 logger = logging.getLogger(__name__)
 
 #: Regex to split 'user@host.domain.tld' string into it's components
 uhdSplitter = re.compile('^([^@]+)@([^.]+)\.(.*)$')
 
+#: The read-through cache for public keys, keyed by normalized uhd. Configured
+#: from the C{[keyCache]} section in C{app.conf}.
+keyCache = LRUCache(maxSize=conf.get('keyCache', {}).get('size', 10000),
+                    ttl=conf.get('keyCache', {}).get('ttl', None),
+                    shared='keys')
+metrics.cacheCollector('key', keyCache)
+
 def splitUserHostDomain(uhd):
     """
     Splits a 'user@host.domian' string into it's 3 components and returns them
@@ -26,6 +37,832 @@ def splitUserHostDomain(uhd):
 
     return r.groups() if r else None
 
+def normalizeUhd(uhd):
+    """
+    Returns the normalized form of a 'user@host.domain' string as used for
+    cache keys.
+
+    @param uhd: the 'user@host.domain' string to normalize.
+
+    @return: The normalized 'user@host.domain' string, or None if L{uhd} is not
+        valid.
+    """
+    res = splitUserHostDomain(uhd)
+
+    return "{0}@{1}.{2}".format(*res) if res else None
+
+def _userSelect(parts, *fields):
+    """
+    Returns a select query for L{fields} of the user@host.domain, joining the
+    user to its host and domain.
+
+    @param parts: The ('user', 'host', 'domain.part') tuple for the user.
+    """
+    user, host, domain = parts
+    return db.User.select(*fields)\
+            .join(db.Host)\
+            .join(db.Domain)\
+            .where(db.User.name==user, db.Host.name==host,
+                   db.Domain.name==domain)
+
+#: The ('user', 'host', 'domain') placeholders for prepared uhd lookups
+_uhdPlaceholders = tuple(db.Placeholder(n) for n in ('user', 'host', 'domain'))
+
+def _uhdValues(parts):
+    """
+    Returns the placeholder values for a uhd lookup prepared with
+    L{_uhdPlaceholders}.
+
+    @param parts: The ('user', 'host', 'domain.part') tuple for the user.
+    """
+    user, host, domain = parts
+    return {'user': user, 'host': host, 'domain': domain}
+
+@db.prepared
+def _keyQuery():
+    """
+    The key lookup for L{getKey}.
+    """
+    return _userSelect(_uhdPlaceholders, db.User.id, db.User.revision,
+                       db.User.keyType, db.User.keyBlob, db.User.keyComment)
+
+@db.prepared
+def _revisionQuery():
+    """
+    The key revision lookup for L{keyRevision}.
+    """
+    return _userSelect(_uhdPlaceholders, db.User.id, db.User.revision)
+
+@db.prepared
+def _authRevisionQuery():
+    """
+    The C{authorized_keys} revision lookup for L{authorizedKeysRevision}.
+    """
+    return _userSelect(_uhdPlaceholders, db.User.id, db.User.authRevision)
+
+@db.prepared
+def _userIdQuery():
+    """
+    The user id lookup for L{_granteeId}.
+    """
+    return _userSelect(_uhdPlaceholders, db.User.id)
+
+def getKey(uhd):
+    """
+    Returns the public key and its revision for a 'user@host.domain'.
+
+    The key is served from L{keyCache} if available, or else looked up with a
+    single User/Host/Domain join and then cached.
+
+    @param uhd: The 'user@host.domain.tld' identifier for the user.
+
+    @return: A (userId, revision, pubKey) tuple, or None if the user does not
+        exist.
+
+    @raises ValueError: If L{uhd} is not a valid identifier.
+    """
+    res = splitUserHostDomain(uhd)
+    if res is None:
+        raise ValueError("Invalid uhd identifier: {0}".format(uhd))
+
+    cacheKey = "{0}@{1}.{2}".format(*res)
+    entry = keyCache.get(cacheKey)
+    if entry is not None:
+        return entry
+
+    # Taken before the read, so a key changed while reading is not cached
+    version = keyCache.version()
+    entry = _keyQuery.scalar(as_tuple=True, **_uhdValues(res))
+    # Only existing users are cached. Unknown users will always go to the DB.
+    if entry is not None:
+        userId, revision, keyType, blob, comment = entry
+        entry = (userId, revision, sshKey.pubKeyText(keyType, blob, comment))
+        keyCache.set(cacheKey, entry, version)
+
+    return entry
+
+def keyRevision(uhd):
+    """
+    Returns the revision of the public key for a 'user@host.domain'.
+
+    The revision is taken from L{keyCache} if the key is cached. If not, only
+    the revision is looked up, without loading the key.
+
+    @param uhd: The 'user@host.domain.tld' identifier for the user.
+
+    @return: A (userId, revision) tuple, or None if the user does not exist.
+
+    @raises ValueError: If L{uhd} is not a valid identifier.
+    """
+    res = splitUserHostDomain(uhd)
+    if res is None:
+        raise ValueError("Invalid uhd identifier: {0}".format(uhd))
+
+    entry = keyCache.get("{0}@{1}.{2}".format(*res))
+    if entry is not None:
+        return entry[:2]
+
+    entry = _revisionQuery.scalar(as_tuple=True, **_uhdValues(res))
+
+    return tuple(entry) if entry else None
+
+def authorizedKeysRevision(uhd):
+    """
+    Returns the revision of the C{authorized_keys} file for a
+    'user@host.domain', without rendering the file.
+
+    @param uhd: The 'user@host.domain.tld' identifier for the file owner.
+
+    @return: An (ownerId, authRevision) tuple, or None if the owner does not
+        exist.
+
+    @raises ValueError: If L{uhd} is not a valid identifier.
+    """
+    res = splitUserHostDomain(uhd)
+    if res is None:
+        raise ValueError("Invalid uhd identifier: {0}".format(uhd))
+
+    entry = _authRevisionQuery.scalar(as_tuple=True, **_uhdValues(res))
+
+    return tuple(entry) if entry else None
+
+def _authorizedKeysChanged(owners, refresh=True):
+    """
+    Bumps the C{authorized_keys} revision for the owners selected by L{owners},
+    in one statement, records the change for these owners in the change log,
+    and refreshes their stored files.
+
+    This must be called in the same transaction as the change to the files.
+
+    @param owners: An expression on L{db.User} selecting the owners.
+    @param refresh: If False, the caller refreshes the stored files itself.
+    """
+    db.User.update(authRevision=db.User.authRevision + 1)\
+            .where(owners)\
+            .execute()
+    changes.record(changes.AUTHORIZED_KEYS, owners)
+    if refresh:
+        _refreshAuthorizedKeysFiles(owners)
+
+def _bumpAuthRevisions(userIds):
+    """
+    Bumps the C{authorized_keys} revision for every owner that has any of the
+    L{userIds} as authorized user, records the change for these owners in the
+    change log, and refreshes their stored files.
+
+    This must be called in the same transaction as the change to the users'
+    keys.
+    """
+    _authorizedKeysChanged(db.User.id << db.AuthorizedKeys\
+            .select(db.AuthorizedKeys.owner)\
+            .where(db.AuthorizedKeys.authedUser << userIds))
+
+@db.prepared
+def _hostIdQuery():
+    """
+    The host id lookup for L{_hostId}.
+    """
+    return db.Host.select(db.Host.id)\
+            .join(db.Domain)\
+            .where(db.Host.name==db.Placeholder('host'),
+                   db.Domain.name==db.Placeholder('domain'))
+
+def _hostId(host, domain):
+    """
+    Returns the id for the host.domain, or None if it does not exist.
+    """
+    return _hostIdQuery.scalar(host=host, domain=domain)
+
+@db.prepared
+def _hostUserQuery():
+    """
+    The user lookup by host id and name for L{addUserAndKey}.
+    """
+    return db.User.select()\
+            .where(db.User.host==db.Placeholder('host'),
+                   db.User.name==db.Placeholder('name'))\
+            .limit(1)
+
+def _entriesQuery():
+    """
+    Returns the select query for the L{db.AuthorizedKeys} entries to render,
+    as (owner, options, user, host, domain, keyType, keyBlob, keyComment)
+    tuples, joining the entries to the authorized users, their hosts and their
+    domains.
+    """
+    return db.AuthorizedKeys.select(db.AuthorizedKeys.owner,
+                                    db.AuthorizedKeys.options,
+                                    db.User.name, db.Host.name,
+                                    db.Domain.name, db.User.keyType,
+                                    db.User.keyBlob, db.User.keyComment)\
+            .join(db.User, on=db.AuthorizedKeys.authedUser)\
+            .join(db.Host)\
+            .join(db.Domain)\
+            .order_by(db.AuthorizedKeys.owner, db.AuthorizedKeys.id)\
+            .tuples()
+
+def _renderEntries(entries):
+    """
+    Renders C{authorized_keys} file entries.
+
+    Each authorized user is rendered as a comment line with the authorized
+    user@host.domain, followed by the public key, prefixed with the SSH
+    options for the entry if any.
+
+    @param entries: (options, user, host, domain, keyType, keyBlob,
+           keyComment) tuples.
+
+    @return: The file contents.
+    """
+    lines = []
+    for options, u, h, d, keyType, blob, comment in entries:
+        pubKey = sshKey.pubKeyText(keyType, blob, comment)
+        lines.append("# {0}@{1}.{2}".format(u, h, d))
+        lines.append("{0} {1}".format(options, pubKey) if options else pubKey)
+
+    return "".join(line + "\n" for line in lines)
+
+def renderAuthorizedKeys(uhd, owner=None):
+    """
+    Renders the C{authorized_keys} file for a 'user@host.domain' from its
+    entries. See L{getAuthorizedKeys} for the stored file.
+
+    The file is rendered from one select joining the entries to the authorized
+    users, their hosts and their domains, so the number of queries does not
+    depend on the number of entries in the file.
+
+    @param uhd: The 'user@host.domain.tld' identifier for the file owner.
+    @param owner: The (ownerId, authRevision) tuple for the owner, if already
+           looked up with L{authorizedKeysRevision}.
+
+    @return: An (ownerId, authRevision, content) tuple with the
+        C{authorized_keys} file contents, or None if the owner does not exist.
+
+    @raises ValueError: If L{uhd} is not a valid identifier.
+    """
+    # The revision is read before the entries, so that the content is never
+    # older than the revision returned with it.
+    if owner is None:
+        owner = authorizedKeysRevision(uhd)
+    if owner is None:
+        return None
+    ownerId, authRevision = owner
+
+    entries = _entriesQuery().where(db.AuthorizedKeys.owner==ownerId)
+
+    return ownerId, authRevision, _renderEntries(e[1:] for e in entries)
+
+@db.prepared
+def _storedFileQuery():
+    """
+    The stored file lookup for L{getAuthorizedKeys}.
+    """
+    return db.AuthorizedKeysFile.select(db.AuthorizedKeysFile.owner,
+                                        db.AuthorizedKeysFile.authRevision,
+                                        db.AuthorizedKeysFile.content)\
+            .where(db.AuthorizedKeysFile.uhd==db.Placeholder('uhd'))
+
+def getAuthorizedKeys(uhd, owner=None):
+    """
+    Returns the C{authorized_keys} file for a 'user@host.domain'.
+
+    The file is fetched from L{db.AuthorizedKeysFile} with a single indexed
+    select. Owners without a stored file, because they have no entries, or
+    their entries were changed outside of this module, get the file rendered
+    by L{renderAuthorizedKeys}.
+
+    @param uhd: The 'user@host.domain.tld' identifier for the file owner.
+    @param owner: The (ownerId, authRevision) tuple for the owner, if already
+           looked up with L{authorizedKeysRevision}, so that rendering the file
+           does not look it up again.
+
+    @return: An (ownerId, authRevision, content) tuple with the
+        C{authorized_keys} file contents, or None if the owner does not exist.
+
+    @raises ValueError: If L{uhd} is not a valid identifier.
+    """
+    normalized = normalizeUhd(uhd)
+    if normalized is None:
+        raise ValueError("Invalid uhd identifier: {0}".format(uhd))
+
+    stored = _storedFileQuery.scalar(as_tuple=True, uhd=normalized)
+    if stored is not None:
+        return tuple(stored)
+
+    return renderAuthorizedKeys(normalized, owner)
+
+def _renderFiles(owners):
+    """
+    Renders the C{authorized_keys} files for the owners selected by L{owners}
+    that have any entries, in two queries however many owners there are.
+
+    @param owners: An expression on L{db.User} selecting the owners.
+
+    @return: A dictionary mapping owner id to (uhd, authRevision, content).
+    """
+    ownerIds = db.User.select(db.User.id).where(owners)
+    rows = db.User.select(db.User.id, db.User.authRevision, db.User.name,
+                          db.Host.name, db.Domain.name)\
+            .join(db.Host)\
+            .join(db.Domain)\
+            .where(owners)\
+            .where(db.User.id << db.AuthorizedKeys.select(
+                db.AuthorizedKeys.owner))\
+            .tuples()
+    heads = dict((ownerId, ("{0}@{1}.{2}".format(u, h, d), authRevision))
+                 for ownerId, authRevision, u, h, d in rows)
+
+    entries = {}
+    for entry in _entriesQuery().where(db.AuthorizedKeys.owner << ownerIds):
+        entries.setdefault(entry[0], []).append(entry[1:])
+
+    files = {}
+    for ownerId, ownerEntries in entries.items():
+        # Entries added after the owners were read are left for next time
+        if ownerId in heads:
+            uhd, authRevision = heads[ownerId]
+            files[ownerId] = (uhd, authRevision,
+                              _renderEntries(ownerEntries))
+
+    return files
+
+def _sha256(content):
+    """
+    Returns the SHA256 hex digest of the UTF-8 encoded file L{content}.
+    """
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+def _refreshAuthorizedKeysFiles(owners):
+    """
+    Renders the C{authorized_keys} files for the owners selected by L{owners}
+    again, and replaces their L{db.AuthorizedKeysFile} rows.
+
+    This must be called in the same transaction as the change to the files.
+
+    @param owners: An expression on L{db.User} selecting the owners.
+
+    @return: The number of files stored. Owners without entries get none.
+    """
+    db.AuthorizedKeysFile.delete()\
+            .where(db.AuthorizedKeysFile.owner <<
+                   db.User.select(db.User.id).where(owners))\
+            .execute()
+    rows = [{'owner': ownerId, 'uhd': uhd, 'authRevision': authRevision,
+             'sha256': _sha256(content),
+             'content': content}
+            for ownerId, (uhd, authRevision, content)
+            in _renderFiles(owners).items()]
+    # Stay below the SQLite limit on variables per statement
+    batch = 900 // len(db.AuthorizedKeysFile._meta.fields)
+    for n in xrange(0, len(rows), batch):
+        db.AuthorizedKeysFile.insert_many(rows[n:n+batch]).execute()
+
+    return len(rows)
+
+def refreshAuthorizedKeys(ownerIds):
+    """
+    Refreshes the stored C{authorized_keys} files for the L{ownerIds}, for use
+    after changing their L{db.AuthorizedKeys} entries directly.
+
+    @param ownerIds: A list of owner user ids.
+    """
+    with db.transaction():
+        _refreshAuthorizedKeysFiles(db.User.id << list(ownerIds))
+
+def rebuildAuthorizedKeysFiles(batchSize=1000):
+    """
+    Deletes all stored C{authorized_keys} files, and renders them again for
+    all owners with entries, in batches of L{batchSize} owners per
+    transaction. Files are rendered from the entries until their batch is
+    stored.
+
+    @return: The number of files stored.
+    """
+    db.AuthorizedKeysFile.delete().execute()
+    lastId, stored = 0, 0
+    while True:
+        with db.transaction():
+            ownerIds = [o for o, in db.AuthorizedKeys\
+                    .select(db.AuthorizedKeys.owner)\
+                    .where(db.AuthorizedKeys.owner > lastId)\
+                    .group_by(db.AuthorizedKeys.owner)\
+                    .order_by(db.AuthorizedKeys.owner)\
+                    .limit(batchSize)\
+                    .tuples()]
+            if not ownerIds:
+                break
+            stored += _refreshAuthorizedKeysFiles(db.User.id << ownerIds)
+            lastId = ownerIds[-1]
+        logger.info("Rebuilt authorized_keys files up to owner id %s", lastId)
+
+    return stored
+
+def checkAuthorizedKeysFiles(batchSize=1000, fix=False):
+    """
+    Checks every stored C{authorized_keys} file against the file rendered
+    from its entries, in batches of L{batchSize} owners.
+
+    @param fix: If True, the files with problems are refreshed.
+
+    @return: A list of (uhd, problem) tuples, where problem is one of:
+        - C{missing}: The owner has entries, but no stored file. The file is
+          rendered from the entries when served, so this is only slower.
+        - C{stale}: The stored file differs from the entries, or was stored
+          for another revision.
+        - C{orphaned}: A file is stored for an owner without entries.
+    """
+    problems = []
+    lastId = 0
+    while True:
+        with db.transaction():
+            batch = db.User.select(db.User.id)\
+                    .where(db.User.id > lastId)\
+                    .order_by(db.User.id)\
+                    .limit(batchSize)\
+                    .tuples()
+            ownerIds = [u for u, in batch]
+            if not ownerIds:
+                break
+            lastId = ownerIds[-1]
+            inBatch = db.User.id << ownerIds
+            files = _renderFiles(inBatch)
+            stored = dict((row[0], row[1:]) for row in db.AuthorizedKeysFile\
+                    .select(db.AuthorizedKeysFile.owner,
+                            db.AuthorizedKeysFile.uhd,
+                            db.AuthorizedKeysFile.authRevision,
+                            db.AuthorizedKeysFile.content,
+                            db.AuthorizedKeysFile.sha256)\
+                    .where(db.AuthorizedKeysFile.owner << ownerIds)\
+                    .tuples())
+            bad = []
+            for ownerId in sorted(set(files) | set(stored)):
+                if ownerId not in stored:
+                    problems.append((files[ownerId][0], 'missing'))
+                elif ownerId not in files:
+                    problems.append((stored[ownerId][0], 'orphaned'))
+                else:
+                    uhd, authRevision, content = files[ownerId]
+                    if stored[ownerId] != (uhd, authRevision, content,
+                                           _sha256(content)):
+                        problems.append((uhd, 'stale'))
+                    else:
+                        continue
+                bad.append(ownerId)
+            if fix and bad:
+                _refreshAuthorizedKeysFiles(db.User.id << bad)
+
+    return problems
+
+def _keyFields(pubKey):
+    """
+    Parses a public key and returns the L{db.User} column values for it.
+
+    @param pubKey: The OpenSSH public key text.
+
+    @return: A dictionary with the C{keyBlob}, C{keyType}, C{keyComment} and
+        C{fingerprint} column values.
+
+    @raises ValueError: If L{pubKey} is not a valid public key.
+    """
+    keyType, blob, comment = sshKey.parse(pubKey)
+
+    return {'keyBlob': blob,
+            'keyType': sshKey.keyTypeCode(keyType),
+            'keyComment': comment,
+            'fingerprint': sshKey.fingerprint(blob)}
+
+def findByFingerprint(fp):
+    """
+    Finds all users holding the public key with the given SHA256 fingerprint.
+
+    @param fp: The fingerprint as shown by C{ssh-keygen -l}, with or without
+           the 'SHA256:' prefix.
+
+    @return: A list of 'user@host.domain' strings for the users holding the
+        key.
+    """
+    fp = fp.strip()
+    if not fp.startswith('SHA256:'):
+        fp = 'SHA256:' + fp
+    # Fingerprints are shown without base64 padding
+    fp = fp.rstrip('=')
+
+    users = db.User.select(db.User.name, db.Host.name, db.Domain.name)\
+            .join(db.Host)\
+            .join(db.Domain)\
+            .where(db.User.fingerprint==fp)\
+            .order_by(db.User.id)\
+            .tuples()
+
+    return ["{0}@{1}.{2}".format(*u) for u in users]
+
+def parseCursor(cursor):
+    """
+    Parses a listing cursor as returned by L{listKeys}.
+
+    @param cursor: The 'domainId.hostId.userId' cursor string.
+
+    @return: The (domainId, hostId, userId) tuple.
+
+    @raises ValueError: If L{cursor} is not a valid cursor.
+    """
+    try:
+        ids = tuple(int(i) for i in cursor.split('.'))
+    except (AttributeError, ValueError):
+        ids = ()
+    if len(ids) != 3:
+        raise ValueError("Invalid cursor: {0}".format(cursor))
+
+    return ids
+
+def listKeys(domain=None, host=None, after=None, limit=None, batchSize=None):
+    """
+    Generator returning all users and their public keys in (domain, host,
+    user) id order.
+
+    Keyset pagination is used instead of C{OFFSET}: each batch of users is
+    selected with a C{WHERE} on the ids of the last row returned, so every
+    batch is an index walk from that row. Rows are read as tuples with
+    C{iterator()}, so no model instances are created or cached, and memory use
+    stays flat however many keys are listed.
+
+    @param domain: Only list users in this domain.
+    @param host: Only list users on hosts with this name.
+    @param after: A (domainId, hostId, userId) tuple. Only users after this
+           position are listed. See L{parseCursor}.
+    @param limit: The maximum number of users to list, or None for all.
+    @param batchSize: The number of users to select per query. Defaults to the
+           C{[listing]} batchSize config.
+
+    @return: Yields ((domainId, hostId, userId), uhd, pubKey) tuples. The ids
+        tuple is the cursor to continue listing after this user.
+    """
+    batchSize = batchSize or conf.get('listing', {}).get('batchSize', 1000)
+    remaining = limit
+
+    while remaining is None or remaining > 0:
+        size = batchSize if remaining is None else min(batchSize, remaining)
+        query = db.User.select(db.Domain.id, db.Host.id, db.User.id,
+                               db.User.name, db.Host.name, db.Domain.name,
+                               db.User.keyType, db.User.keyBlob,
+                               db.User.keyComment)\
+                .join(db.Host)\
+                .join(db.Domain)
+        if domain is not None:
+            query = query.where(db.Domain.name==domain)
+        if host is not None:
+            query = query.where(db.Host.name==host)
+        if after is not None:
+            d, h, u = after
+            query = query.where((db.Domain.id > d) |
+                                ((db.Domain.id == d) &
+                                 ((db.Host.id > h) |
+                                  ((db.Host.id == h) & (db.User.id > u)))))
+        query = query.order_by(db.Domain.id, db.Host.id, db.User.id)\
+                .limit(size)\
+                .tuples()
+
+        count = 0
+        for dId, hId, uId, u, h, d, keyType, blob, comment in query.iterator():
+            count += 1
+            after = (dId, hId, uId)
+            yield after, "{0}@{1}.{2}".format(u, h, d), \
+                  sshKey.pubKeyText(keyType, blob, comment)
+
+        if remaining is not None:
+            remaining -= count
+        if count < size:
+            break
+
+def listDomains():
+    """
+    Lists all domains with their host, user and C{authorized_keys} entry
+    counts, in one aggregate query.
+
+    @return: A list of C{{'name', 'hosts', 'users', 'authorizedKeys'}}
+        dictionaries in domain name order, where C{authorizedKeys} is the
+        number of entries in the C{authorized_keys} files of all users in the
+        domain.
+    """
+    rows = db.Domain.select(db.Domain.name,
+                            fn.COUNT(fn.DISTINCT(db.Host.id)),
+                            fn.COUNT(fn.DISTINCT(db.User.id)),
+                            fn.COUNT(db.AuthorizedKeys.id))\
+            .join(db.Host, JOIN_LEFT_OUTER)\
+            .join(db.User, JOIN_LEFT_OUTER)\
+            .join(db.AuthorizedKeys, JOIN_LEFT_OUTER,
+                  on=(db.AuthorizedKeys.owner==db.User.id))\
+            .group_by(db.Domain.name)\
+            .order_by(db.Domain.name)\
+            .tuples()
+
+    return [{'name': name, 'hosts': hosts, 'users': users,
+             'authorizedKeys': entries}
+            for name, hosts, users, entries in rows]
+
+def listHosts(domain):
+    """
+    Lists the hosts in a domain with their user and C{authorized_keys} entry
+    counts, in one aggregate query.
+
+    @param domain: The domain name.
+
+    @return: A list of C{{'name', 'users', 'authorizedKeys'}} dictionaries in
+        host name order, or None if the domain does not exist.
+    """
+    # Grouped from the domain, so that a domain without hosts gives one row
+    rows = db.Domain.select(db.Host.name,
+                            fn.COUNT(fn.DISTINCT(db.User.id)),
+                            fn.COUNT(db.AuthorizedKeys.id))\
+            .join(db.Host, JOIN_LEFT_OUTER)\
+            .join(db.User, JOIN_LEFT_OUTER)\
+            .join(db.AuthorizedKeys, JOIN_LEFT_OUTER,
+                  on=(db.AuthorizedKeys.owner==db.User.id))\
+            .where(db.Domain.name==domain)\
+            .group_by(db.Host.name)\
+            .order_by(db.Host.name)\
+            .tuples()
+    rows = list(rows)
+    if not rows:
+        return None
+
+    return [{'name': name, 'users': users, 'authorizedKeys': entries}
+            for name, users, entries in rows if name is not None]
+
+def listUsers(domain, host, keys=False):
+    """
+    Lists the users on a host.domain with their C{authorized_keys} counts, in
+    one aggregate query.
+
+    @param domain: The domain name.
+    @param host: The host name.
+    @param keys: If True, the public keys are included.
+
+    @return: A list of C{{'name', 'uhd', 'authorizedKeys', 'authorizedOn'}}
+        dictionaries in user name order, or None if the host.domain does not
+        exist. C{authorizedKeys} is the number of entries in the user's
+        C{authorized_keys} file, and C{authorizedOn} the number of files the
+        user's key is in. With L{keys}, each one also has the C{key}.
+    """
+    authed = db.AuthorizedKeys.alias()
+    fields = [db.User.name, fn.COUNT(db.AuthorizedKeys.id),
+              authed.select(fn.COUNT(authed.id))\
+                    .where(authed.authedUser==db.User.id)]
+    if keys:
+        fields += [db.User.keyType, db.User.keyBlob, db.User.keyComment]
+    # Grouped from the host, so that a host without users gives one row
+    rows = db.Host.select(*fields)\
+            .join(db.Domain)\
+            .switch(db.Host)\
+            .join(db.User, JOIN_LEFT_OUTER)\
+            .join(db.AuthorizedKeys, JOIN_LEFT_OUTER,
+                  on=(db.AuthorizedKeys.owner==db.User.id))\
+            .where(db.Domain.name==domain, db.Host.name==host)\
+            .group_by(db.User.name)\
+            .order_by(db.User.name)\
+            .tuples()
+    rows = list(rows)
+    if not rows:
+        return None
+
+    users = []
+    for row in rows:
+        name, entries, authedOn = row[:3]
+        if name is None:
+            continue
+        user = {'name': name, 'uhd': "{0}@{1}.{2}".format(name, host, domain),
+                'authorizedKeys': entries, 'authorizedOn': authedOn}
+        if keys:
+            user['key'] = sshKey.pubKeyText(*row[3:])
+        users.append(user)
+
+    return users
+
+#: The scopes authorizations can be granted and revoked on
+GRANT_SCOPES = ('user', 'host', 'domain')
+
+def _grantTargets(scope, name):
+    """
+    Returns a select query for the ids of the users a grant or revoke targets:
+    the user@host.domain, all users on the host.domain, or all users in the
+    domain given by L{name}, depending on the L{scope}.
+
+    @raises ValueError: If the scope or name is invalid.
+    """
+    if scope not in GRANT_SCOPES:
+        raise ValueError("Invalid scope: {0}".format(scope))
+    if not name:
+        raise ValueError("A name is required for the {0} scope".format(scope))
+    if scope == 'user':
+        parts = splitUserHostDomain(name)
+        if parts is None:
+            raise ValueError("Invalid uhd identifier: {0}".format(name))
+        return _userSelect(parts, db.User.id)
+
+    targets = db.User.select(db.User.id).join(db.Host).join(db.Domain)
+    if scope == 'domain':
+        return targets.where(db.Domain.name==name)
+    host, _, domain = name.partition('.')
+    if not domain:
+        raise ValueError("Invalid host.domain: {0}".format(name))
+
+    return targets.where(db.Host.name==host, db.Domain.name==domain)
+
+def _granteeId(uhd):
+    """
+    Returns the user id for the grantee 'user@host.domain', or None if the
+    user does not exist.
+
+    @raises ValueError: If L{uhd} is not a valid identifier.
+    """
+    parts = splitUserHostDomain(uhd or '')
+    if parts is None:
+        raise ValueError("Invalid uhd identifier: {0}".format(uhd))
+
+    return _userIdQuery.scalar(**_uhdValues(parts))
+
+def grantAuthorization(grantee, scope, name, options=None):
+    """
+    Authorizes the key of the L{grantee} user in the C{authorized_keys} files of
+    all users targeted by L{scope} and L{name}, in one C{INSERT ... SELECT}
+    statement.
+
+    Targets that have the grantee authorized already are left as they are,
+    including their options, so repeating a grant changes nothing. Only the
+    owners of new entries get a new C{authorized_keys} revision and change log
+    entry.
+
+    @param grantee: The 'user@host.domain' to authorize.
+    @param scope: C{user}, C{host} or C{domain}. See L{GRANT_SCOPES}.
+    @param name: The user@host.domain, host.domain or domain for the scope.
+    @param options: Optional SSH options for the new entries.
+
+    @return: The number of new entries, or None if the grantee does not exist.
+
+    @raises ValueError: If any of the arguments are invalid.
+    """
+    targets = _grantTargets(scope, name)
+    if options is not None and ('\n' in options or '\r' in options):
+        raise ValueError("Options can not span lines.")
+
+    with db.transaction():
+        granteeId = _granteeId(grantee)
+        if granteeId is None:
+            return None
+        # New entries get ids above the current ones
+        lastId = db.AuthorizedKeys.select(fn.Max(db.AuthorizedKeys.id))\
+                .scalar() or 0
+        cursor = db.insertFromSelect(
+                db.AuthorizedKeys,
+                (db.AuthorizedKeys.owner, db.AuthorizedKeys.authedUser,
+                 db.AuthorizedKeys.options),
+                targets.select(db.User.id, Param(granteeId), Param(options)),
+                ignore=True)
+        granted = db.rowsAffected(cursor)
+        if granted:
+            _authorizedKeysChanged(db.User.id << db.AuthorizedKeys\
+                    .select(db.AuthorizedKeys.owner)\
+                    .where(db.AuthorizedKeys.id > lastId))
+
+    return granted
+
+def revokeAuthorization(grantee, scope, name):
+    """
+    Removes the key of the L{grantee} user from the C{authorized_keys} files of
+    all users targeted by L{scope} and L{name}, in one C{DELETE} statement.
+
+    See L{grantAuthorization} for the arguments.
+
+    @return: The number of removed entries, or None if the grantee does not
+        exist.
+
+    @raises ValueError: If any of the arguments are invalid.
+    """
+    targets = _grantTargets(scope, name)
+
+    with db.transaction():
+        granteeId = _granteeId(grantee)
+        if granteeId is None:
+            return None
+        entries = (db.AuthorizedKeys.authedUser==granteeId) & \
+                  (db.AuthorizedKeys.owner << targets)
+        # The owners are selected by their entries, so they are updated
+        # before the entries are deleted
+        _authorizedKeysChanged(db.User.id << db.AuthorizedKeys\
+                    .select(db.AuthorizedKeys.owner).where(entries),
+                refresh=False)
+        revoked = db.AuthorizedKeys.delete().where(entries).execute()
+        if revoked:
+            # Deleting the entries deleted their owners' stored files, so the
+            # targets with entries left and no stored file are refreshed
+            _refreshAuthorizedKeysFiles(
+                    (db.User.id << targets) &
+                    (db.User.id << db.AuthorizedKeys\
+                        .select(db.AuthorizedKeys.owner)) &
+                    ~(db.User.id << db.AuthorizedKeysFile\
+                        .select(db.AuthorizedKeysFile.owner)))
+
+    return revoked
 
 def addUserAndKey(uhd, pubKey, allowUpdate=False):
     """
@@ -43,6 +880,11 @@ def addUserAndKey(uhd, pubKey, allowUpdate=False):
     ValueError will be raised indicate that the user exists but no updates are
     allowed.
 
+    All statements are run in a single transaction, using C{INSERT OR IGNORE}
+    against the unique indexes for domains, hosts and users instead of failed
+    inserts followed by selects. Adding a user to an existing host.domain takes
+    three statements, including the change log entry.
+
     @param uhd: The 'user@host.domain.tld' identifier for this user
     @param pubKey: This user's public key
     @param allowUpdate: Allows/disallows updating the key for an existing user.
@@ -52,10 +894,9 @@ def addUserAndKey(uhd, pubKey, allowUpdate=False):
     @raises: Possibly various errors depending on reason for error.
     """
     # Validate pubKey
-    # TODO: Need to find a better way to validate the key. Possibly using
-    #       formencode validation? For now we only test for None
     if pubKey is None:
         raise ValueError("No public key supplied.")
+    keyFields = _keyFields(pubKey)
 
     # First split the uhd string
     res = splitUserHostDomain(uhd)
@@ -65,41 +906,270 @@ def addUserAndKey(uhd, pubKey, allowUpdate=False):
     # Break the parts out
     u, h, d = res
 
-    # Try to create the domain
-    try:
-        dom = db.Domain.create(name=d)
-    except db.IntegrityError:
-        # It exists
-        dom = db.Domain.select().where(db.Domain.name==d).get()
-    
-    # Now the host
-    try:
-        host = dom.addHost(h)
-    except db.IntegrityError:
-        # It exists
-        host = db.Host.select()\
-                .where(db.Host.domain==dom)\
-                .where(db.Host.name==h)\
-                .get()
-    
-    # Now the user
-    try:
-        user = host.addUser(u, pubKey)
-    except db.IntegrityError as exc:
-        # It exists. Unless updates are allowed, we need to bail here
-        if not allowUpdate:
-            logger.info("Error adding user/pubKey [{0}/{1}] for uhd: [{2}]. "
-                        "Error: {3}".format(u, pubKey, uhd, str(exc)))
-            raise ValueError("Key updates to existing user [{0}] not "
-                             "allowed.".format(uhd))
-        # We may update the key, so get the user
-        user = db.User.select()\
-                .where(db.User.host==host)\
-                .where(db.User.name==u)\
-                .get()
-        # Update the key
-        user.pubKey = pubKey
-        user.save()
-    
+    with db.transaction():
+        # In the common case the host.domain exists already, and this is all
+        # we need before adding the user
+        hostId = _hostId(h, d)
+        if hostId is None:
+            # Add the domain if it does not exist, and then the host in it
+            db.insertOrIgnore(db.Domain.insert(name=d))
+            cursor = db.insertFromSelect(
+                    db.Host,
+                    (db.Host.domain, db.Host.name),
+                    db.Domain.select(db.Domain.id, Param(h))\
+                            .where(db.Domain.name==d),
+                    ignore=True)
+            if db.rowsAffected(cursor) == 1:
+                hostId = cursor.lastrowid
+            else:
+                # Another connection added it since we looked
+                hostId = _hostId(h, d)
+
+        # Now the user
+        cursor = db.insertOrIgnore(
+                db.User.insert(host=hostId, name=u, **keyFields))
+        if db.rowsAffected(cursor) == 1:
+            # We know all the values, so there is no need to read it back
+            user = db.User(id=cursor.lastrowid, host=hostId, name=u,
+                           comment=None, revision=1, authRevision=1,
+                           **keyFields)
+            changes.record(changes.KEY, db.User.id == user.id)
+        else:
+            # It exists. Unless updates are allowed, we need to bail here
+            if not allowUpdate:
+                logger.info("Error adding user/pubKey [{0}/{1}] for uhd: "
+                            "[{2}]. User exists.".format(u, pubKey, uhd))
+                raise ValueError("Key updates to existing user [{0}] not "
+                                 "allowed.".format(uhd))
+            # We may update the key, so get the user
+            user = _hostUserQuery.get(host=hostId, name=u)
+            # Update the key, and bump the revisions for the key and for all
+            # authorized_keys files it is in
+            for field, value in keyFields.items():
+                setattr(user, field, value)
+            user.revision += 1
+            user.save()
+            changes.record(changes.KEY, db.User.id == user.id)
+            _bumpAuthRevisions([user.id])
+
+        # Any cached key for this user is stale once this commits. This may be
+        # nested in a larger transaction, as for the write queue, so that is
+        # not necessarily when this block ends.
+        db.afterCommit(partial(keyCache.invalidate,
+                               "{0}@{1}.{2}".format(u, h, d)))
+
     return user
 
+
+#: The conflict policies for L{bulkAddUsersAndKeys}
+BULK_POLICIES = ('skip', 'update', 'fail')
+
+def bulkAddUsersAndKeys(records, policy='skip', dryRun=False, chunkSize=None):
+    """
+    Adds users and public keys in bulk.
+
+    The records are consumed from L{records} one chunk at a time, and each
+    chunk is added in a single transaction: all missing domains and hosts for
+    the chunk are added and resolved once, and all new users for the chunk are
+    added with C{insert_many}. L{records} may be a generator so that the full
+    import never has to be held in memory.
+
+    The L{policy} determines what happens when a user exists already:
+        - C{skip}: The record is skipped and the existing key is kept.
+        - C{update}: The existing key is replaced by the key in the record.
+        - C{fail}: The import stops at this record. The full chunk containing
+          this record is rolled back, but earlier chunks stay committed.
+
+    @param records: An iterable of C{{'uhd': 'user@host.domain', 'key': key}}
+           dictionaries.
+    @param policy: The conflict policy, one of L{BULK_POLICIES}.
+    @param dryRun: If True, each chunk is rolled back instead of committed, so
+           the results show what would happen without changing anything.
+    @param chunkSize: The number of records per chunk. Defaults to the
+           C{[bulk] chunkSize} setting in C{app.conf}.
+
+    @return: A dictionary with the C{policy}, C{dryRun} flag, a C{summary}
+             dictionary with the count of records per status, an C{aborted}
+             flag that is set when the C{fail} policy stopped the import, and
+             a C{results} list with a C{{'index', 'uhd', 'status'}} dictionary,
+             plus C{error} where applicable, for each record processed. The
+             status is one of C{added}, C{updated}, C{skipped}, C{failed} or
+             C{rolledBack}.
+
+    @raises ValueError: If L{policy} is not valid.
+    """
+    if policy not in BULK_POLICIES:
+        raise ValueError("Invalid conflict policy: {0}".format(policy))
+    if chunkSize is None:
+        chunkSize = conf.get('bulk', {}).get('chunkSize', 250)
+
+    results = []
+    aborted = False
+    chunk = []
+    records = iter(records)
+    while not aborted:
+        # Collect the next chunk
+        try:
+            for rec in records:
+                chunk.append((len(results) + len(chunk), rec))
+                if len(chunk) >= chunkSize:
+                    break
+        except ValueError as exc:
+            # The record source could not produce the next record, so we stop
+            # after what we have so far
+            aborted = True
+            error = {'index': len(results) + len(chunk), 'uhd': None,
+                     'status': 'failed', 'error': str(exc)}
+        else:
+            error = None
+
+        if not chunk and error is None:
+            break
+        if chunk:
+            aborted = _bulkAddChunk(chunk, policy, dryRun, results) or aborted
+            chunk = []
+        if error is not None:
+            results.append(error)
+
+    summary = dict((s, 0) for s in ('added', 'updated', 'skipped', 'failed',
+                                    'rolledBack'))
+    for res in results:
+        summary[res['status']] += 1
+
+    return {'policy': policy, 'dryRun': dryRun, 'aborted': aborted,
+            'summary': summary, 'results': results}
+
+def _bulkAddChunk(chunk, policy, dryRun, results):
+    """
+    Adds one chunk of records for L{bulkAddUsersAndKeys} in a single
+    transaction.
+
+    @param chunk: A list of (index, record) tuples.
+    @param policy: The conflict policy.
+    @param dryRun: Rolls the transaction back if True.
+    @param results: The results list to append the result for each record to.
+
+    @return: True if the import must be aborted due to the C{fail} policy,
+             False otherwise.
+    """
+    # Validate and split the records. Maps chunk position to result
+    chunkResults = []
+    valid = []
+    for idx, rec in chunk:
+        uhd = rec.get('uhd') if isinstance(rec, dict) else None
+        res = {'index': idx, 'uhd': uhd}
+        chunkResults.append(res)
+        parts = splitUserHostDomain(uhd) if isinstance(uhd, basestring) \
+                else None
+        key = rec.get('key') if isinstance(rec, dict) else None
+        if parts is None:
+            res.update(status='failed',
+                       error="Invalid uhd identifier: {0}".format(uhd))
+        elif not key:
+            res.update(status='failed', error="No public key supplied.")
+        else:
+            try:
+                valid.append((res, parts, _keyFields(key)))
+            except ValueError as exc:
+                res.update(status='failed', error=str(exc))
+
+    # The result for the record that aborts the import under the fail policy
+    aborted = None
+    updated = []
+    with db.transaction() as txn:
+        if valid:
+            # Add all missing domains, and get the ids for all of them
+            domains = set(d for _, (u, h, d), _ in valid)
+            db.insertOrIgnore(db.Domain.insert_many(
+                [{'name': d} for d in domains]))
+            domIds = dict(db.Domain.select(db.Domain.name, db.Domain.id)\
+                    .where(db.Domain.name << list(domains))\
+                    .tuples())
+
+            # Same for the hosts
+            hosts = set((h, domIds[d]) for _, (u, h, d), _ in valid)
+            db.insertOrIgnore(db.Host.insert_many(
+                [{'name': h, 'domain': dId} for h, dId in hosts]))
+            hostIds = {}
+            for hId, h, dId in db.Host.select(db.Host.id, db.Host.name,
+                                              db.Host.domain)\
+                    .where(db.Host.domain << list(domIds.values()))\
+                    .where(db.Host.name << list(set(h for h, _ in hosts)))\
+                    .tuples():
+                hostIds[(h, dId)] = hId
+
+            # Find the users that exist already
+            users = set((u, hostIds[(h, domIds[d])])
+                        for _, (u, h, d), _ in valid)
+            existing = {}
+            for uId, u, hId in db.User.select(db.User.id, db.User.name,
+                                              db.User.host)\
+                    .where(db.User.host << list(set(h for _, h in users)))\
+                    .where(db.User.name << list(set(u for u, _ in users)))\
+                    .tuples():
+                existing[(u, hId)] = uId
+
+            # Split into inserts and updates. New users are keyed on (user,
+            # host) so that duplicates in the chunk are treated as conflicts
+            newUsers = {}
+            for res, (u, h, d), key in valid:
+                userKey = (u, hostIds[(h, domIds[d])])
+                if userKey not in existing and userKey not in newUsers:
+                    newUsers[userKey] = (res, key)
+                    res['status'] = 'added'
+                elif policy == 'skip':
+                    res['status'] = 'skipped'
+                elif policy == 'update':
+                    if userKey in newUsers:
+                        # Replaces the key to be inserted
+                        newUsers[userKey][0]['status'] = 'skipped'
+                        newUsers[userKey] = (res, key)
+                        res['status'] = 'added'
+                    else:
+                        updated.append((existing[userKey], key, u, h, d))
+                        res['status'] = 'updated'
+                else:
+                    res.update(status='failed',
+                               error="User exists: {0}".format(res['uhd']))
+                    aborted = res
+                    break
+
+            if aborted is None:
+                rows = [dict(host=hId, name=u, **key)
+                        for (u, hId), (res, key) in newUsers.items()]
+                # New users get ids above the current maximum, since this
+                # transaction holds the write lock
+                lastId = db.User.select(fn.Max(db.User.id)).scalar() or 0
+                # Stay below the SQLite limit on variables per statement
+                batch = 900 // len(db.User._meta.fields)
+                for n in xrange(0, len(rows), batch):
+                    db.User.insert_many(rows[n:n+batch]).execute()
+                if rows:
+                    changes.record(changes.KEY, db.User.id > lastId)
+                for uId, key, u, h, d in updated:
+                    db.User.update(revision=db.User.revision + 1, **key)\
+                            .where(db.User.id==uId)\
+                            .execute()
+                if updated:
+                    updatedIds = [uId for uId, _, _, _, _ in updated]
+                    changes.record(changes.KEY, db.User.id << updatedIds)
+                    _bumpAuthRevisions(updatedIds)
+
+        if aborted is not None or dryRun:
+            txn.rollback()
+
+    if aborted is not None:
+        # Nothing in this chunk was committed, and processing stops at the
+        # failed record
+        chunkResults = chunkResults[:chunkResults.index(aborted) + 1]
+        for res in chunkResults[:-1]:
+            if res['status'] != 'failed':
+                res['status'] = 'rolledBack'
+    elif not dryRun:
+        # Any cached keys for updated users are now stale
+        for uId, key, u, h, d in updated:
+            keyCache.invalidate("{0}@{1}.{2}".format(u, h, d))
+
+    results.extend(chunkResults)
+
+    return aborted is not None
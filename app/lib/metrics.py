@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+"""
+Application metrics library.
+
+Metrics are kept in a L{Registry} of counters and histograms, and exposed in
+the Prometheus text format by the L{MetricsPage} mounted at C{/metrics}.
+
+To keep the instrumentation cost to a few microseconds, every thread updates
+its own shard of the metrics without any locking, and the shards are only
+summed when the metrics are rendered.
+
+The C{metrics} CherryPy tool records the latency and status of every request
+it is switched on for, along with the number of database queries and the time
+spent on them. See L{recordQuery} for the database hook.
+"""
+
+import time
+import bisect
+import threading
+import cherrypy
+from lib import conf, componentConfig
+
+#: Default latency histogram buckets, in seconds
+TIME_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                0.5, 1.0, 2.5, 5.0, 10.0)
+
+#: Buckets for the number of database queries per request
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+class Registry(object):
+    """
+    A registry of counters and histograms, sharded per thread.
+
+    Metrics must be described with L{counter} or L{histogram} before they are
+    updated. Each metric can have any number of label sets, passed as a tuple
+    of (name, value) tuples.
+    """
+
+    def __init__(self):
+        # Maps metric name to (type, help, buckets)
+        self._meta = {}
+        self._shards = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._collectors = []
+
+    def counter(self, name, help):
+        """
+        Describes a counter.
+        """
+        self._meta[name] = ('counter', help, None)
+
+    def histogram(self, name, help, buckets=TIME_BUCKETS):
+        """
+        Describes a histogram with the given upper bucket bounds.
+        """
+        self._meta[name] = ('histogram', help, tuple(buckets))
+
+    def collector(self, func):
+        """
+        Adds a function to call when rendering, for metrics kept elsewhere.
+
+        @param func: Called without arguments, and must return a list of
+               (name, type, help, samples) tuples, where samples is a list of
+               (labels, value) tuples.
+        """
+        self._collectors.append(func)
+
+    def _shard(self):
+        """
+        Returns the metrics shard for the current thread.
+        """
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = {}
+            with self._lock:
+                self._shards.append(shard)
+            return shard
+
+    def inc(self, name, labels=(), value=1):
+        """
+        Increments a counter.
+        """
+        shard = self._shard()
+        key = (name, labels)
+        shard[key] = shard.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        """
+        Records a value in a histogram.
+        """
+        shard = self._shard()
+        key = (name, labels)
+        hist = shard.get(key)
+        if hist is None:
+            # A count per bucket, plus the +Inf bucket and the sum
+            hist = shard[key] = [0] * (len(self._meta[name][2]) + 2)
+        hist[bisect.bisect_left(self._meta[name][2], value)] += 1
+        hist[-1] += value
+
+    def collect(self):
+        """
+        Returns the metrics, summed over all shards.
+
+        @return: A dictionary mapping (name, labels) to the counter value, or
+            to the list of bucket counts and sum for histograms.
+        """
+        with self._lock:
+            shards = list(self._shards)
+        totals = {}
+        for shard in shards:
+            # items() copies the shard atomically under the GIL
+            for key, value in shard.items():
+                if isinstance(value, list):
+                    total = totals.setdefault(key, [0] * len(value))
+                    for n, v in enumerate(value):
+                        total[n] += v
+                else:
+                    totals[key] = totals.get(key, 0) + value
+
+        return totals
+
+    def render(self):
+        """
+        Returns all metrics in the Prometheus text exposition format.
+        """
+        byName = {}
+        for (name, labels), value in self.collect().items():
+            byName.setdefault(name, []).append((labels, value))
+
+        lines = []
+        for name in sorted(self._meta):
+            kind, help, buckets = self._meta[name]
+            lines.append("# HELP {0} {1}".format(name, help))
+            lines.append("# TYPE {0} {1}".format(name, kind))
+            for labels, value in sorted(byName.get(name, [])):
+                if kind == 'counter':
+                    lines.append(_sample(name, labels, value))
+                    continue
+                cumulative = 0
+                for bound, count in zip(buckets + ('+Inf',), value[:-1]):
+                    cumulative += count
+                    lines.append(_sample(name + '_bucket',
+                                         labels + (('le', bound),),
+                                         cumulative))
+                lines.append(_sample(name + '_sum', labels, value[-1]))
+                lines.append(_sample(name + '_count', labels, cumulative))
+
+        # Collectors may return samples for the same metrics
+        collected = {}
+        for func in self._collectors:
+            for name, kind, help, samples in func():
+                collected.setdefault(name, (kind, help, []))[2].extend(samples)
+        for name in sorted(collected):
+            kind, help, samples = collected[name]
+            lines.append("# HELP {0} {1}".format(name, help))
+            lines.append("# TYPE {0} {1}".format(name, kind))
+            for labels, value in samples:
+                lines.append(_sample(name, labels, value))
+
+        return "\n".join(lines) + "\n"
+
+def _sample(name, labels, value):
+    """
+    Formats a single Prometheus sample line.
+    """
+    if labels:
+        name += '{' + ','.join('{0}="{1}"'.format(
+                    k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                    for k, v in labels) + '}'
+
+    return "{0} {1}".format(name, repr(value) if isinstance(value, float)
+                                  else value)
+
+#: The application metrics registry
+registry = Registry()
+registry.histogram('http_request_duration_seconds',
+                   "Request latency by route and method.")
+registry.counter('http_requests_total',
+                 "Requests by route, method and status code.")
+registry.histogram('http_request_db_queries',
+                   "Database queries per request by route.", COUNT_BUCKETS)
+registry.histogram('http_request_db_seconds',
+                   "Time spent on database queries per request by route.")
+registry.histogram('db_query_duration_seconds',
+                   "Database query latency by statement type.")
+registry.counter('db_connections_opened_total',
+                 "Database connections opened.")
+registry.counter('db_connections_closed_total',
+                 "Database connections closed.")
+
+#: Per thread state for the request being handled
+_request = threading.local()
+
+def recordQuery(sql, seconds):
+    """
+    Records an executed database query. Called by the L{lib.database} databases
+    for every statement.
+
+    @param sql: The SQL statement.
+    @param seconds: The time the statement took.
+    """
+    registry.observe('db_query_duration_seconds',
+                     (('statement', sql.split(None, 1)[0].upper()),), seconds)
+    if getattr(_request, 'active', False):
+        _request.queries += 1
+        _request.dbTime += seconds
+
+def routeName(request):
+    """
+    Returns the route of a request, for use as a label.
+
+    The controller class identifies the route without any path parameters.
+    Other tools wrap the handler later on, so this must be called from a tool
+    that runs C{on_start_resource}.
+    """
+    handler = getattr(request.handler, 'callable', None)
+    return getattr(getattr(handler, 'im_class', None), '__name__', 'none')
+
+def startRequest():
+    """
+    The C{metrics} tool callable. Starts measuring the current request, and
+    attaches L{endRequest} to record the results once the response is sent.
+    """
+    _request.active = True
+    _request.start = time.time()
+    _request.queries = 0
+    _request.dbTime = 0.0
+    _request.route = routeName(cherrypy.request)
+    cherrypy.request.hooks.attach('on_end_request', endRequest)
+
+def endRequest():
+    """
+    Records the metrics for the request measured by L{startRequest}.
+    """
+    elapsed = time.time() - _request.start
+    _request.active = False
+
+    route = _request.route
+    method = cherrypy.request.method
+    status = str(cherrypy.response.status).split(None, 1)[0]
+
+    registry.observe('http_request_duration_seconds',
+                     (('route', route), ('method', method)), elapsed)
+    registry.inc('http_requests_total',
+                 (('route', route), ('method', method), ('status', status)))
+    registry.observe('http_request_db_queries', (('route', route),),
+                     _request.queries)
+    registry.observe('http_request_db_seconds', (('route', route),),
+                     _request.dbTime)
+
+cherrypy.tools.metrics = cherrypy.Tool('on_start_resource', startRequest)
+
+def cacheCollector(name, cache):
+    """
+    Adds a collector for the stats of a L{lib.cache.LRUCache}.
+
+    @param name: The cache name, used as the C{cache} label.
+    """
+    def collect():
+        stats = cache.stats()
+        labels = (('cache', name),)
+        samples = [('cache_size', 'gauge', "Entries in the cache.",
+                    [(labels, stats['size'])])]
+        for counter in ('hits', 'misses', 'evictions', 'expirations',
+                        'invalidations'):
+            samples.append(('cache_{0}_total'.format(counter), 'counter',
+                            "Cache {0}.".format(counter),
+                            [(labels, stats[counter])]))
+        return samples
+
+    registry.collector(collect)
+
+class MetricsPage(object):
+    """
+    The C{/metrics} page, with all metrics in the Prometheus text format.
+    """
+
+    @cherrypy.expose
+    def index(self):
+        cherrypy.response.headers['Content-Type'] = 'text/plain; version=0.0.4'
+        return registry.render()
+
+def setup():
+    """
+    Mounts the L{MetricsPage} if enabled in the C{[metrics]} config.
+
+    The page is configured from the optional C{metrics[.site].conf} files, for
+    example to require authentication.
+    """
+    metricsConf = conf.get('metrics', {})
+    if not metricsConf.get('enabled', True):
+        return
+    cherrypy.tree.mount(MetricsPage(), metricsConf.get('path', '/metrics'),
+                        componentConfig('metrics', required=False))
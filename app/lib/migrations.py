@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+"""
+Database schema migrations.
+
+New tables are created by L{lib.database.initialize}, but columns added to
+existing models need a migration for databases created before the column was
+added. Every migration must be safe to run on an up to date database, since
+all of them are run on every L{run}.
+
+Migrations are only run when the schema version stored in the database differs
+from the current one, which includes the names of all L{MIGRATIONS}. See
+L{lib.database.initialize}.
+"""
+
+import sqlite3
+import logging
+from external.peewee import IntegerField, CharField, BlobField, TextField
+from external.playhouse.migrate import SqliteMigrator, migrate
+from lib import sshKey
+
+logger = logging.getLogger(__name__)
+
+def columnNames(database, table):
+    """
+    Returns the list of column names for L{table}.
+    """
+    cursor = database.execute_sql('PRAGMA table_info("{0}")'.format(table))
+
+    return [row[1] for row in cursor.fetchall()]
+
+def addColumns(migrator, table, columns):
+    """
+    Adds any of the L{columns} not yet in L{table}.
+
+    Columns are added as nullable columns and then set to the field default.
+    Adding the NOT NULL constraint afterwards would mean rebuilding the table
+    in SQLite, losing its indexes.
+
+    @param migrator: The schema migrator.
+    @param table: The table name.
+    @param columns: A list of (columnName, field) tuples. The fields must be new
+           field instances, and not the model fields, since the migrator
+           changes them.
+
+    @return: The list of column names added.
+    """
+    existing = set(columnNames(migrator.database, table))
+    added = []
+    for name, field in columns:
+        if name in existing:
+            continue
+        ops = [migrator.alter_add_column(table, name, field)]
+        if field.default is not None:
+            ops.append(migrator.apply_default(table, name, field))
+        migrate(*ops)
+        added.append(name)
+
+    if added:
+        logger.info("Added columns %s to table %s", added, table)
+
+    return added
+
+def addRevisions(migrator):
+    """
+    Adds the key and authorized_keys revision counters to the user table.
+    """
+    with migrator.database.transaction():
+        addColumns(migrator, 'user',
+                   [('revision', IntegerField(default=1)),
+                    ('authRevision', IntegerField(default=1))])
+
+def addFingerprints(migrator):
+    """
+    Adds the indexed key type and fingerprint columns to the user table.
+
+    They are filled in for existing users by L{addKeyBlobs}, which parses every
+    key text anyway, so the keys are only parsed once.
+    """
+    added = addColumns(migrator, 'user', [('keyType', IntegerField(null=True)),
+                                          ('fingerprint', CharField(null=True))])
+    for column in added:
+        migrate(migrator.add_index('user', (column,)))
+
+def addKeyBlobs(migrator, batchSize=1000):
+    """
+    Converts the public key text in the user table to the decoded key blob,
+    key type, key comment and fingerprint columns, in batches of L{batchSize}
+    users per transaction, and then drops the key text column.
+
+    Keys that can not be parsed are logged and stored as is in the blob column,
+    without a key type, so that the text is still returned for them.
+    """
+    database = migrator.database
+    if 'pubKey' not in columnNames(database, 'user'):
+        return
+    addColumns(migrator, 'user', [('keyBlob', BlobField(null=True)),
+                                  ('keyComment', TextField(null=True))])
+
+    lastId = 0
+    while True:
+        with database.transaction():
+            rows = database.execute_sql(
+                    'SELECT "id", "pubKey" FROM "user" WHERE "id" > ? AND '
+                    '"keyBlob" IS NULL ORDER BY "id" LIMIT ?',
+                    (lastId, batchSize)).fetchall()
+            if not rows:
+                break
+            for userId, pubKey in rows:
+                try:
+                    keyType, blob, comment = sshKey.parse(pubKey)
+                except ValueError as exc:
+                    logger.warning("Storing unparsable key as is for user id "
+                                   "%s: %s", userId, exc)
+                    database.execute_sql(
+                        'UPDATE "user" SET "keyBlob" = ? WHERE "id" = ?',
+                        (buffer(pubKey.encode('utf-8')), userId))
+                    continue
+                database.execute_sql(
+                    'UPDATE "user" SET "keyType" = ?, "keyBlob" = ?, '
+                    '"keyComment" = ?, "fingerprint" = ? WHERE "id" = ?',
+                    (sshKey.keyTypeCode(keyType), buffer(blob), comment,
+                     sshKey.fingerprint(blob), userId))
+            lastId = rows[-1][0]
+        logger.info("Converted keys up to user id %s", lastId)
+
+    if sqlite3.sqlite_version_info >= (3, 35, 0):
+        database.execute_sql('ALTER TABLE "user" DROP COLUMN "pubKey"')
+    else:
+        # Older SQLite versions need the table rebuilt, which loses the indexes
+        from models.model import User
+        migrate(migrator.drop_column('user', 'pubKey'))
+        User._create_indexes()
+    logger.info("Dropped the user pubKey column. Run VACUUM to reclaim the "
+                "space it used.")
+
+#: Triggers deleting the stored authorized_keys files of owners whose entries
+#: change, or whose authorized users' keys change. keyManagement stores the
+#: files again in the same transaction, and any other change leaves them to be
+#: rendered from the entries until refreshed.
+AUTHORIZED_KEYS_TRIGGERS = {
+    'authorizedkeys_insert':
+        'AFTER INSERT ON "authorizedkeys" BEGIN '
+        'DELETE FROM "authorizedkeysfile" WHERE "owner_id" = NEW."owner_id"; '
+        'END',
+    'authorizedkeys_update':
+        'AFTER UPDATE ON "authorizedkeys" BEGIN '
+        'DELETE FROM "authorizedkeysfile" '
+        'WHERE "owner_id" IN (OLD."owner_id", NEW."owner_id"); '
+        'END',
+    'authorizedkeys_delete':
+        'AFTER DELETE ON "authorizedkeys" BEGIN '
+        'DELETE FROM "authorizedkeysfile" WHERE "owner_id" = OLD."owner_id"; '
+        'END',
+    'user_key_update':
+        'AFTER UPDATE OF "name", "keyType", "keyBlob", "keyComment" ON "user" '
+        'BEGIN '
+        'DELETE FROM "authorizedkeysfile" WHERE "owner_id" IN '
+        '(SELECT "owner_id" FROM "authorizedkeys" '
+        'WHERE "authedUser_id" = NEW."id"); '
+        'END',
+}
+
+def addAuthorizedKeysFiles(migrator):
+    """
+    Adds the triggers keeping the stored C{authorized_keys} files consistent,
+    and stores the files for all owners. The table itself is created with the
+    other tables.
+    """
+    from lib import keyManagement
+    database = migrator.database
+    with database.transaction():
+        for name, trigger in sorted(AUTHORIZED_KEYS_TRIGGERS.items()):
+            database.execute_sql('CREATE TRIGGER IF NOT EXISTS "{0}" {1}'\
+                                 .format(name, trigger))
+    if database.execute_sql('SELECT 1 FROM "authorizedkeysfile" LIMIT 1')\
+            .fetchone() is None:
+        stored = keyManagement.rebuildAuthorizedKeysFiles()
+        if stored:
+            logger.info("Stored %s authorized_keys files", stored)
+
+def addNameIndexes(migrator):
+    """
+    Adds the indexes listing the hosts in a domain, and the users on a host, in
+    name order. They are named the way peewee names the model indexes.
+    """
+    database = migrator.database
+    with database.transaction():
+        for table, columns in (('host', ('domain_id', 'name')),
+                               ('user', ('host_id', 'name'))):
+            database.execute_sql(
+                'CREATE INDEX IF NOT EXISTS "{0}_{1}" ON "{0}" ({2})'.format(
+                    table, '_'.join(columns),
+                    ', '.join('"{0}"'.format(c) for c in columns)))
+
+def addUniqueAuthorizedKeys(migrator):
+    """
+    Adds the unique index on the C{authorized_keys} entries' owner and
+    authorized user, after deleting any duplicate entries.
+    """
+    from lib import keyManagement
+    database = migrator.database
+    with database.transaction():
+        deleted = database.execute_sql(
+                'DELETE FROM "authorizedkeys" WHERE "id" NOT IN '
+                '(SELECT MIN("id") FROM "authorizedkeys" '
+                'GROUP BY "owner_id", "authedUser_id")').rowcount
+        database.execute_sql(
+                'CREATE UNIQUE INDEX IF NOT EXISTS '
+                '"authorizedkeys_owner_id_authedUser_id" '
+                'ON "authorizedkeys" ("owner_id", "authedUser_id")')
+    if deleted > 0:
+        # The triggers deleted the stored files of the owners
+        logger.info("Deleted %s duplicate authorized_keys entries", deleted)
+        keyManagement.rebuildAuthorizedKeysFiles()
+
+#: The migrations, in the order they must be run
+MIGRATIONS = [addRevisions, addFingerprints, addKeyBlobs,
+              addAuthorizedKeysFiles, addNameIndexes, addUniqueAuthorizedKeys]
+
+def run(database):
+    """
+    Runs all L{MIGRATIONS} against L{database}.
+
+    Migrations manage their own transactions, so that long running data
+    migrations can commit in batches.
+
+    @param database: The peewee database to migrate.
+    """
+    migrator = SqliteMigrator(database)
+    for migration in MIGRATIONS:
+        migration(migrator)
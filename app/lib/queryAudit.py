@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+"""
+Query budget and N+1 query detection, for development and CI.
+
+When enabled in the C{[queryAudit]} config, every SQL statement executed while
+an audit is active is normalized and counted. An audit reports a problem when:
+
+    - the same normalized statement runs more than C{maxRepeats} times, which
+      is the typical sign of lazy foreign key lookups in a loop (N+1 queries),
+    - more statements run than the declared query budget.
+
+Problems are logged with the Python call site that issued the offending
+statement, or raised as L{QueryBudgetError} if the C{[queryAudit]} action is
+C{raise}, which is what tests and CI should use.
+
+Audits are active for requests handled with the C{queryAudit} tool, where the
+budget for a handler is declared with the tool decorator::
+
+    @cherrypy.tools.queryAudit(budget=3)
+    def GET(self, uhd):
+        ...
+
+or in code with the L{audit} context manager.
+"""
+
+import os
+import re
+import logging
+import threading
+import traceback
+import cherrypy
+from lib import conf
+
+logger = logging.getLogger(__name__)
+
+#: The C{[queryAudit]} config section
+auditConf = conf.get('queryAudit', {})
+
+#: If True, statements are audited
+enabled = auditConf.get('enabled', False)
+
+#: Default for the number of times one statement may run per audit
+MAX_REPEATS = auditConf.get('maxRepeats', 5)
+
+#: What to do on problems: 'log' or 'raise'
+action = auditConf.get('action', 'log')
+
+#: Files whose frames are skipped to find the call site of a statement
+_skipFiles = tuple(os.path.splitext(os.path.abspath(p))[0] for p in (
+                   __file__,
+                   os.path.join(os.path.dirname(__file__), 'database.py'),
+                   os.path.join(os.path.dirname(__file__), '..', 'external',
+                                'peewee.py')))
+
+#: Regexes and replacements to normalize statements
+_normalizers = (
+    (re.compile(r"'(?:[^']|'')*'"), '?'),
+    (re.compile(r'\b\d+(\.\d+)?\b'), '?'),
+    (re.compile(r'\(\s*\?(\s*,\s*\?)*\s*\)'), '(?+)'),
+    (re.compile(r'\s+'), ' '),
+)
+
+class QueryBudgetError(Exception):
+    """
+    Raised when an audit finds a problem and the action is C{raise}.
+    """
+
+def normalize(sql):
+    """
+    Returns the normalized form of a statement, with literals replaced by '?',
+    and any list of parameters, like for C{IN}, collapsed to '(?+)'.
+    """
+    for regex, repl in _normalizers:
+        sql = regex.sub(repl, sql)
+
+    return sql.strip()
+
+def callSite():
+    """
+    Returns the 'file:line in function' description of the innermost stack
+    frame outside the database layer.
+    """
+    for filename, line, func, _ in reversed(traceback.extract_stack()):
+        if not os.path.splitext(os.path.abspath(filename))[0] \
+                .startswith(_skipFiles):
+            return "{0}:{1} in {2}".format(filename, line, func)
+
+    return "unknown"
+
+class Audit(object):
+    """
+    The statements executed during one audit.
+    """
+
+    def __init__(self, name, budget=None, maxRepeats=None):
+        """
+        Instance initialization.
+
+        @param name: The name of what is being audited, for reports.
+        @param budget: The maximum number of statements, or None for no limit.
+        @param maxRepeats: The maximum number of times one normalized
+               statement may run, or None for no limit.
+        """
+        self.name = name
+        self.budget = budget
+        self.maxRepeats = maxRepeats
+        self.count = 0
+        self.statements = {}
+        self.problems = []
+
+    def record(self, sql):
+        """
+        Records an executed statement, and reports it if it breaks the limits.
+        """
+        self.count += 1
+        key = normalize(sql)
+        repeats = self.statements[key] = self.statements.get(key, 0) + 1
+
+        # Each problem is only reported once per audit
+        if self.maxRepeats is not None and repeats == self.maxRepeats + 1:
+            self.report("statement ran more than {0} times: {1}".format(
+                            self.maxRepeats, key))
+        if self.budget is not None and self.count == self.budget + 1:
+            self.report("more than the budget of {0} statements, at: "
+                        "{1}".format(self.budget, key))
+
+    def report(self, problem):
+        """
+        Logs or raises a problem, with the call site of the current statement.
+        """
+        msg = "Query audit for {0}: {1} (called from {2})".format(
+                self.name, problem, callSite())
+        self.problems.append(msg)
+        if action == 'raise':
+            raise QueryBudgetError(msg)
+        logger.warning(msg)
+
+#: The active audit for the current thread
+_local = threading.local()
+
+def record(sql):
+    """
+    Records an executed statement in the active audit for this thread, if any.
+    Called by the L{lib.database} databases for every statement when auditing
+    is L{enabled}.
+    """
+    current = getattr(_local, 'audit', None)
+    if current is not None:
+        current.record(sql)
+
+class audit(object):
+    """
+    Context manager auditing the statements run inside it. Audits do not nest;
+    an inner audit replaces the outer one while active.
+
+    Usage::
+
+        with audit('render', budget=2) as a:
+            keyManagement.renderAuthorizedKeys(uhd)
+        print a.count, a.problems
+    """
+
+    def __init__(self, name, budget=None, maxRepeats=MAX_REPEATS):
+        self.audit = Audit(name, budget, maxRepeats)
+
+    def __enter__(self):
+        self._outer = getattr(_local, 'audit', None)
+        _local.audit = self.audit
+        return self.audit
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        _local.audit = self._outer
+
+def startRequest(budget=None, maxRepeats=MAX_REPEATS):
+    """
+    The C{queryAudit} tool callable. Starts an audit for the current request
+    if auditing is L{enabled}.
+
+    @param budget: The query budget for the request handler.
+    @param maxRepeats: The maximum times one statement may run.
+    """
+    if not enabled:
+        return
+    request = cherrypy.request
+    _local.audit = Audit("{0} {1}{2}".format(request.method,
+                                             request.script_name,
+                                             request.path_info),
+                         budget, maxRepeats)
+    request.hooks.attach('on_end_request', endRequest)
+
+def endRequest():
+    """
+    Ends the audit for the current request.
+    """
+    _local.audit = None
+
+cherrypy.tools.queryAudit = cherrypy.Tool('on_start_resource', startRequest)
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+OpenSSH public key parsing library.
+"""
+
+import struct
+import base64
+import binascii
+import hashlib
+
+#: The known key types. The position of a type in this tuple, plus one, is the
+#: key type code stored in the database, so new types must only ever be added
+#: at the end.
+KEY_TYPES = ('ssh-rsa',
+             'ssh-dss',
+             'ssh-ed25519',
+             'ecdsa-sha2-nistp256',
+             'ecdsa-sha2-nistp384',
+             'ecdsa-sha2-nistp521',
+             'sk-ssh-ed25519@openssh.com',
+             'sk-ecdsa-sha2-nistp256@openssh.com')
+
+def keyTypeCode(keyType):
+    """
+    Returns the key type code for a key type name.
+
+    @raises ValueError: If L{keyType} is not a known key type.
+    """
+    try:
+        return KEY_TYPES.index(keyType) + 1
+    except ValueError:
+        raise ValueError("Unsupported key type: {0}".format(keyType))
+
+def keyTypeName(code):
+    """
+    Returns the key type name for a key type code.
+    """
+    return KEY_TYPES[code - 1]
+
+def fingerprint(blob):
+    """
+    Returns the OpenSSH SHA256 fingerprint for a decoded key, in the same
+    'SHA256:...' format as shown by C{ssh-keygen -l}.
+
+    @param blob: The decoded (binary) public key.
+    """
+    digest = base64.b64encode(hashlib.sha256(blob).digest())
+
+    return 'SHA256:' + digest.rstrip('=')
+
+def parse(pubKey):
+    """
+    Parses an OpenSSH public key as found in C{id_rsa.pub} or C{authorized_keys}
+    files, without any options.
+
+    @param pubKey: The public key text: 'type base64-key [comment]'
+
+    @return: A (keyType, blob, comment) tuple with the key type name, the
+        decoded key, and the comment, or None if there is no comment.
+
+    @raises ValueError: If L{pubKey} is not a valid public key.
+    """
+    parts = pubKey.strip().split(None, 2) if pubKey else []
+    if len(parts) < 2:
+        raise ValueError("Invalid public key.")
+
+    keyType, data = parts[0], parts[1]
+    keyTypeCode(keyType)
+    try:
+        blob = base64.b64decode(data)
+    except (TypeError, binascii.Error):
+        raise ValueError("Invalid public key encoding.")
+
+    # The blob starts with the length prefixed key type, which must match the
+    # type given in the text
+    if len(blob) < 4:
+        raise ValueError("Invalid public key data.")
+    length = struct.unpack('>I', blob[:4])[0]
+    if blob[4:4+length] != keyType:
+        raise ValueError("Public key data does not match key type.")
+
+    comment = parts[2].strip() if len(parts) > 2 else None
+
+    return keyType, blob, comment or None
+
+def pubKeyText(code, blob, comment=None):
+    """
+    Rebuilds the OpenSSH public key text from its stored parts. This is the
+    reverse of L{parse}.
+
+    @param code: The key type code. See L{keyTypeCode}. If None, L{blob} is
+           taken to be key text that could not be parsed, and is returned as
+           is.
+    @param blob: The decoded (binary) public key.
+    @param comment: The key comment, or None.
+
+    @return: The public key text: 'type base64-key [comment]'
+    """
+    if code is None:
+        return str(blob)
+    key = keyTypeName(code) + ' ' + base64.b64encode(blob)
+
+    return key + ' ' + comment if comment else key
@@ -0,0 +1,337 @@
+# -*- coding: utf-8 -*-
+"""
+Multi-process serving.
+
+A single process runs all requests under one GIL, so JSON encoding, auth and
+ORM work can use at most one core. With more than one worker configured, the
+L{Master} process forks that many workers instead. Each worker runs its own
+CherryPy engine with a L{ReusePortServer}, and binds the same port with
+C{SO_REUSEPORT}, so the kernel spreads new connections over the workers.
+
+The workers share the SQLite database, and invalidate each other's caches
+through the shared L{generation} counters. Everything else is per worker,
+including the metrics, the admission control limits and the change log
+compaction schedule.
+
+The master restarts workers that exit, and on C{SIGHUP} replaces all workers
+one at a time, only stopping an old worker once its replacement is serving.
+C{SIGTERM} or C{SIGINT} stops the workers, which finish the requests they are
+handling first.
+"""
+
+import os
+import sys
+import time
+import errno
+import signal
+import select
+import socket
+import logging
+import threading
+import cherrypy
+from cherrypy import _cpserver, _cpwsgi_server
+from cherrypy.wsgiserver.wsgiserver2 import prevent_socket_inheritance
+from lib import generation
+
+logger = logging.getLogger(__name__)
+
+#: The SO_REUSEPORT socket option, which Python 2 does not define
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT',
+                       15 if sys.platform.startswith('linux') else None)
+
+#: Workers exiting sooner than this many seconds after they were started are
+#: restarted with an increasing delay
+MIN_UPTIME = 5
+
+#: The maximum seconds to delay restarting a failing worker
+MAX_RESTART_DELAY = 60
+
+class ReusePortWSGIServer(_cpwsgi_server.CPWSGIServer):
+    """
+    The CherryPy WSGI server, binding its socket with C{SO_REUSEPORT}.
+
+    When stopping, the base class stops accepting connections before it closes
+    its socket, and drops any connections accepted in between. This server
+    stops listening first instead, so the kernel hands new connections to the
+    other workers, and, with the C{net.ipv4.tcp_migrate_req} sysctl set, also
+    the connections queued on this socket but not accepted yet.
+    """
+
+    _listening = True
+
+    def tick(self):
+        try:
+            super(ReusePortWSGIServer, self).tick()
+        except socket.error:
+            # Accepting fails once the socket stopped listening
+            if self._listening:
+                raise
+
+    def stop(self):
+        self._listening = False
+        if self.socket is not None:
+            try:
+                self.socket.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        super(ReusePortWSGIServer, self).stop()
+
+    def bind(self, family, type, proto=0):
+        # As the base class, but the option must be set before binding
+        self.socket = socket.socket(family, type, proto)
+        prevent_socket_inheritance(self.socket)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        if self.nodelay and not isinstance(self.bind_addr, str):
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.ssl_adapter is not None:
+            self.socket = self.ssl_adapter.bind(self.socket)
+        self.socket.bind(self.bind_addr)
+
+class ReusePortServer(_cpserver.Server):
+    """
+    The CherryPy server adapter for workers sharing a port.
+
+    The base adapter waits for the port to be free before it starts and after
+    it stops, which it is not while other workers listen on it, so that is
+    left out here.
+    """
+
+    def start(self):
+        if not self.httpserver:
+            self.httpserver, self.bind_addr = \
+                    self.httpserver_from_self(ReusePortWSGIServer(self))
+        if self.running:
+            return
+        self.interrupt = None
+        thread = threading.Thread(target=self._start_http_thread)
+        thread.setName("HTTPServer " + thread.getName())
+        thread.start()
+        self.wait()
+        self.running = True
+        self.bus.log("Serving on %s with SO_REUSEPORT" % self._get_base())
+    start.priority = 75
+
+    def stop(self):
+        if self.running:
+            self.httpserver.stop()
+            self.running = False
+            self.bus.log("HTTP Server %s shut down" % self.httpserver)
+    stop.priority = 25
+
+def useReusePort():
+    """
+    Replaces C{cherrypy.server} with a L{ReusePortServer} with the same
+    settings from the global config.
+    """
+    server = ReusePortServer()
+    for key, value in cherrypy.config.items():
+        if key.startswith('server.') and key.count('.') == 1 and \
+           key != 'server.workers':
+            setattr(server, key[len('server.'):], value)
+    cherrypy.server.unsubscribe()
+    cherrypy.server = server
+    server.subscribe()
+
+class Master(object):
+    """
+    Runs and supervises a number of worker processes.
+    """
+
+    def __init__(self, count, work, readyTimeout=30):
+        """
+        Instance initialization.
+
+        The application must be set up before L{serve} is called, but no
+        database connections may be open, since forked processes can not use
+        them.
+
+        @param count: The number of workers.
+        @param work: The function that serves requests in a worker until the
+               CherryPy engine exits. It is called with a function to call
+               once the worker is serving.
+        @param readyTimeout: The maximum seconds a new worker may take to
+               start serving.
+        """
+        if SO_REUSEPORT is None:
+            raise ValueError("Multiple workers need SO_REUSEPORT, which is "
+                             "not available on this platform.")
+        self.count = count
+        self.work = work
+        self.readyTimeout = readyTimeout
+        # Maps worker pid to the time it was started
+        self.workers = {}
+        # The pids of workers that were told to stop
+        self.retiring = set()
+        self.failures = 0
+        self._stopping = False
+        self._restarting = False
+
+    def serve(self, ready=None):
+        """
+        Starts the workers, and supervises them until they are stopped.
+
+        @param ready: An optional function to call once all workers are
+               serving.
+
+        @return: The exit status for the master process.
+        """
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        signal.signal(signal.SIGHUP, self._restart)
+        logger.info("Starting %s workers", self.count)
+        for _ in range(self.count):
+            self.spawn()
+        if ready is not None:
+            ready()
+
+        stopped = False
+        while self.workers:
+            if self._stopping and not stopped:
+                stopped = True
+                logger.info("Stopping %s workers", len(self.workers))
+                for pid in self.workers:
+                    self.signal(pid, signal.SIGTERM)
+            elif self._restarting and not self._stopping:
+                self._restarting = False
+                self.restart()
+            try:
+                pid, status = os.wait()
+            except OSError, exc:
+                if exc.errno == errno.EINTR:
+                    continue
+                raise
+            self.reap(pid, status)
+        logger.info("All workers stopped")
+
+        return 0
+
+    def _stop(self, signum, frame):
+        self._stopping = True
+
+    def _restart(self, signum, frame):
+        self._restarting = True
+
+    def signal(self, pid, signum):
+        """
+        Sends L{signum} to worker L{pid}, if it is still running.
+        """
+        try:
+            os.kill(pid, signum)
+        except OSError, exc:
+            if exc.errno != errno.ESRCH:
+                raise
+
+    def spawn(self):
+        """
+        Forks a worker, and waits for it to start serving.
+
+        @return: The worker pid.
+        """
+        readFd, writeFd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(readFd)
+            status = 1
+            try:
+                status = self._runWorker(writeFd)
+            except SystemExit, exc:
+                status = exc.code
+            except BaseException:
+                logger.exception("Worker %s failed", os.getpid())
+            finally:
+                os._exit(status or 0)
+
+        os.close(writeFd)
+        self.workers[pid] = time.time()
+        try:
+            ready = _waitReadable(readFd, self.readyTimeout)
+            ready = ready and os.read(readFd, 1) == '.'
+        finally:
+            os.close(readFd)
+        if ready:
+            logger.info("Worker %s started", pid)
+        else:
+            logger.error("Worker %s did not start serving", pid)
+
+        return pid
+
+    def _runWorker(self, readyFd):
+        """
+        Runs the work function in a new worker process.
+        """
+        # The master passes stop signals on, and handles restarts
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM,
+                      lambda signum, frame: cherrypy.engine.exit())
+        generation.share()
+        useReusePort()
+
+        def ready():
+            os.write(readyFd, '.')
+            os.close(readyFd)
+
+        self.work(ready)
+
+        return 0
+
+    def reap(self, pid, status):
+        """
+        Handles an exited worker, and starts a new one in its place unless it
+        was told to stop.
+        """
+        started = self.workers.pop(pid, None)
+        if started is None:
+            return
+        if pid in self.retiring:
+            self.retiring.discard(pid)
+            logger.info("Worker %s stopped", pid)
+            return
+        if self._stopping:
+            return
+
+        logger.warning("Worker %s exited with status %s", pid, status)
+        if time.time() - started < MIN_UPTIME:
+            self.failures += 1
+            delay = min(MAX_RESTART_DELAY, 2 ** self.failures)
+            logger.warning("Restarting worker in %s seconds", delay)
+            time.sleep(delay)
+            if self._stopping:
+                return
+        else:
+            self.failures = 0
+        self.spawn()
+
+    def restart(self):
+        """
+        Replaces all workers, one at a time. A worker is told to stop once its
+        replacement is serving, and finishes its requests in progress.
+        """
+        logger.info("Restarting %s workers", len(self.workers))
+        for pid in list(self.workers):
+            if pid in self.retiring:
+                continue
+            self.spawn()
+            self.retiring.add(pid)
+            self.signal(pid, signal.SIGTERM)
+            if self._stopping:
+                break
+
+def _waitReadable(fd, timeout):
+    """
+    Waits up to L{timeout} seconds for L{fd} to become readable, continuing
+    when interrupted by signals.
+
+    @return: True if it is readable, False on timeout.
+    """
+    deadline = time.time() + timeout
+    while True:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return False
+        try:
+            return bool(select.select([fd], [], [], remaining)[0])
+        except select.error, exc:
+            if exc.args[0] != errno.EINTR:
+                raise
@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+"""
+Group commit for writes.
+
+Every write transaction ends with a commit, and for small writes like adding a
+key, the commit is most of the cost. The L{WriteQueue} CherryPy engine plugin
+commits many writes together: request threads L{WriteQueue.submit} write
+operations to a bounded queue, and wait on the returned L{Future}. A single
+writer thread takes the operations off the queue in batches, and runs each
+batch in one transaction, with every operation in a nested transaction, which
+is a savepoint. An operation that fails only rolls its own changes back, and
+its error goes to its submitter, while the rest of the batch commits.
+
+A batch is closed when it has C{[writeQueue] batchSize} operations, or
+C{maxDelay} seconds after its first operation was taken, whichever comes first.
+With the default C{maxDelay} of 0, a batch takes the operations queued while
+the previous batch was committing, so there is no added latency, and batches
+grow with the commit time and the load.
+
+When the queue is full, L{WriteQueue.submit} raises L{QueueFull} right away
+instead of waiting, so the API can tell the client to retry later.
+"""
+
+import sys
+import time
+import Queue
+import logging
+import threading
+import cherrypy
+from cherrypy.process.plugins import SimplePlugin
+from lib import conf, database as db, metrics
+
+logger = logging.getLogger(__name__)
+
+#: The C{[writeQueue]} config section
+queueConf = conf.get('writeQueue', {})
+
+metrics.registry.histogram('write_queue_batch_size',
+                           "Operations committed per write queue batch.",
+                           (1, 2, 5, 10, 20, 50, 100, 200, 500))
+metrics.registry.counter('write_queue_rejected_total',
+                         "Operations rejected because the queue was full.")
+
+#: The write queue engine plugin, once set up
+_queue = None
+
+class QueueFull(Exception):
+    """
+    Raised by L{WriteQueue.submit} when the queue is full.
+    """
+
+class Timeout(Exception):
+    """
+    Raised by L{Future.result} when the operation did not complete in time.
+    """
+
+class Future(object):
+    """
+    The result of an operation submitted to the L{WriteQueue}.
+    """
+
+    def __init__(self):
+        """
+        Instance initialization.
+        """
+        self._done = threading.Event()
+        self._result = None
+        self._excInfo = None
+
+    def setResult(self, result):
+        """
+        Completes the operation with its return value.
+        """
+        self._result = result
+        self._done.set()
+
+    def setException(self, excInfo):
+        """
+        Completes the operation with an error.
+
+        @param excInfo: The C{sys.exc_info()} tuple for the error.
+        """
+        self._excInfo = excInfo
+        self._done.set()
+
+    def result(self, timeout=None):
+        """
+        Waits for the operation to complete, and returns its return value, or
+        raises its error.
+
+        @param timeout: The maximum number of seconds to wait, or None to wait
+               until the operation completes.
+
+        @raises Timeout: If the operation did not complete in time. It may
+                still complete later.
+        """
+        if not self._done.wait(timeout):
+            raise Timeout()
+        if self._excInfo is not None:
+            raise self._excInfo[0], self._excInfo[1], self._excInfo[2]
+
+        return self._result
+
+class WriteQueue(SimplePlugin):
+    """
+    CherryPy engine plugin running queued write operations in batches, with
+    one commit per batch, on its own writer thread.
+    """
+
+    def __init__(self, bus, maxSize=1000, batchSize=100, maxDelay=0):
+        """
+        Instance initialization.
+
+        @param bus: The CherryPy engine.
+        @param maxSize: The maximum number of operations waiting in the queue.
+        @param batchSize: The maximum number of operations per transaction.
+        @param maxDelay: The maximum number of seconds to wait for more
+               operations to add to a batch.
+        """
+        SimplePlugin.__init__(self, bus)
+        self.queue = Queue.Queue(maxSize)
+        self.batchSize = batchSize
+        self.maxDelay = maxDelay
+        self.thread = None
+
+    def start(self):
+        """
+        Starts the writer thread.
+        """
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run,
+                                           name='writeQueue')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self):
+        """
+        Runs the operations queued so far, and stops the writer thread.
+        """
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+    # After the HTTP server, so that requests waiting on writes can finish
+    stop.priority = 80
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Queues the write operation C{func(*args, **kwargs)}.
+
+        The operation runs in a transaction shared with other operations, so it
+        must not commit or roll back itself, but it may use nested
+        transactions.
+
+        @return: The L{Future} for the operation.
+
+        @raises QueueFull: If the queue is full.
+        """
+        future = Future()
+        try:
+            self.queue.put_nowait((future, func, args, kwargs))
+        except Queue.Full:
+            metrics.registry.inc('write_queue_rejected_total')
+            raise QueueFull()
+
+        return future
+
+    def _run(self):
+        """
+        The writer thread. Takes batches of operations off the queue and runs
+        them until the stop marker is taken.
+        """
+        running = True
+        while running:
+            op = self.queue.get()
+            if op is None:
+                break
+            batch = [op]
+            deadline = time.time() + self.maxDelay
+            while len(batch) < self.batchSize:
+                try:
+                    op = self.queue.get(timeout=max(0, deadline - time.time()))
+                except Queue.Empty:
+                    break
+                if op is None:
+                    running = False
+                    break
+                batch.append(op)
+            self._runBatch(batch)
+
+        db.closeThread()
+
+    def _runBatch(self, batch):
+        """
+        Runs a batch of operations in a single transaction, and then completes
+        their futures.
+
+        @param batch: A list of (future, func, args, kwargs) tuples.
+        """
+        results = []
+        try:
+            with db.transaction():
+                for future, func, args, kwargs in batch:
+                    try:
+                        with db.transaction():
+                            results.append((future, func(*args, **kwargs),
+                                            None))
+                    except Exception:
+                        results.append((future, None, sys.exc_info()))
+        except Exception:
+            # Nothing in the batch was committed
+            logger.exception("Error committing a batch of %s writes",
+                             len(batch))
+            excInfo = sys.exc_info()
+            results = [(future, None, excInfo) for future, _, _, _ in batch]
+        metrics.registry.observe('write_queue_batch_size', (), len(batch))
+
+        for future, result, excInfo in results:
+            if excInfo is None:
+                future.setResult(result)
+            else:
+                future.setException(excInfo)
+
+def run(func, *args, **kwargs):
+    """
+    Runs the write operation C{func(*args, **kwargs)} through the write queue
+    if it is set up, and returns its result. Without the write queue, the
+    operation is simply called.
+
+    @raises QueueFull: If the queue is full.
+    @raises Timeout: If the operation did not complete within the
+            C{[writeQueue] timeout} seconds. It may still complete later.
+    """
+    if _queue is None:
+        return func(*args, **kwargs)
+
+    return _queue.submit(func, *args, **kwargs)\
+            .result(queueConf.get('timeout', 30))
+
+def setup():
+    """
+    Subscribes the L{WriteQueue} plugin to the CherryPy engine if enabled in
+    the C{[writeQueue]} config.
+    """
+    global _queue
+    if queueConf.get('enabled', False) and _queue is None:
+        _queue = WriteQueue(cherrypy.engine,
+                            maxSize=queueConf.get('maxSize', 1000),
+                            batchSize=queueConf.get('batchSize', 100),
+                            maxDelay=queueConf.get('maxDelay', 0))
+        _queue.subscribe()
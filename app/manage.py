@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+"""
+sshKeyServer management commands.
+
+Usage: manage.py <command> [args]
+
+Run C{manage.py -h} for the list of commands.
+"""
+
+import sys
+import getpass
+import argparse
+from lib import configApp, auth, backup, changes, generation, keyManagement
+from lib import database as db
+
+def passwd(args):
+    """
+    Sets, or with --delete removes, the password for an API user.
+    """
+    if args.delete:
+        if not auth.deleteUser(args.username):
+            print >> sys.stderr, "No such user: {0}".format(args.username)
+            return 1
+        print "Removed user: {0}".format(args.username)
+        return 0
+
+    password = getpass.getpass("New password for {0}: ".format(args.username))
+    if password != getpass.getpass("Repeat password: "):
+        print >> sys.stderr, "Passwords do not match."
+        return 1
+    if not password:
+        print >> sys.stderr, "Empty passwords are not allowed."
+        return 1
+    auth.setPassword(args.username, password)
+    print "Password set for user: {0}".format(args.username)
+
+    return 0
+
+def compactChanges(args):
+    """
+    Compacts the change log.
+    """
+    deleted = changes.compact(args.retain)
+    print "Deleted {0} change log entries.".format(deleted)
+
+    return 0
+
+def rebuildAuthorizedKeys(args):
+    """
+    Renders all stored authorized_keys files again.
+    """
+    stored = keyManagement.rebuildAuthorizedKeysFiles()
+    print "Stored {0} authorized_keys files.".format(stored)
+
+    return 0
+
+def checkAuthorizedKeys(args):
+    """
+    Checks the stored authorized_keys files against their entries, and with
+    --fix, refreshes the files with problems.
+    """
+    problems = keyManagement.checkAuthorizedKeysFiles(fix=args.fix)
+    for uhd, problem in problems:
+        print "{0}: {1}".format(uhd, problem)
+    if not problems:
+        print "All stored authorized_keys files are up to date."
+        return 0
+    print "{0} problems found{1}.".format(len(problems),
+                                          ", and fixed" if args.fix else "")
+
+    return 0 if args.fix else 1
+
+def backupDatabase(args):
+    """
+    Writes a compressed backup of the database to a file, or to stdout.
+    """
+    if args.output == '-':
+        backup.backup(sys.stdout)
+        return 0
+    size = backup.backup(args.output)
+    print "Wrote a backup of {0} bytes to {1}.".format(size, args.output)
+
+    return 0
+
+def restoreDatabase(args):
+    """
+    Verifies a backup, and unless only checking, replaces the database with
+    it.
+    """
+    if args.check:
+        problems = backup.check(args.input)
+        for problem in problems:
+            print problem
+        if problems:
+            return 1
+        print "The backup is valid."
+        return 0
+
+    db.closeConnections()
+    try:
+        backup.restore(args.input)
+    except backup.BackupError, exc:
+        print >> sys.stderr, str(exc)
+        return 1
+    # Migrate backups of older schema versions
+    db.setup()
+    print "Restored the database from {0}.".format(args.input)
+
+    return 0
+
+def parseArgs(argv=None):
+    """
+    Parses command line args.
+    """
+    parser = argparse.ArgumentParser(description="sshKeyServer management.")
+    commands = parser.add_subparsers(title="commands")
+
+    cmd = commands.add_parser('passwd', help="Set an API user password.")
+    cmd.add_argument('username', help="The API username.")
+    cmd.add_argument('--delete', action='store_true',
+                     help="Remove the user instead.")
+    cmd.set_defaults(func=passwd)
+
+    cmd = commands.add_parser('compact-changes',
+                              help="Delete old change log entries.")
+    cmd.add_argument('--retain', type=int,
+                     help="The number of recent entries to keep. Defaults to "
+                          "the [changes] retain config.")
+    cmd.set_defaults(func=compactChanges)
+
+    cmd = commands.add_parser('rebuild-authorized-keys',
+                              help="Render all stored authorized_keys files "
+                                   "again.")
+    cmd.set_defaults(func=rebuildAuthorizedKeys)
+
+    cmd = commands.add_parser('check-authorized-keys',
+                              help="Check the stored authorized_keys files "
+                                   "against their entries.")
+    cmd.add_argument('--fix', action='store_true',
+                     help="Refresh the files with problems.")
+    cmd.set_defaults(func=checkAuthorizedKeys)
+
+    cmd = commands.add_parser('backup',
+                              help="Write a compressed backup of the running "
+                                   "database.")
+    cmd.add_argument('output', help="The backup file, or - for stdout.")
+    cmd.set_defaults(func=backupDatabase)
+
+    cmd = commands.add_parser('restore',
+                              help="Replace the database with a backup. The "
+                                   "server must be stopped.")
+    cmd.add_argument('input', help="The backup file, compressed or not.")
+    cmd.add_argument('--check', action='store_true',
+                     help="Only verify the backup.")
+    cmd.set_defaults(func=restoreDatabase)
+
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    """
+    Runs a management command.
+    """
+    args = parseArgs(argv)
+    configApp()
+    db.setup()
+    # Running servers drop their cached data changed by commands
+    generation.share()
+
+    return args.func(args)
+
+if __name__ == "__main__":
+    sys.exit(main())
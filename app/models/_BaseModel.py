@@ -11,13 +11,45 @@ from external import peewee
 #database = peewee.SqliteDatabase('myDB.sqlite', check_same_thread=False)#, threadlocals=True)
 db_proxy = peewee.Proxy()
 
+# The database for reads when reads and writes are split. If this is left
+# uninitialized by L{lib.database.setup}, reads go to L{db_proxy} as well.
+read_proxy = peewee.Proxy()
+
 class ModelBase(peewee.Model):
     """
     The base class for all models.
 
-    This class only provides the Meta class for the database connection to be
-    used by all models.
+    This class provides the Meta class for the database connection to be used
+    by all models, and routes reads to the L{read_proxy} database if it has
+    been set up. Writes always go to L{db_proxy}.
     """
     class Meta:
         database = db_proxy
 
+    @classmethod
+    def _readDatabase(cls):
+        """
+        Returns the database to use for a read.
+
+        Reads go to L{read_proxy} if set up, except while the current thread
+        has a write transaction open. These reads must see the uncommitted
+        writes in the transaction, so they stay on the write database.
+        """
+        writer = cls._meta.database
+        if read_proxy.obj is None or writer.transaction_depth():
+            return writer
+        return read_proxy.obj
+
+    @classmethod
+    def select(cls, *selection):
+        query = super(ModelBase, cls).select(*selection)
+        query.database = cls._readDatabase()
+        return query
+
+    @classmethod
+    def raw(cls, sql, *params):
+        query = super(ModelBase, cls).raw(sql, *params)
+        if query._sql.lstrip().lower().startswith('select'):
+            query.database = cls._readDatabase()
+        return query
+
@@ -3,14 +3,16 @@
 Defines the models for the app.
 """
 
-from _BaseModel import db_proxy, ModelBase
+from _BaseModel import db_proxy, read_proxy, ModelBase
 from external.peewee import *
+from lib import sshKey
 
 # NOTE: All models that need to be automatically managed by
 # L{lib.database.initialize} should be added to this list.
-__all__ = ["db_proxy",
+__all__ = ["db_proxy", "read_proxy",
            # Models
-           "Domain", "Host", "User", "AuthorizedKeys",
+           "Domain", "Host", "User", "AuthorizedKeys", "AuthorizedKeysFile",
+           "Credential", "Change", "SchemaVersion",
            # Exception classes
            "DoesNotExist", "IntegrityError"
           ]
@@ -56,6 +58,8 @@ class Host(ModelBase):
         indexes = (
             # The host should be unique within the domain
             (('name', 'domain'), True),
+            # Lists the hosts in a domain in name order
+            (('domain', 'name'), False),
         )
 
     def fqn(self):
@@ -88,16 +92,35 @@ class User(ModelBase):
     #: The name for the user
     name = TextField(null=False)
 
-    #: The SSH public key for this user
-    pubKey = TextField(null=False)
+    #: The decoded SSH public key for this user. See L{pubKey} for the text
+    #: form.
+    keyBlob = BlobField(null=False)
+
+    #: The public key type code. See L{lib.sshKey.KEY_TYPES}
+    keyType = IntegerField(null=True, index=True)
+
+    #: The comment from the public key text
+    keyComment = TextField(null=True, default=None)
+
+    #: The public key SHA256 fingerprint, as shown by C{ssh-keygen -l}
+    fingerprint = CharField(null=True, index=True)
 
     #: Any optional comments for this user
     comment = TextField(null=True, default=None)
 
+    #: Revision of the public key, bumped whenever the key changes
+    revision = IntegerField(default=1)
+
+    #: Revision of this user's L{AuthorizedKeys} file, bumped whenever the
+    #: rendered file changes
+    authRevision = IntegerField(default=1)
+
     class Meta:
         indexes = (
             # The user should be unique on the host
             (('name', 'host'), True),
+            # Lists the users on a host in name order
+            (('host', 'name'), False),
         )
     def fqn(self):
         """
@@ -105,6 +128,25 @@ class User(ModelBase):
         """
         return "{0}@{1}".format(self.name, self.host.fqn())
 
+    @property
+    def pubKey(self):
+        """
+        The SSH public key text, as found in C{id_rsa.pub} files.
+
+        Keys are stored decoded, so the text is rebuilt from the key type,
+        blob and comment. Setting it parses the text into these fields, and
+        raises a ValueError if it is not a valid public key.
+        """
+        return sshKey.pubKeyText(self.keyType, self.keyBlob, self.keyComment)
+
+    @pubKey.setter
+    def pubKey(self, pubKey):
+        keyType, blob, comment = sshKey.parse(pubKey)
+        self.keyType = sshKey.keyTypeCode(keyType)
+        self.keyBlob = blob
+        self.keyComment = comment
+        self.fingerprint = sshKey.fingerprint(blob)
+
     def __repr__(self):
         return "{0} | {1} | {2}".format(self.fqn(), self.comment, self.pubKey)
 
@@ -125,3 +167,78 @@ class AuthorizedKeys(ModelBase):
     #: Any optional SSH options for the authorized entry in the file
     options = TextField(null=True, default=None)
 
+    class Meta:
+        indexes = (
+            # A user is authorized at most once in a file
+            (('owner', 'authedUser'), True),
+        )
+
+
+class AuthorizedKeysFile(ModelBase):
+    """
+    The rendered C{authorized_keys} file for every L{User} with
+    L{AuthorizedKeys} entries, kept up to date by L{lib.keyManagement} in the
+    same transaction as the changes to the entries or the authorized users'
+    keys. Rows are looked up by the normalized user@host.domain, so a file is
+    served with a single indexed fetch.
+
+    Database triggers delete an owner's row whenever its entries change by any
+    other way, and the file is then rendered from the entries until it is
+    refreshed. See L{lib.migrations.addAuthorizedKeysFiles}.
+    """
+
+    #: The owner of the file
+    owner = ForeignKeyField(User, unique=True, on_delete='CASCADE')
+
+    #: The owner's normalized user@host.domain
+    uhd = TextField(unique=True)
+
+    #: The owner's L{User.authRevision} the file was rendered at
+    authRevision = IntegerField()
+
+    #: The SHA256 hex digest of L{content}
+    sha256 = CharField()
+
+    #: The rendered file
+    content = TextField()
+
+
+class Credential(ModelBase):
+    """
+    API user credentials. See L{lib.auth}.
+    """
+
+    #: The API username
+    name = CharField(unique=True)
+
+    #: The salted password hash: 'pbkdf2_sha256$iterations$salt$hash'
+    pwHash = CharField()
+
+    #: The realm L{ha1} was calculated for
+    realm = CharField(null=True, default=None)
+
+    #: The HTTP Digest HA1 value: MD5('name:realm:password')
+    ha1 = CharField(null=True, default=None)
+
+
+class Change(ModelBase):
+    """
+    The change log: an entry for every change to a user's key or
+    C{authorized_keys} file, added in the same transaction as the change. The
+    entry id is the change sequence number. See L{lib.changes}.
+    """
+
+    #: What changed: 'key' or 'authorized_keys'
+    kind = CharField()
+
+    #: The id of the L{User} whose key or authorized_keys file changed
+    user = IntegerField()
+
+class SchemaVersion(ModelBase):
+    """
+    The version of the schema the database was last set up for. It holds a
+    single row. See L{lib.database.initialize}.
+    """
+
+    #: The schema version. See L{lib.database.schemaVersion}.
+    version = CharField()
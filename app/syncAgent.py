@@ -0,0 +1,453 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+"""
+sshKeyServer sync agent.
+
+Keeps the C{authorized_keys} files for the users on this host in sync with the
+key server. Only the Python standard library is used, so the agent can be
+copied to hosts on its own.
+
+The agent follows the C{/api/changes} feed for its host, and only fetches the
+C{authorized_keys} files that changed, with conditional requests on a single
+keep-alive connection. A file is only rewritten when its content changed, by
+writing a temporary file next to it, syncing it to disk, and renaming it over
+the old file, so a file is never seen half written.
+
+The state file keeps the last change sequence number, and the entity tag and
+content hash of every file. When the server reports that the changes since the
+last sequence number are no longer available, a full snapshot of all users on
+the host is fetched instead.
+
+Usage:
+    syncAgent.py --server https://keys.example.com:8091 --user agent \\
+                 --password-file /etc/sshKeySync.pw [--once]
+
+Run C{syncAgent.py -h} for all options.
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import socket
+import base64
+import hashlib
+import httplib
+import logging
+import urllib
+import urlparse
+import argparse
+import tempfile
+
+logger = logging.getLogger('syncAgent')
+
+#: The default path template for the authorized_keys files
+PATH_TEMPLATE = '~{user}/.ssh/authorized_keys'
+
+#: The user names files are synced for: POSIX portable user names, which can
+#: not lead the path template out of the user's home
+USER_NAME = re.compile(r'^[A-Za-z0-9_][A-Za-z0-9_.-]*\$?$')
+
+class RetryLater(Exception):
+    """
+    Raised when the server asks to retry a request later.
+    """
+
+    def __init__(self, retryAfter):
+        self.retryAfter = retryAfter
+        super(RetryLater, self).__init__(
+                "Server busy. Retry after {0}s".format(retryAfter))
+
+def atomicWrite(path, content, mode=0600, owner=None):
+    """
+    Replaces the file at L{path} with L{content} atomically.
+
+    The content is written to a temporary file in the same directory, synced
+    to disk, and renamed over L{path}. The directory is synced after the
+    rename, so the new file survives a crash.
+
+    @param path: The file to replace.
+    @param content: The new file content as a string.
+    @param mode: The file permissions.
+    @param owner: An optional (uid, gid) tuple for the file and any directory
+           created for it.
+    """
+    dirName = os.path.dirname(path)
+    if not os.path.isdir(dirName):
+        os.makedirs(dirName, 0700)
+        if owner:
+            os.chown(dirName, *owner)
+
+    fd, tmp = tempfile.mkstemp(dir=dirName, prefix='.authorized_keys.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp, mode)
+        if owner:
+            os.chown(tmp, *owner)
+        os.rename(tmp, path)
+    except:
+        os.unlink(tmp)
+        raise
+
+    dirFd = os.open(dirName, os.O_RDONLY)
+    try:
+        os.fsync(dirFd)
+    finally:
+        os.close(dirFd)
+
+class SyncAgent(object):
+    """
+    Syncs the C{authorized_keys} files for the users on one host.
+    """
+
+    def __init__(self, server, hostName, stateFile, auth=None,
+                 pathTemplate=PATH_TEMPLATE, pollTimeout=60, localUsers=True):
+        """
+        Instance initialization.
+
+        @param server: The server base URI, like C{https://keys:8091}.
+        @param hostName: The host.domain name of this host on the server.
+        @param stateFile: The path to the state file.
+        @param auth: An optional (username, password) tuple for the API.
+        @param pathTemplate: The path template for the C{authorized_keys}
+               files. C{{user}} is replaced with the user name, and a leading
+               C{~{user}} is expanded to the user's home directory.
+        @param pollTimeout: Seconds to wait for changes per request.
+        @param localUsers: If True, only users with a local account are synced,
+               and their files are owned by them when running as root.
+        """
+        uri = urlparse.urlsplit(server)
+        self.https = uri.scheme == 'https'
+        self.netloc = uri.netloc
+        self.basePath = uri.path.rstrip('/') + '/api'
+        self.hostName = hostName
+        self.host, _, self.domain = hostName.partition('.')
+        self.stateFile = stateFile
+        self.pathTemplate = pathTemplate
+        self.pollTimeout = pollTimeout
+        self.localUsers = localUsers
+        self.headers = {}
+        if auth:
+            self.headers['Authorization'] = 'Basic ' + \
+                    base64.b64encode('{0}:{1}'.format(*auth))
+        self.conn = None
+        self.state = self.loadState()
+
+    def loadState(self):
+        """
+        Returns the saved state, or a new state if there is no state file yet,
+        or it is for another server or host.
+        """
+        state = {'server': self.netloc, 'host': self.hostName, 'since': None,
+                 'files': {}}
+        try:
+            with open(self.stateFile) as f:
+                saved = json.load(f)
+        except IOError:
+            return state
+        except ValueError:
+            logger.warning("Ignoring invalid state file: %s", self.stateFile)
+            return state
+        if saved.get('server') != self.netloc or \
+           saved.get('host') != self.hostName:
+            logger.warning("State file is for another server or host. "
+                           "Starting from a snapshot.")
+            return state
+
+        return saved
+
+    def saveState(self):
+        """
+        Saves the state atomically.
+        """
+        atomicWrite(self.stateFile, json.dumps(self.state, indent=1,
+                                               sort_keys=True))
+
+    def request(self, path, params=None, headers=None):
+        """
+        Sends a GET request to the API on the keep-alive connection.
+
+        @param path: The path relative to the API base.
+        @param params: Optional query parameters.
+        @param headers: Optional extra request headers.
+
+        @return: A (status, response, body) tuple.
+
+        @raises RetryLater: If the server responds with a 503.
+        @raises IOError: If the request fails, or the response status is not
+                200, 304 or 404.
+        """
+        url = self.basePath + path
+        if params:
+            url += '?' + urllib.urlencode(params)
+        hdrs = dict(self.headers, **(headers or {}))
+        for attempt in (1, 2):
+            if self.conn is None:
+                cls = httplib.HTTPSConnection if self.https \
+                      else httplib.HTTPConnection
+                self.conn = cls(self.netloc, timeout=self.pollTimeout + 30)
+            try:
+                self.conn.request('GET', url, headers=hdrs)
+                resp = self.conn.getresponse()
+                body = resp.read()
+                break
+            except (httplib.HTTPException, socket.error):
+                # The server may have closed the kept alive connection, so
+                # reconnect and try once more
+                self.conn.close()
+                self.conn = None
+                if attempt == 2:
+                    raise
+
+        if resp.status == 503:
+            raise RetryLater(int(resp.getheader('Retry-After') or 5))
+        if resp.status not in (200, 304, 404):
+            raise IOError("GET {0} failed: {1} {2}".format(url, resp.status,
+                                                           resp.reason))
+
+        return resp.status, resp, body
+
+    def close(self):
+        """
+        Closes the connection to the server.
+        """
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def userPath(self, user):
+        """
+        Returns the path to the C{authorized_keys} file for a local user.
+
+        @raises ValueError: If L{user} is not a valid user name. See
+                L{USER_NAME}.
+        """
+        if not USER_NAME.match(user):
+            raise ValueError("Invalid user name: {0!r}".format(user))
+
+        return os.path.expanduser(self.pathTemplate.format(user=user))
+
+    def userOwner(self, user):
+        """
+        Returns the (uid, gid) the user's file should be owned by, or None to
+        leave it to the agent's user.
+
+        @raises KeyError: If only local users are synced, and the user has no
+                local account.
+        """
+        if not self.localUsers:
+            return None
+        import pwd
+        pw = pwd.getpwnam(user)
+
+        return (pw.pw_uid, pw.pw_gid) if os.geteuid() == 0 else None
+
+    def syncUser(self, uhd):
+        """
+        Fetches the C{authorized_keys} file for the user@host.domain if it
+        changed since the last fetch, and rewrites the local file if its
+        content changed.
+
+        @return: True if the local file was written.
+        """
+        user = uhd.split('@', 1)[0]
+        if not USER_NAME.match(user):
+            # Names from the server are never trusted to stay in the home dir
+            logger.warning("Skipping %s: invalid user name", uhd)
+            return False
+        try:
+            owner = self.userOwner(user)
+        except KeyError:
+            logger.debug("Skipping %s: no local user", uhd)
+            return False
+
+        files = self.state['files']
+        known = files.get(uhd, {})
+        path = self.userPath(user)
+        headers = {}
+        if known.get('etag') and os.path.exists(path):
+            headers['If-None-Match'] = known['etag']
+        status, resp, body = self.request(
+                '/authorized_keys/' + urllib.quote(uhd, safe='@'),
+                headers=headers)
+        if status == 304:
+            return False
+        if status == 404:
+            # The user is gone from the server. The local file is left alone.
+            files.pop(uhd, None)
+            return False
+
+        digest = hashlib.sha256(body).hexdigest()
+        files[uhd] = {'etag': resp.getheader('ETag'), 'sha256': digest}
+        if known.get('sha256') == digest and os.path.exists(path):
+            return False
+        atomicWrite(path, body, owner=owner)
+        logger.info("Updated %s", path)
+
+        return True
+
+    def snapshot(self):
+        """
+        Syncs the files for all users on this host.
+
+        @return: The number of files written.
+        """
+        # The position is taken first, so that no change made during the
+        # snapshot can be missed
+        since = self.changes(timeout=0, limit=1)['last']
+
+        written = 0
+        after = None
+        seen = set()
+        while True:
+            params = {'host': self.host, 'domain': self.domain,
+                      'format': 'ndjson', 'limit': 1000}
+            if after:
+                params['after'] = after
+            status, _, body = self.request('/keys', params)
+            after = None
+            for line in body.splitlines():
+                rec = json.loads(line)
+                if 'next' in rec:
+                    after = rec['next']
+                else:
+                    seen.add(rec['uhd'])
+                    written += self.syncUser(rec['uhd'])
+            if not after:
+                break
+
+        # Forget the users that are gone
+        for uhd in set(self.state['files']) - seen:
+            del self.state['files'][uhd]
+        self.state['since'] = since
+        self.saveState()
+
+        return written
+
+    def changes(self, timeout, limit=1000):
+        """
+        Returns the changes response for this host after the current position.
+        """
+        status, _, body = self.request('/changes', {
+            'since': self.state['since'] or 0, 'scope': 'host',
+            'name': self.hostName, 'timeout': timeout, 'limit': limit})
+
+        return json.loads(body)
+
+    def syncOnce(self, timeout=0):
+        """
+        Applies the changes since the last sync, waiting up to L{timeout}
+        seconds for changes if there are none.
+
+        On the first sync, or when the server requires it, a full snapshot is
+        synced instead.
+
+        @return: The number of files written.
+        """
+        if self.state['since'] is None:
+            return self.snapshot()
+
+        written = 0
+        while True:
+            res = self.changes(timeout)
+            if res['snapshotRequired']:
+                logger.info("Changes no longer available. Syncing snapshot.")
+                return written + self.snapshot()
+            # Several changes for a user need only one sync
+            uhds = []
+            for change in res['changes']:
+                if change['kind'] == 'authorized_keys' and \
+                   change['uhd'] not in uhds:
+                    uhds.append(change['uhd'])
+            for uhd in uhds:
+                written += self.syncUser(uhd)
+            self.state['since'] = res['next']
+            self.saveState()
+            if not res['more']:
+                return written
+            timeout = 0
+
+    def run(self):
+        """
+        Syncs forever, long-polling for changes.
+        """
+        delay = 1
+        while True:
+            try:
+                self.syncOnce(self.pollTimeout)
+                delay = 1
+            except RetryLater as exc:
+                time.sleep(exc.retryAfter)
+            except (IOError, ValueError, httplib.HTTPException) as exc:
+                logger.error("Sync failed: %s. Retrying in %ss", exc, delay)
+                time.sleep(delay)
+                delay = min(delay * 2, 300)
+
+def parseArgs(argv=None):
+    """
+    Parses command line args.
+    """
+    parser = argparse.ArgumentParser(
+            description="Syncs authorized_keys files from an sshKeyServer.")
+    parser.add_argument('--server', required=True,
+                        help="The server base URI, like https://keys:8091")
+    parser.add_argument('--name', default=socket.getfqdn(),
+                        help="This host's host.domain name on the server. "
+                             "Default: %(default)s")
+    parser.add_argument('--user', help="The API username.")
+    parser.add_argument('--password-file',
+                        help="A file holding the API password. The password "
+                             "may also be set in SSHKEYSERVER_PASSWORD.")
+    parser.add_argument('--state', default='/var/lib/sshKeySync/state.json',
+                        help="The state file. Default: %(default)s")
+    parser.add_argument('--path-template', default=PATH_TEMPLATE,
+                        help="The authorized_keys path for a {user}. "
+                             "Default: %(default)s")
+    parser.add_argument('--all-users', action='store_true',
+                        help="Sync users without a local account as well.")
+    parser.add_argument('--timeout', type=int, default=60,
+                        help="Seconds to wait for changes per request.")
+    parser.add_argument('--once', action='store_true',
+                        help="Sync once and exit instead of running forever.")
+    parser.add_argument('-v', '--verbose', action='store_true')
+
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    """
+    Runs the sync agent.
+    """
+    args = parseArgs(argv)
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO,
+                        format="%(asctime)s %(levelname)s %(message)s")
+    auth = None
+    if args.user:
+        password = os.environ.get('SSHKEYSERVER_PASSWORD')
+        if args.password_file:
+            with open(args.password_file) as f:
+                password = f.read().strip()
+        auth = (args.user, password or '')
+
+    agent = SyncAgent(args.server, args.name, args.state, auth=auth,
+                      pathTemplate=args.path_template,
+                      pollTimeout=args.timeout,
+                      localUsers=not args.all_users)
+    if not args.once:
+        agent.run()
+    try:
+        written = agent.syncOnce()
+    except (RetryLater, IOError, ValueError, httplib.HTTPException) as exc:
+        logger.error("Sync failed: %s", exc)
+        return 1
+    finally:
+        agent.close()
+    logger.info("Sync done. %s files written.", written)
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""
+Tests the admission control rate limits and route caps.
+
+Run from the tests dir with: python -m unittest admissionTests
+"""
+
+import time
+import threading
+import unittest
+import cherrypy
+import requests
+from helpers import setupDatabase, startServer, stopServer, makeKey
+from lib import admission, keyManagement
+
+class TokenBucketsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.buckets = admission.TokenBuckets(maxBuckets=3)
+
+    def testTake(self):
+        take = self.buckets.take
+        self.assertEqual([take('a', 2, 3, now=10) for _ in range(3)],
+                         [0, 0, 0])
+        self.assertAlmostEqual(take('a', 2, 3, now=10), 0.5)
+        # Other clients have their own bucket
+        self.assertEqual(take('b', 2, 3, now=10), 0)
+        # Refilled at the rate, but never above the burst
+        self.assertEqual(take('a', 2, 3, now=10.5), 0)
+        self.assertAlmostEqual(take('a', 2, 3, now=10.5), 0.5)
+        self.assertEqual([take('a', 2, 3, now=100) for _ in range(4)][-1],
+                         0.5)
+
+    def testPrune(self):
+        take = self.buckets.take
+        take('a', 1, 2, now=10)
+        take('b', 1, 2, now=10)
+        take('c', 1, 2, now=10.5)
+        # 'a' and 'b' are full again at 11, and 'c' at 11.5
+        take('d', 1, 2, now=11)
+        self.assertEqual(sorted(self.buckets._buckets), ['c', 'd'])
+
+    def testEvictLeastRecentlyUsed(self):
+        take = self.buckets.take
+        # None of the buckets are full again before 20
+        for now, key in ((10, 'a'), (10.1, 'b'), (10.2, 'c'), (10.3, 'a')):
+            take(key, 1, 10, now=now)
+        take('d', 1, 10, now=10.4)
+        self.assertEqual(sorted(self.buckets._buckets), ['a', 'c', 'd'])
+        # Far more clients than buckets
+        for n in range(100):
+            take(n, 1, 10, now=11 + n / 1000.0)
+            self.assertLessEqual(len(self.buckets), 3)
+        self.assertIn(99, self.buckets._buckets)
+        # An evicted client starts over with a full bucket
+        self.assertEqual(take('a', 1, 10, now=12), 0)
+
+class InFlightTests(unittest.TestCase):
+
+    def testEnterAndLeave(self):
+        inFlight = admission.InFlight()
+        self.assertTrue(inFlight.enter('A', 2))
+        self.assertTrue(inFlight.enter('A', 2))
+        self.assertFalse(inFlight.enter('A', 2))
+        self.assertTrue(inFlight.enter('B', 2))
+        inFlight.leave('A')
+        self.assertEqual(inFlight.counts(), {'A': 1, 'B': 1})
+        self.assertTrue(inFlight.enter('A', 2))
+
+class AdmissionAPITests(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        setupDatabase()
+        keyManagement.addUserAndKey('user@host.api.tld', makeKey('api'))
+        cls.baseURI = startServer()
+        cls.auth = ('admin', 'admin')
+        cls.app = cherrypy.tree.apps['/api']
+        cls.saved = dict(cls.app.config['/'])
+
+    @classmethod
+    def tearDownClass(cls):
+        stopServer()
+        cls.app.config['/'] = cls.saved
+
+    def setUp(self):
+        admission.buckets = admission.TokenBuckets()
+
+    def configure(self, path='/', **settings):
+        self.app.merge({path: dict(('tools.admission.' + k, v)
+                                   for k, v in settings.items())})
+
+    def get(self, path='/key/user@host.api.tld', auth=None):
+        return requests.get(self.baseURI + '/api' + path,
+                            auth=auth or self.auth)
+
+    def testUserRate(self):
+        self.configure(userRead=(0.5, 2), userWrite=None)
+        self.assertEqual([self.get().status_code for _ in range(2)],
+                         [200, 200])
+        res = self.get()
+        self.assertEqual(res.status_code, 429)
+        self.assertEqual(res.headers['Retry-After'], '2')
+        self.assertEqual(res.json()['errorInfo'],
+                         {'limit': 'user', 'retryAfter': 2})
+        # Writes have their own bucket
+        res = requests.post(self.baseURI + '/api/key/new@host.api.tld',
+                            data={'key': makeKey('new')}, auth=self.auth)
+        self.assertEqual(res.status_code, 200)
+        self.configure(userRead=(50, 500))
+
+    def testIpRate(self):
+        # Checked before authentication
+        self.configure(ipRead=(0.5, 1))
+        self.assertEqual(self.get(auth=('admin', 'wrong')).status_code, 401)
+        res = self.get()
+        self.assertEqual(res.status_code, 429)
+        self.assertEqual(res.json()['errorInfo']['limit'], 'ip')
+        self.configure(ipRead=(200, 2000))
+
+    def testInFlight(self):
+        self.configure('/changes', maxInFlight=1)
+        polling = threading.Thread(
+            target=requests.get, args=(self.baseURI + '/api/changes',),
+            kwargs={'params': {'since': 1000, 'timeout': 1},
+                    'auth': self.auth})
+        polling.start()
+        try:
+            deadline = time.time() + 5
+            while not admission.inFlight.counts().get('Changes'):
+                self.assertLess(time.time(), deadline)
+                time.sleep(0.01)
+            res = self.get('/changes?since=0')
+            self.assertEqual(res.status_code, 503)
+            self.assertEqual(res.headers['Retry-After'], '1')
+            self.assertEqual(res.json()['errorInfo']['limit'], 'inFlight')
+            # Other routes are not affected
+            self.assertEqual(self.get().status_code, 200)
+        finally:
+            polling.join()
+            del self.app.config['/changes']
+        self.assertEqual(admission.inFlight.counts()['Changes'], 0)
+
+    def testMetrics(self):
+        self.configure(userRead=(0.5, 1))
+        self.get()
+        self.get()
+        text = requests.get(self.baseURI + '/metrics').text
+        self.assertIn('admission_rejected_total{limit="user",route="Key"}',
+                      text)
+        self.assertIn('http_requests_total{route="Key",method="GET",'
+                      'status="429"}', text)
+        self.assertIn('admission_buckets ', text)
+        self.configure(userRead=(50, 500))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks authenticated request throughput with and without the verified
+credentials cache in lib.auth.
+
+Every request without the cache pays for a full PBKDF2 password hash, while
+repeat requests with the cache only need an HMAC and a cache lookup.
+
+Usage: python authBench.py [numRequests]
+"""
+
+import sys
+import requests
+from helpers import setupDatabase, startServer, stopServer, makeKey, timeit
+from lib import auth, keyManagement
+
+def getThroughput(baseURI, count):
+    """
+    Returns authenticated GETs per second for L{count} key requests.
+    """
+    session = requests.Session()
+    session.auth = ('admin', 'admin')
+    uri = "{0}/api/key/bench@host.auth.tld".format(baseURI)
+
+    def get(n):
+        r = session.get(uri)
+        r.raise_for_status()
+
+    return timeit(get, count)
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+
+    setupDatabase()
+    keyManagement.addUserAndKey('bench@host.auth.tld', makeKey('bench'))
+    cache = auth.verifiedCache
+    baseURI = startServer()
+    try:
+        auth.verifiedCache = None
+        # Every request hashes, so fewer requests are enough
+        uncached = getThroughput(baseURI, max(count // 20, 5))
+        auth.verifiedCache = cache
+        cached = getThroughput(baseURI, count)
+    finally:
+        auth.verifiedCache = cache
+        stopServer()
+
+    print "Authenticated GET throughput ({0} PBKDF2 iterations):".format(
+            auth.iterations)
+    print "  no cache: {0:8.1f} req/s".format(uncached)
+    print "  cache:    {0:8.1f} req/s".format(cached)
+    print "  cache stats: {0}".format(cache.stats())
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""
+Tests the API credential store.
+
+Run from the tests dir with: python -m unittest authTests
+"""
+
+import unittest
+from helpers import setupDatabase, QueryCounter
+from lib import auth
+
+class CredentialTests(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        setupDatabase()
+        # Keep the tests fast
+        cls.iterations = auth.iterations
+        auth.iterations = 1000
+        auth.setPassword('alice', 'secret')
+
+    @classmethod
+    def tearDownClass(cls):
+        auth.iterations = cls.iterations
+
+    def setUp(self):
+        auth.verifiedCache.clear()
+
+    def testHash(self):
+        pwHash = auth.hashPassword('secret')
+        self.assertTrue(pwHash.startswith('pbkdf2_sha256$1000$'))
+        self.assertNotIn('secret', pwHash)
+        self.assertNotEqual(pwHash, auth.hashPassword('secret'))
+        self.assertTrue(auth.checkPassword('secret', pwHash))
+        self.assertFalse(auth.checkPassword('wrong', pwHash))
+        self.assertFalse(auth.checkPassword('secret', 'garbage'))
+
+    def testValidate(self):
+        self.assertTrue(auth.validate_password('localhost', 'alice', 'secret'))
+        self.assertFalse(auth.validate_password('localhost', 'alice', 'wrong'))
+        self.assertFalse(auth.validate_password('localhost', 'bob', 'secret'))
+
+    def testCacheSkipsLookup(self):
+        auth.validate_password('localhost', 'alice', 'secret')
+        with QueryCounter() as qc:
+            self.assertTrue(
+                auth.validate_password('localhost', 'alice', 'secret'))
+        self.assertEqual(qc.count, 0)
+
+    def testFailuresNotCached(self):
+        auth.validate_password('localhost', 'alice', 'wrong')
+        self.assertEqual(len(auth.verifiedCache), 0)
+
+    def testPasswordChange(self):
+        auth.setPassword('carol', 'old')
+        self.assertTrue(auth.validate_password('localhost', 'carol', 'old'))
+        auth.setPassword('carol', 'new')
+        self.assertFalse(auth.validate_password('localhost', 'carol', 'old'))
+        self.assertTrue(auth.validate_password('localhost', 'carol', 'new'))
+        self.assertTrue(auth.deleteUser('carol'))
+        self.assertFalse(auth.validate_password('localhost', 'carol', 'new'))
+
+    def testHA1(self):
+        self.assertEqual(auth.get_ha1('localhost', 'alice'),
+                         auth.digestHA1('alice', 'secret', 'localhost'))
+        self.assertIsNone(auth.get_ha1('elsewhere', 'alice'))
+        self.assertIsNone(auth.get_ha1('localhost', 'bob'))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""
+Tests rendering and storing authorized_keys files.
+
+Run from the tests dir with: python -m unittest authorizedKeysTests
+"""
+
+import unittest
+import requests
+from helpers import setupDatabase, startServer, stopServer, makeKey, \
+        QueryCounter
+from lib import keyManagement, database as db
+
+def addAuthorized(ownerUhd, count, options=None):
+    """
+    Adds L{count} authorized users, each on their own host in their own domain,
+    to the authorized_keys file for L{ownerUhd}.
+    """
+    owner = keyManagement.addUserAndKey(ownerUhd, makeKey(ownerUhd))
+    for n in range(count):
+        uhd = "user{0}@host{0}.{1}".format(n, ownerUhd.replace('@', '-'))
+        user = keyManagement.addUserAndKey(uhd, makeKey(n))
+        db.AuthorizedKeys.create(owner=owner, authedUser=user, options=options)
+
+class RenderAuthorizedKeysTests(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        setupDatabase()
+        addAuthorized('one@owner.tld', 1)
+        addAuthorized('many@owner.tld', 25, options='no-pty')
+        keyManagement.addUserAndKey('none@owner.tld', makeKey('none'))
+
+    def testRender(self):
+        _, _, content = keyManagement.renderAuthorizedKeys('one@owner.tld')
+        self.assertEqual(content, "# user0@host0.one-owner.tld\n"
+                                  "{0}\n".format(makeKey(0)))
+
+    def testOptions(self):
+        _, _, content = keyManagement.renderAuthorizedKeys('many@owner.tld')
+        lines = content.splitlines()
+        self.assertEqual(len(lines), 50)
+        self.assertEqual(lines[-1], "no-pty " + makeKey(24))
+
+    def testEmpty(self):
+        _, _, content = keyManagement.renderAuthorizedKeys('none@owner.tld')
+        self.assertEqual(content, "")
+
+    def testUnknownOwner(self):
+        self.assertIsNone(
+            keyManagement.renderAuthorizedKeys('nobody@owner.tld'))
+
+    def testInvalidUhd(self):
+        self.assertRaises(ValueError, keyManagement.renderAuthorizedKeys,
+                          'invalid')
+
+    def testConstantQueryCount(self):
+        counts = []
+        for uhd in ('none@owner.tld', 'one@owner.tld', 'many@owner.tld'):
+            with QueryCounter() as qc:
+                keyManagement.renderAuthorizedKeys(uhd)
+            counts.append(qc.count)
+        self.assertEqual(counts, [2, 2, 2])
+
+class StoredAuthorizedKeysTests(unittest.TestCase):
+
+    def setUp(self):
+        setupDatabase()
+        addAuthorized('owner@stored.tld', 3)
+        self.authed = 'user1@host1.owner-stored.tld'
+        # Changing an authorized user's key stores the file
+        keyManagement.addUserAndKey(self.authed, makeKey('new'),
+                                    allowUpdate=True)
+
+    def stored(self):
+        return [f.uhd for f in db.AuthorizedKeysFile.select()]
+
+    def testStored(self):
+        self.assertEqual(self.stored(), ['owner@stored.tld'])
+        with QueryCounter() as qc:
+            res = keyManagement.getAuthorizedKeys('owner@stored.tld')
+        self.assertEqual(qc.count, 1)
+        self.assertEqual(
+            res, keyManagement.renderAuthorizedKeys('owner@stored.tld'))
+        self.assertIn(makeKey('new'), res[2])
+        self.assertEqual(keyManagement.checkAuthorizedKeysFiles(), [])
+
+    def testEntriesChanged(self):
+        # Changing entries directly drops the stored file, so the file is
+        # rendered from the entries
+        owner = db.User.get(db.User.name=='owner')
+        extra = keyManagement.addUserAndKey('extra@stored.tld', makeKey('x'))
+        db.AuthorizedKeys.create(owner=owner, authedUser=extra)
+        self.assertEqual(self.stored(), [])
+        content = keyManagement.getAuthorizedKeys('owner@stored.tld')[2]
+        self.assertIn(makeKey('x'), content)
+
+        self.assertEqual(keyManagement.checkAuthorizedKeysFiles(),
+                         [('owner@stored.tld', 'missing')])
+        keyManagement.refreshAuthorizedKeys([owner.id])
+        self.assertEqual(keyManagement.checkAuthorizedKeysFiles(), [])
+
+        db.AuthorizedKeys.delete().where(db.AuthorizedKeys.owner==owner)\
+                .execute()
+        content = keyManagement.getAuthorizedKeys('owner@stored.tld')[2]
+        self.assertEqual(content, "")
+
+    def testAuthedUserDeleted(self):
+        db.User.delete().where(db.User.name=='user0').execute()
+        self.assertEqual(self.stored(), [])
+
+    def testCheck(self):
+        db.AuthorizedKeysFile.update(content='tampered').execute()
+        self.assertEqual(keyManagement.checkAuthorizedKeysFiles(),
+                         [('owner@stored.tld', 'stale')])
+        self.assertEqual(keyManagement.checkAuthorizedKeysFiles(fix=True),
+                         [('owner@stored.tld', 'stale')])
+        self.assertEqual(keyManagement.checkAuthorizedKeysFiles(), [])
+
+    def testRebuild(self):
+        addAuthorized('other@stored.tld', 2)
+        self.assertEqual(keyManagement.rebuildAuthorizedKeysFiles(batchSize=1),
+                         2)
+        self.assertEqual(sorted(self.stored()), ['other@stored.tld',
+                                                 'owner@stored.tld'])
+        self.assertEqual(keyManagement.checkAuthorizedKeysFiles(batchSize=2),
+                         [])
+
+class ConditionalGetTests(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        setupDatabase()
+        addAuthorized('owner@conditional.tld', 3)
+        keyManagement.addUserAndKey('none@conditional.tld', makeKey('none'))
+        cls.baseURI = startServer()
+
+    @classmethod
+    def tearDownClass(cls):
+        stopServer()
+
+    def get(self, headers=None, owner='owner@conditional.tld'):
+        return requests.get(self.baseURI + '/api/authorized_keys/' + owner,
+                            auth=('admin', 'admin'), headers=headers)
+
+    def testNotModifiedSkipsContent(self):
+        tag = self.get().headers['ETag']
+        with QueryCounter() as qc:
+            res = self.get({'If-None-Match': tag})
+        self.assertEqual(res.status_code, 304)
+        # Only the revision was looked up, and not the stored file
+        self.assertEqual(len(qc.statements), 1)
+        self.assertNotIn('authorizedkeysfile', qc.statements[0])
+
+    def testModified(self):
+        res = self.get({'If-None-Match': '"a0-0"'})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.text.count('# user'), 3)
+
+    def testRenderedModified(self):
+        # Owners without entries have no stored file, so it is rendered
+        owner = 'none@conditional.tld'
+        self.get(owner=owner)
+        with QueryCounter() as qc:
+            res = self.get({'If-None-Match': '"a0-0"'}, owner)
+        self.assertEqual(res.status_code, 200)
+        # The revision, the stored file and the entries, without looking the
+        # revision up again for rendering
+        self.assertEqual(len(qc.statements), 3)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+Tests online backups and restores.
+
+Run from the tests dir with: python -m unittest backupTests
+"""
+
+import os
+import glob
+import gzip
+import tempfile
+import threading
+import unittest
+import requests
+from helpers import setupDatabase, startServer, stopServer, makeKey
+from lib import auth, backup, keyManagement, database as db
+
+class BackupTests(unittest.TestCase):
+
+    def setUp(self):
+        setupDatabase()
+        keyManagement.addUserAndKey('before@host.backup.tld', makeKey(1))
+        fd, self.path = tempfile.mkstemp(suffix='.sqlite.gz')
+        os.close(fd)
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    def testBackupAndRestore(self):
+        size = backup.backup(self.path)
+        self.assertEqual(size, os.path.getsize(self.path))
+        self.assertEqual(backup.check(self.path), [])
+        keyManagement.addUserAndKey('after@host.backup.tld', makeKey(2))
+        # This process still has the database open
+        self.assertRaises(backup.BackupError, backup.restore, self.path)
+        db.closeConnections()
+        backup.restore(self.path)
+        db.setup()
+        self.assertIsNotNone(keyManagement.getKey('before@host.backup.tld'))
+        self.assertIsNone(keyManagement.getKey('after@host.backup.tld'))
+        self.assertEqual(keyManagement.checkAuthorizedKeysFiles(), [])
+
+    def testSnapshotRemoved(self):
+        pattern = os.path.join(os.path.dirname(db.path()), 'backup-*.sqlite')
+        before = set(glob.glob(pattern))
+        # Gone even if the backup is never read
+        body = backup.stream()
+        self.assertEqual(set(glob.glob(pattern)), before)
+        body.close()
+        body = backup.stream()
+        self.assertTrue(next(body).startswith(backup.GZIP_MAGIC))
+        del body
+        self.assertEqual(set(glob.glob(pattern)), before)
+
+    def testUncompressed(self):
+        backup.backup(self.path)
+        with gzip.open(self.path) as f:
+            data = f.read()
+        with open(self.path, 'wb') as f:
+            f.write(data)
+        self.assertEqual(backup.check(self.path), [])
+
+    def testWritesDuringBackup(self):
+        errors = []
+        done = threading.Event()
+
+        def write():
+            n = 0
+            try:
+                while not done.is_set():
+                    keyManagement.addUserAndKey(
+                        'user{0}@host.backup.tld'.format(n), makeKey(n))
+                    n += 1
+            except Exception, exc:
+                errors.append(exc)
+            finally:
+                db.closeThread()
+        writer = threading.Thread(target=write)
+        writer.start()
+        try:
+            for _ in range(3):
+                backup.backup(self.path)
+                self.assertEqual(backup.check(self.path), [])
+        finally:
+            done.set()
+            writer.join()
+        self.assertEqual(errors, [])
+
+    def testInvalid(self):
+        with open(self.path, 'wb') as f:
+            f.write('not a database' * 100)
+        self.assertNotEqual(backup.check(self.path), [])
+        with open(self.path, 'wb') as f:
+            f.write(backup.GZIP_MAGIC + 'truncated')
+        self.assertNotEqual(backup.check(self.path), [])
+        db.closeConnections()
+        self.assertRaises(backup.BackupError, backup.restore, self.path)
+        db.setup()
+        self.assertIsNotNone(keyManagement.getKey('before@host.backup.tld'))
+
+class BackupAPITests(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        setupDatabase()
+        keyManagement.addUserAndKey('user@host.backup.tld', makeKey(1))
+        auth.setPassword('reader', 'reader')
+        cls.baseURI = startServer()
+
+    @classmethod
+    def tearDownClass(cls):
+        stopServer()
+
+    def testGet(self):
+        res = requests.get(self.baseURI + '/api/backup', auth=('admin', 'admin'),
+                           stream=True)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['Content-Type'], 'application/gzip')
+        fd, path = tempfile.mkstemp(suffix='.sqlite.gz')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in res.raw.stream(65536, decode_content=False):
+                    f.write(chunk)
+            self.assertEqual(backup.check(path), [])
+        finally:
+            os.unlink(path)
+
+    def testOperatorsOnly(self):
+        res = requests.get(self.baseURI + '/api/backup',
+                           auth=('reader', 'reader'))
+        self.assertEqual(res.status_code, 403)
+        self.assertNotEqual(res.headers['Content-Type'], 'application/gzip')
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,336 @@
+# -*- coding: utf-8 -*-
+"""
+API load testing and benchmark suite.
+
+Starts the application in-process on an ephemeral port against a temporary
+database, seeds it with a dataset of domains x hosts x users, with a number of
+authorized_keys entries per user, and then drives concurrent read, write and
+mixed workloads against the API.
+
+Throughput and p50/p95/p99 latencies are reported per endpoint for every
+workload, and can be written as JSON. In compare mode, the results are checked
+against a stored baseline, and the exit status is 1 if any endpoint regressed
+by more than the threshold.
+
+Usage:
+    python benchSuite.py [options]
+    python benchSuite.py --output baseline.json
+    python benchSuite.py --compare baseline.json --threshold 15
+
+Run with -h for all options.
+"""
+
+import sys
+import json
+import time
+import random
+import urllib
+import httplib
+import argparse
+import threading
+from helpers import setupDatabase, startServer, stopServer, makeKey
+from lib import keyManagement, sshKey, database as db
+
+#: The available workloads, as (endpoint, weight) tuples. Endpoints are picked
+#: at random in proportion to their weights.
+WORKLOADS = {
+    'read': [('key.get', 50), ('authorized_keys.get', 30),
+             ('fingerprint.get', 10), ('keys.list', 10)],
+    'write': [('key.post', 1)],
+    'mixed': [('key.get', 45), ('authorized_keys.get', 25),
+              ('fingerprint.get', 5), ('keys.list', 5), ('key.post', 20)],
+}
+
+#: The metrics compared against the baseline, and if a higher value is better
+COMPARED = (('throughput', True), ('p95', False), ('p99', False))
+
+class Dataset(object):
+    """
+    The seeded dataset, and the request generators for the endpoints.
+    """
+
+    def __init__(self, domains, hosts, users, authorized):
+        """
+        Instance initialization.
+
+        @param domains: The number of domains.
+        @param hosts: The number of hosts per domain.
+        @param users: The number of users per host.
+        @param authorized: The number of authorized_keys entries per user.
+        """
+        self.domains = domains
+        self.hosts = hosts
+        self.users = users
+        self.authorized = authorized
+        self.total = domains * hosts * users
+        # New users added by the write workloads
+        self._added = 0
+        self._lock = threading.Lock()
+
+    def uhd(self, n):
+        """
+        Returns the user@host.domain for seeded user L{n}.
+        """
+        u, n = n % self.users, n // self.users
+        return "user{0}@host{1}.dom{2}.bench".format(u, n % self.hosts,
+                                                     n // self.hosts)
+
+    def seed(self):
+        """
+        Seeds the database.
+        """
+        records = ({'uhd': self.uhd(n), 'key': makeKey(n)}
+                   for n in xrange(self.total))
+        res = keyManagement.bulkAddUsersAndKeys(records)
+        assert res['summary']['added'] == self.total, res['summary']
+
+        ids = [i for i, in db.User.select(db.User.id)
+                                  .order_by(db.User.id).tuples()]
+        rows = [{'owner': ids[n], 'authedUser': ids[(n + m) % len(ids)]}
+                for n in xrange(len(ids))
+                for m in range(1, self.authorized + 1)]
+        with db.transaction():
+            for start in xrange(0, len(rows), 400):
+                db.AuthorizedKeys.insert_many(rows[start:start+400]).execute()
+
+    def request(self, endpoint, rnd):
+        """
+        Returns the (method, path, body) for a request to L{endpoint}.
+        """
+        if endpoint == 'key.get':
+            return 'GET', '/api/key/' + self.uhd(rnd.randrange(self.total)), \
+                   None
+        if endpoint == 'authorized_keys.get':
+            return 'GET', '/api/authorized_keys/' + \
+                   self.uhd(rnd.randrange(self.total)), None
+        if endpoint == 'fingerprint.get':
+            blob = sshKey.parse(makeKey(rnd.randrange(self.total)))[1]
+            return 'GET', '/api/fingerprint/' + \
+                   urllib.quote(sshKey.fingerprint(blob), safe=':'), None
+        if endpoint == 'keys.list':
+            dom = "dom{0}.bench".format(rnd.randrange(self.domains))
+            return 'GET', '/api/keys?limit=100&domain=' + dom, None
+        if endpoint == 'key.post':
+            with self._lock:
+                self._added += 1
+                n = self._added
+            uhd = "new{0}@host{1}.dom{2}.bench".format(
+                    n, n % self.hosts, n % self.domains)
+            return 'POST', '/api/key/' + uhd, \
+                   urllib.urlencode({'key': makeKey(uhd)})
+        raise ValueError("Unknown endpoint: {0}".format(endpoint))
+
+def percentile(times, pct):
+    """
+    Returns the nearest rank percentile of the sorted L{times}.
+    """
+    return times[max(0, min(len(times) - 1,
+                            int(round(len(times) * pct / 100.0)) - 1))]
+
+def stats(times, errors, elapsed):
+    """
+    Returns the stats dictionary for a list of latencies in seconds.
+    """
+    times = sorted(times)
+    res = {'requests': len(times), 'errors': errors,
+           'throughput': round(len(times) / elapsed, 2)}
+    if times:
+        for pct in (50, 95, 99):
+            res['p{0}'.format(pct)] = round(percentile(times, pct) * 1000, 3)
+        res['max'] = round(times[-1] * 1000, 3)
+
+    return res
+
+def runWorkload(baseURI, dataset, workload, clients, duration):
+    """
+    Drives a workload with L{clients} concurrent keep-alive clients for
+    L{duration} seconds.
+
+    @return: The workload results, with the stats per endpoint, and for all
+        requests together.
+    """
+    host = baseURI.split('//')[1]
+    auth = 'Basic ' + 'admin:admin'.encode('base64').strip()
+    endpoints = WORKLOADS[workload]
+    choices = [e for e, weight in endpoints for _ in range(weight)]
+    times = dict((e, []) for e, _ in endpoints)
+    errors = dict((e, 0) for e, _ in endpoints)
+    lock = threading.Lock()
+    stop = time.time() + duration
+
+    def client(idx):
+        conn = httplib.HTTPConnection(host)
+        rnd = random.Random(idx)
+        mine = dict((e, []) for e, _ in endpoints)
+        failed = dict((e, 0) for e, _ in endpoints)
+        while time.time() < stop:
+            endpoint = rnd.choice(choices)
+            method, path, body = dataset.request(endpoint, rnd)
+            headers = {'Authorization': auth}
+            if body is not None:
+                headers['Content-Type'] = 'application/x-www-form-urlencoded'
+            start = time.time()
+            try:
+                conn.request(method, path, body, headers)
+                resp = conn.getresponse()
+                resp.read()
+                ok = resp.status == 200
+            except (httplib.HTTPException, IOError):
+                conn.close()
+                conn = httplib.HTTPConnection(host)
+                ok = False
+            if ok:
+                mine[endpoint].append(time.time() - start)
+            else:
+                failed[endpoint] += 1
+        with lock:
+            for e in mine:
+                times[e].extend(mine[e])
+                errors[e] += failed[e]
+
+    threads = [threading.Thread(target=client, args=(n,))
+               for n in range(clients)]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start
+
+    res = {'endpoints': dict((e, stats(times[e], errors[e], elapsed))
+                             for e in times)}
+    res['total'] = stats([t for e in times for t in times[e]],
+                         sum(errors.values()), elapsed)
+
+    return res
+
+def compare(results, baseline, threshold):
+    """
+    Compares results against a baseline.
+
+    @param threshold: The percentage an endpoint metric may be worse than the
+           baseline before it is flagged as a regression.
+
+    @return: A list of (workload, endpoint, metric, baseline, current, change)
+        tuples for the regressions found.
+    """
+    regressions = []
+    for workload, res in sorted(results['workloads'].items()):
+        base = baseline.get('workloads', {}).get(workload)
+        if base is None:
+            continue
+        for endpoint, current in sorted(res['endpoints'].items()):
+            old = base['endpoints'].get(endpoint)
+            if old is None:
+                continue
+            for metric, higherIsBetter in COMPARED:
+                if not old.get(metric) or metric not in current:
+                    continue
+                change = (current[metric] - old[metric]) * 100.0 / old[metric]
+                if (-change if higherIsBetter else change) > threshold:
+                    regressions.append((workload, endpoint, metric,
+                                        old[metric], current[metric], change))
+
+    return regressions
+
+def report(results):
+    """
+    Prints the results as tables.
+    """
+    for workload, res in sorted(results['workloads'].items()):
+        print "Workload: {0}".format(workload)
+        print "  {0:<22} {1:>8} {2:>7} {3:>9} {4:>8} {5:>8} {6:>8}".format(
+                'endpoint', 'requests', 'errors', 'req/s', 'p50 ms',
+                'p95 ms', 'p99 ms')
+        rows = sorted(res['endpoints'].items()) + [('total', res['total'])]
+        for endpoint, s in rows:
+            print "  {0:<22} {1:>8} {2:>7} {3:>9.1f} {4:>8} {5:>8} " \
+                  "{6:>8}".format(endpoint, s['requests'], s['errors'],
+                                  s['throughput'], s.get('p50', '-'),
+                                  s.get('p95', '-'), s.get('p99', '-'))
+
+def parseArgs(argv=None):
+    """
+    Parses command line args.
+    """
+    parser = argparse.ArgumentParser(description="API benchmark suite.")
+    parser.add_argument('--domains', type=int, default=10)
+    parser.add_argument('--hosts', type=int, default=10,
+                        help="Hosts per domain.")
+    parser.add_argument('--users', type=int, default=20,
+                        help="Users per host.")
+    parser.add_argument('--authorized', type=int, default=5,
+                        help="authorized_keys entries per user.")
+    parser.add_argument('--workload', action='append',
+                        choices=sorted(WORKLOADS),
+                        help="Workload to run. May be repeated. Default: all.")
+    parser.add_argument('--clients', type=int, default=8,
+                        help="Concurrent clients.")
+    parser.add_argument('--duration', type=float, default=10,
+                        help="Seconds per workload.")
+    parser.add_argument('--threads', type=int, default=10,
+                        help="Server worker threads.")
+    parser.add_argument('--output', help="Write the results JSON here.")
+    parser.add_argument('--compare', metavar='BASELINE',
+                        help="Compare against this baseline results JSON.")
+    parser.add_argument('--threshold', type=float, default=10,
+                        help="Regression threshold in percent.")
+
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parseArgs(argv)
+    dataset = Dataset(args.domains, args.hosts, args.users, args.authorized)
+
+    setupDatabase()
+    start = time.time()
+    dataset.seed()
+    seedTime = time.time() - start
+
+    results = {'config': {'domains': args.domains, 'hosts': args.hosts,
+                          'users': args.users,
+                          'authorized': args.authorized,
+                          'clients': args.clients,
+                          'duration': args.duration,
+                          'threads': args.threads},
+               'seedSeconds': round(seedTime, 2),
+               'workloads': {}}
+
+    baseURI = startServer(threads=args.threads)
+    try:
+        # The first request pays for the password hash, so that is kept out of
+        # the measurements
+        warmUp = httplib.HTTPConnection(baseURI.split('//')[1])
+        warmUp.request('GET', '/api/key/' + dataset.uhd(0), headers={
+            'Authorization': 'Basic ' + 'admin:admin'.encode('base64').strip()})
+        warmUp.getresponse().read()
+        warmUp.close()
+        for workload in args.workload or sorted(WORKLOADS):
+            results['workloads'][workload] = runWorkload(
+                    baseURI, dataset, workload, args.clients, args.duration)
+    finally:
+        stopServer()
+
+    report(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get('config') != results['config']:
+            print "WARNING: Baseline was run with a different config."
+        regressions = compare(results, baseline, args.threshold)
+        for workload, endpoint, metric, old, new, change in regressions:
+            print "REGRESSION: {0} {1} {2}: {3} -> {4} ({5:+.1f}%)".format(
+                    workload, endpoint, metric, old, new, change)
+        if regressions:
+            return 1
+        print "No regressions over {0}% against {1}".format(args.threshold,
+                                                             args.compare)
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""
+Tests bulk key imports, and the streaming JSON record decoder they use.
+
+Run from the tests dir with: python -m unittest bulkTests
+"""
+
+import json
+import unittest
+import requests
+from StringIO import StringIO
+from helpers import setupDatabase, startServer, stopServer, makeKey
+from lib import iterJsonRecords, keyManagement, database as db
+
+def record(name, seed=None):
+    """
+    Returns a bulk import record for the user L{name} on the bulk.tld test
+    host.
+    """
+    return {'uhd': '{0}@host.bulk.tld'.format(name),
+            'key': makeKey(name if seed is None else seed)}
+
+def statuses(result):
+    """
+    Returns the status of each record in the bulk import L{result}.
+    """
+    return [res['status'] for res in result['results']]
+
+class IterJsonRecordsTests(unittest.TestCase):
+
+    records = [{'a': 1}, {'b': [1, 2]}, {'c': u'\xe9'}]
+
+    def testNdjson(self):
+        data = '\n'.join(json.dumps(r) for r in self.records) + '\n'
+        self.assertEqual(list(iterJsonRecords(StringIO(data), blockSize=3)),
+                         self.records)
+
+    def testArray(self):
+        data = json.dumps(self.records, indent=2)
+        self.assertEqual(list(iterJsonRecords(StringIO(data), blockSize=3)),
+                         self.records)
+        self.assertEqual(list(iterJsonRecords(StringIO('[]'))), [])
+
+    def testInvalid(self):
+        records = iterJsonRecords(StringIO('{"a": 1}\n{"b": '))
+        self.assertEqual(next(records), {'a': 1})
+        self.assertRaises(ValueError, next, records)
+
+class BulkAddTests(unittest.TestCase):
+
+    def setUp(self):
+        setupDatabase()
+        keyManagement.keyCache.clear()
+        keyManagement.addUserAndKey(record('old')['uhd'], makeKey('old'))
+
+    def key(self, name):
+        row = keyManagement.getKey(record(name)['uhd'])
+        return row[2] if row else None
+
+    def testSkip(self):
+        result = keyManagement.bulkAddUsersAndKeys(
+            [record('new'), record('old', 'bulk')], policy='skip')
+        self.assertEqual(statuses(result), ['added', 'skipped'])
+        self.assertEqual(result['summary']['added'], 1)
+        self.assertEqual(result['summary']['skipped'], 1)
+        self.assertFalse(result['aborted'])
+        self.assertEqual(self.key('new'), makeKey('new'))
+        self.assertEqual(self.key('old'), makeKey('old'))
+
+    def testUpdate(self):
+        # The cached key must be dropped by the update
+        self.assertEqual(self.key('old'), makeKey('old'))
+        result = keyManagement.bulkAddUsersAndKeys(
+            [record('new'), record('old', 'bulk')], policy='update')
+        self.assertEqual(statuses(result), ['added', 'updated'])
+        self.assertEqual(self.key('old'), makeKey('bulk'))
+        self.assertEqual(keyManagement.getKey(record('old')['uhd'])[1], 2)
+
+    def testFail(self):
+        records = [record('new0'), record('new1'), record('new2'),
+                   record('old', 'bulk'), record('new4')]
+        result = keyManagement.bulkAddUsersAndKeys(records, policy='fail',
+                                                   chunkSize=2)
+        # The first chunk was committed, the second one rolled back, and the
+        # import stopped at the conflict
+        self.assertTrue(result['aborted'])
+        self.assertEqual(statuses(result),
+                         ['added', 'added', 'rolledBack', 'failed'])
+        self.assertEqual(self.key('new1'), makeKey('new1'))
+        self.assertIsNone(self.key('new2'))
+        self.assertIsNone(self.key('new4'))
+        self.assertEqual(self.key('old'), makeKey('old'))
+
+    def testDryRun(self):
+        self.assertEqual(self.key('old'), makeKey('old'))
+        users = db.User.select().count()
+        result = keyManagement.bulkAddUsersAndKeys(
+            [record('new'), record('old', 'bulk')], policy='update',
+            dryRun=True)
+        self.assertTrue(result['dryRun'])
+        self.assertEqual(statuses(result), ['added', 'updated'])
+        self.assertEqual(db.User.select().count(), users)
+        self.assertIsNone(self.key('new'))
+        self.assertEqual(self.key('old'), makeKey('old'))
+
+    def testInvalidRecords(self):
+        result = keyManagement.bulkAddUsersAndKeys(
+            [record('new'), 'not an object', {'uhd': 'invalid'},
+             {'uhd': record('nokey')['uhd']},
+             {'uhd': record('badkey')['uhd'], 'key': 'not a key'}])
+        self.assertEqual(statuses(result),
+                         ['added', 'failed', 'failed', 'failed', 'failed'])
+        self.assertEqual(result['summary']['failed'], 4)
+        self.assertFalse(result['aborted'])
+        self.assertEqual(self.key('new'), makeKey('new'))
+
+    def testInvalidPolicy(self):
+        self.assertRaises(ValueError, keyManagement.bulkAddUsersAndKeys,
+                          [record('new')], policy='merge')
+
+class BulkAPITests(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        setupDatabase()
+        cls.baseURI = startServer()
+
+    @classmethod
+    def tearDownClass(cls):
+        stopServer()
+
+    def post(self, data, **params):
+        return requests.post(self.baseURI + '/api/keys/bulk', data=data,
+                             params=params, auth=('admin', 'admin'))
+
+    def testNdjson(self):
+        data = '\n'.join(json.dumps(record('nd{0}'.format(n)))
+                         for n in range(3))
+        res = self.post(data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.json()['summary']['added'], 3)
+        self.assertIsNotNone(keyManagement.getKey(record('nd2')['uhd']))
+
+    def testArray(self):
+        data = json.dumps([record('array{0}'.format(n)) for n in range(3)])
+        res = self.post(data, policy='update')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(statuses(res.json()), ['added'] * 3)
+
+    def testDryRun(self):
+        res = self.post(json.dumps([record('dry')]), dryRun='true')
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(res.json()['dryRun'])
+        self.assertIsNone(keyManagement.getKey(record('dry')['uhd']))
+
+    def testMalformed(self):
+        data = json.dumps(record('valid')) + '\n[1, 2]\n{"uhd": '
+        res = self.post(data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(statuses(res.json()), ['added', 'failed', 'failed'])
+        self.assertTrue(res.json()['aborted'])
+
+    def testInvalidPolicy(self):
+        res = self.post(json.dumps([record('policy')]), policy='merge')
+        self.assertEqual(res.status_code, 400)
+        self.assertIsNone(keyManagement.getKey(record('policy')['uhd']))
+
+if __name__ == "__main__":
+    unittest.main()
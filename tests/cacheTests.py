@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""
+Tests the LRU cache, and the key cache in front of the key lookups.
+
+Run from the tests dir with: python -m unittest cacheTests
+"""
+
+import time
+import unittest
+from helpers import setupDatabase, makeKey, QueryCounter
+from lib import keyManagement
+from lib.cache import LRUCache
+
+class LRUCacheTests(unittest.TestCase):
+
+    def testEviction(self):
+        cache = LRUCache(maxSize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        # Using 'a' makes 'b' the least recently used entry
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def testTtl(self):
+        cache = LRUCache(ttl=0.05)
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+        time.sleep(0.1)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.stats()['expirations'], 1)
+
+    def testInvalidate(self):
+        cache = LRUCache()
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.invalidate('a')
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get('b'), 2)
+        cache.clear()
+        self.assertIsNone(cache.get('b'))
+
+    def testStaleSet(self):
+        cache = LRUCache()
+        version = cache.version()
+        # Invalidated while the value was read, even if it was not cached
+        cache.invalidate('a')
+        cache.set('a', 'stale', version)
+        self.assertIsNone(cache.get('a'))
+        version = cache.version()
+        cache.set('a', 'fresh', version)
+        self.assertEqual(cache.get('a'), 'fresh')
+
+class KeyCacheTests(unittest.TestCase):
+
+    uhd = 'user@host.cache.tld'
+
+    def setUp(self):
+        setupDatabase()
+        keyManagement.keyCache.clear()
+        keyManagement.addUserAndKey(self.uhd, makeKey('old'))
+
+    def testHitSkipsDatabase(self):
+        keyManagement.getKey(self.uhd)
+        with QueryCounter() as qc:
+            self.assertEqual(keyManagement.getKey(self.uhd)[2], makeKey('old'))
+            self.assertEqual(keyManagement.keyRevision(self.uhd)[1], 1)
+        self.assertEqual(qc.count, 0)
+
+    def testUnknownNotCached(self):
+        uhd = 'new@host.cache.tld'
+        self.assertIsNone(keyManagement.getKey(uhd))
+        keyManagement.addUserAndKey(uhd, makeKey('new'))
+        self.assertEqual(keyManagement.getKey(uhd)[2], makeKey('new'))
+
+    def testInvalidatedOnUpdate(self):
+        keyManagement.getKey(self.uhd)
+        keyManagement.addUserAndKey(self.uhd, makeKey('new'), allowUpdate=True)
+        self.assertEqual(keyManagement.getKey(self.uhd)[1:], (2, makeKey('new')))
+
+    def testInvalidatedOnBulkUpdate(self):
+        keyManagement.getKey(self.uhd)
+        keyManagement.bulkAddUsersAndKeys(
+            [{'uhd': self.uhd, 'key': makeKey('bulk')}], policy='update')
+        self.assertEqual(keyManagement.getKey(self.uhd)[2], makeKey('bulk'))
+
+    def testUpdateDuringMiss(self):
+        query = keyManagement._keyQuery
+
+        class Racing(object):
+            """
+            Runs the key lookup, and then updates the key before the caller
+            caches the row read.
+            """
+            def scalar(inner, **values):
+                row = query.scalar(**values)
+                keyManagement.addUserAndKey(self.uhd, makeKey('new'),
+                                            allowUpdate=True)
+                return row
+        keyManagement._keyQuery = Racing()
+        try:
+            self.assertEqual(keyManagement.getKey(self.uhd)[2], makeKey('old'))
+        finally:
+            keyManagement._keyQuery = query
+        # The row read before the update was not cached
+        self.assertEqual(keyManagement.getKey(self.uhd)[1:], (2, makeKey('new')))
+        self.assertEqual(keyManagement.keyRevision(self.uhd)[1], 2)
+
+if __name__ == "__main__":
+    unittest.main()
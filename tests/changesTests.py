@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""
+Tests the change log and the long-polling change feed API.
+
+Run from the tests dir with: python -m unittest changesTests
+"""
+
+import time
+import threading
+import unittest
+import requests
+from helpers import setupDatabase, startServer, stopServer, makeKey
+from lib import changes, keyManagement, database as db
+
+def latest():
+    """
+    Returns the last sequence number in the change log.
+    """
+    return changes.bounds()[1] or 0
+
+class ChangeLogTests(unittest.TestCase):
+
+    def setUp(self):
+        setupDatabase()
+
+    def testAddAndUpdate(self):
+        owner = keyManagement.addUserAndKey('owner@host.log.tld', makeKey(1))
+        user = keyManagement.addUserAndKey('user@host.log.tld', makeKey(2))
+        db.AuthorizedKeys.create(owner=owner, authedUser=user)
+        since = latest()
+        keyManagement.addUserAndKey('user@host.log.tld', makeKey(3),
+                                    allowUpdate=True)
+
+        res = changes.changesSince(since)
+        self.assertEqual([(c['kind'], c['uhd']) for c in res['changes']],
+                         [('key', 'user@host.log.tld'),
+                          ('authorized_keys', 'owner@host.log.tld')])
+        self.assertEqual(res['changes'][0]['key'], makeKey(3))
+        self.assertEqual(res['next'], since + 2)
+        self.assertFalse(res['more'])
+
+    def testBulk(self):
+        keyManagement.addUserAndKey('user0@host.bulk.tld', makeKey(0))
+        since = latest()
+        records = [{'uhd': 'user{0}@host.bulk.tld'.format(n),
+                    'key': makeKey(n + 10)} for n in range(3)]
+        keyManagement.bulkAddUsersAndKeys(records, policy='update')
+
+        uhds = [c['uhd'] for c in changes.changesSince(since)['changes']]
+        self.assertEqual(sorted(uhds), ['user{0}@host.bulk.tld'.format(n)
+                                        for n in range(3)])
+
+    def testRolledBack(self):
+        since = latest()
+        records = [{'uhd': 'new@host.dry.tld', 'key': makeKey('dry')}]
+        keyManagement.bulkAddUsersAndKeys(records, dryRun=True)
+        self.assertEqual(latest(), since)
+
+    def testScopes(self):
+        for uhd in ('a@one.x.tld', 'b@two.x.tld', 'c@one.y.tld'):
+            keyManagement.addUserAndKey(uhd, makeKey(uhd))
+
+        def uhds(scope, name):
+            return [c['uhd'] for c in
+                    changes.changesSince(0, scope, name)['changes']]
+        self.assertEqual(uhds('domain', 'x.tld'), ['a@one.x.tld',
+                                                   'b@two.x.tld'])
+        self.assertEqual(uhds('host', 'one.y.tld'), ['c@one.y.tld'])
+        # Changes out of scope still move the position on
+        self.assertEqual(changes.changesSince(0, 'host', 'one.x.tld')['next'],
+                         latest())
+        self.assertRaises(ValueError, changes.changesSince, 0, 'user', 'a')
+        self.assertRaises(ValueError, changes.changesSince, 0, 'host', 'one')
+
+    def testLimit(self):
+        for n in range(5):
+            keyManagement.addUserAndKey('u{0}@host.limit.tld'.format(n),
+                                        makeKey(n))
+        res = changes.changesSince(0, limit=3)
+        self.assertEqual(len(res['changes']), 3)
+        self.assertTrue(res['more'])
+        self.assertEqual(res['last'], latest())
+        res = changes.changesSince(res['next'], limit=3)
+        self.assertEqual(len(res['changes']), 2)
+        self.assertFalse(res['more'])
+
+    def testCompaction(self):
+        for n in range(5):
+            keyManagement.addUserAndKey('u{0}@host.compact.tld'.format(n),
+                                        makeKey(n))
+        last = latest()
+        self.assertEqual(changes.compact(retain=2), 3)
+        self.assertEqual(changes.compact(retain=0), 1)
+        # The newest entry is always kept, so sequence numbers never repeat
+        self.assertEqual(changes.bounds(), (last, last))
+
+        res = changes.changesSince(1)
+        self.assertTrue(res['snapshotRequired'])
+        self.assertEqual(res['next'], last)
+        self.assertFalse(changes.changesSince(last - 1)['snapshotRequired'])
+        # Past the end of the log, as after restoring an older database
+        self.assertTrue(changes.changesSince(last + 1)['snapshotRequired'])
+
+    def testAfterCommit(self):
+        called = []
+        with db.transaction():
+            db.afterCommit(lambda: called.append(1))
+            self.assertEqual(called, [])
+        self.assertEqual(called, [1])
+        with db.transaction() as txn:
+            db.afterCommit(lambda: called.append(2))
+            txn.rollback()
+        self.assertEqual(called, [1])
+
+class ChangesAPITests(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        setupDatabase()
+        keyManagement.addUserAndKey('user@host.api.tld', makeKey('api'))
+        cls.baseURI = startServer()
+        cls.auth = ('admin', 'admin')
+
+    @classmethod
+    def tearDownClass(cls):
+        stopServer()
+
+    def get(self, **params):
+        return requests.get(self.baseURI + '/api/changes', params=params,
+                            auth=self.auth)
+
+    def testChanges(self):
+        res = self.get(since=0, timeout=0)
+        self.assertEqual(res.status_code, 200)
+        self.assertIn({'seq': 1, 'kind': 'key', 'uhd': 'user@host.api.tld',
+                       'key': makeKey('api')}, res.json()['changes'])
+
+    def testLongPoll(self):
+        since = latest()
+
+        def add():
+            time.sleep(0.3)
+            keyManagement.addUserAndKey('poll@host.api.tld', makeKey('poll'))
+        threading.Thread(target=add).start()
+
+        start = time.time()
+        res = self.get(since=since, timeout=10)
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual([c['uhd'] for c in res.json()['changes']],
+                         ['poll@host.api.tld'])
+
+    def testTimeout(self):
+        since = latest()
+        start = time.time()
+        res = self.get(since=since, timeout=0.3)
+        self.assertGreaterEqual(time.time() - start, 0.3)
+        self.assertEqual(res.json()['changes'], [])
+        self.assertEqual(res.json()['next'], since)
+
+    def testTooManyWaiters(self):
+        saved = changes.changesConf.get('maxWaiters')
+        changes.changesConf['maxWaiters'] = 0
+        try:
+            res = self.get(since=latest(), timeout=1)
+        finally:
+            changes.changesConf['maxWaiters'] = saved
+        self.assertEqual(res.status_code, 503)
+        self.assertEqual(res.headers['Retry-After'], '1')
+
+    def testInvalid(self):
+        self.assertEqual(self.get(since='x').status_code, 400)
+        self.assertEqual(self.get(scope='domain').status_code, 400)
+
+if __name__ == "__main__":
+    unittest.main()
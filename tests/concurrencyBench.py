@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks read throughput against the CherryPy server thread pool size, for
+both the per-thread and the shared database connection modes.
+
+Each combination runs a server in its own process against the same seeded
+database, while this process drives it with concurrent clients reading
+authorized_keys files, which are not cached, so every request hits the
+database.
+
+Usage: python concurrencyBench.py [seconds] [clients]
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import httplib
+import threading
+import subprocess
+from helpers import setupDatabase, startServer, makeKey
+
+#: The thread pool sizes to benchmark
+POOL_SIZES = (1, 2, 4, 8, 16)
+
+#: Number of owners to seed, and authorized users per owner
+OWNERS = 200
+AUTHORIZED = 10
+
+def seed():
+    """
+    Seeds a new database and returns its path.
+    """
+    from lib import keyManagement, database as db
+
+    dbName = setupDatabase()
+    users = [keyManagement.addUserAndKey("user{0}@host{1}.bench.tld".format(
+                n, n % 20), makeKey(n)) for n in range(OWNERS)]
+    with db.transaction():
+        for n, owner in enumerate(users):
+            for m in range(1, AUTHORIZED + 1):
+                db.AuthorizedKeys.create(owner=owner,
+                                         authedUser=users[(n + m) % OWNERS])
+
+    return dbName
+
+def serve(dbName, threads, mode):
+    """
+    Runs a server for the benchmark until stdin is closed.
+    """
+    import lib
+    lib.conf['database']['connectionMode'] = mode
+    setupDatabase(dbName)
+    baseURI = startServer(threads=threads)
+    # Measure the server, not the rate limits of a single client
+    import cherrypy
+    cherrypy.tree.apps['/api'].config['/']['tools.admission.on'] = False
+    sys.stdout.write(baseURI + '\n')
+    sys.stdout.flush()
+    sys.stdin.read()
+    os._exit(0)
+
+def drive(baseURI, seconds, clients):
+    """
+    Runs L{clients} concurrent keep-alive clients against the server for
+    L{seconds}, and returns the requests per second.
+    """
+    host = baseURI.split('//')[1]
+    auth = 'Basic ' + 'admin:admin'.encode('base64').strip()
+    counts = [0] * clients
+    stop = time.time() + seconds
+
+    def client(idx):
+        conn = httplib.HTTPConnection(host)
+        rnd = random.Random(idx)
+        while time.time() < stop:
+            n = rnd.randrange(OWNERS)
+            conn.request('GET', '/api/authorized_keys/user{0}@host{1}.bench.tld'
+                         .format(n, n % 20), headers={'Authorization': auth})
+            resp = conn.getresponse()
+            resp.read()
+            assert resp.status == 200, resp.status
+            counts[idx] += 1
+
+    threads = [threading.Thread(target=client, args=(n,))
+               for n in range(clients)]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    return sum(counts) / (time.time() - start)
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == 'serve':
+        serve(sys.argv[2], int(sys.argv[3]), sys.argv[4])
+
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 5
+    clients = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+
+    dbName = seed()
+    results = {}
+    for mode in ('shared', 'threadlocal'):
+        for threads in POOL_SIZES:
+            proc = subprocess.Popen([sys.executable, __file__, 'serve', dbName,
+                                     str(threads), mode],
+                                    stdin=subprocess.PIPE,
+                                    stdout=subprocess.PIPE)
+            baseURI = proc.stdout.readline().strip()
+            try:
+                results.setdefault(mode, {})[threads] = drive(baseURI,
+                                                              seconds, clients)
+            finally:
+                proc.stdin.close()
+                proc.wait()
+
+    print "Read throughput (req/s) with {0} clients:".format(clients)
+    print "  {0:>8} {1:>10} {2:>12}".format('threads', 'shared',
+                                             'threadlocal')
+    for threads in POOL_SIZES:
+        print "  {0:>8} {1:>10.1f} {2:>12.1f}".format(
+            threads, results['shared'][threads],
+            results['threadlocal'][threads])
+    print json.dumps(results)
+
+if __name__ == "__main__":
+    main()
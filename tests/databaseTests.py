@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""
+Tests the database connection modes with concurrent readers and writers.
+
+Run from the tests dir with: python -m unittest databaseTests
+"""
+
+import threading
+import unittest
+from helpers import setupDatabase, makeKey
+import lib
+from lib import keyManagement, sshKey, database as db
+from external.peewee import OperationalError
+
+#: The number of writer threads, and the writes per thread
+WRITERS = 6
+WRITES = 50
+
+#: The number of reader threads, and the listings per thread
+READERS = 2
+READS = 20
+
+class ConcurrencyTests(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = dict(lib.conf['database'])
+
+    def tearDown(self):
+        db.closeConnections()
+        lib.conf['database'] = self.saved
+        setupDatabase()
+
+    def runThreads(self, target, count):
+        """
+        Runs L{target} with the thread index on L{count} threads, each with its
+        own connections, and returns the errors raised.
+        """
+        errors = []
+
+        def run(idx):
+            try:
+                target(idx)
+            except Exception, exc:
+                errors.append(exc)
+            finally:
+                db.closeThread()
+        threads = [threading.Thread(target=run, args=(n,))
+                   for n in range(count)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        return errors
+
+    def runConcurrently(self, mode, split):
+        lib.conf['database'].update(connectionMode=mode, readWriteSplit=split)
+        setupDatabase()
+        keyManagement.addUserAndKey('first@host0.write.tld', makeKey('first'))
+
+        def write(idx):
+            # All threads add users to the same hosts, so every write starts
+            # by reading, and the first writes also add the hosts
+            for n in range(WRITES):
+                keyManagement.addUserAndKey(
+                    'user{0}-{1}@host{2}.write.tld'.format(idx, n, n % 3),
+                    makeKey((idx, n)))
+
+        def read(idx):
+            # Listings run several queries, and read each one in batches
+            listed = 0
+            for _ in range(READS):
+                uhds = [uhd for _, uhd, _ in
+                        keyManagement.listKeys(batchSize=25)]
+                self.assertEqual(len(set(uhds)), len(uhds))
+                self.assertGreaterEqual(len(uhds), listed)
+                listed = len(uhds)
+                self.assertEqual(keyManagement.findByFingerprint(
+                                    sshKey.fingerprint(sshKey.parse(
+                                        makeKey('first'))[1])),
+                                 ['first@host0.write.tld'])
+
+        def run(idx):
+            if idx < WRITERS:
+                write(idx)
+            else:
+                read(idx)
+        self.assertEqual(self.runThreads(run, WRITERS + READERS), [])
+        self.assertEqual(db.User.select().count(), WRITERS * WRITES + 1)
+        self.assertEqual(db.Host.select().count(), 3)
+
+    def testThreadLocal(self):
+        self.runConcurrently('threadlocal', False)
+
+    def testShared(self):
+        self.runConcurrently('shared', False)
+
+    def testReadWriteSplit(self):
+        self.runConcurrently('threadlocal', True)
+        # The read connections the readers used refuse writes
+        self.assertRaises(OperationalError, db.read_proxy.execute_sql,
+                          'DELETE FROM "user"')
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""
+Tests browsing domains, hosts and users with their counts.
+
+Run from the tests dir with: python -m unittest domainTests
+"""
+
+import unittest
+import requests
+from helpers import setupDatabase, startServer, stopServer, makeKey, \
+                    QueryCounter
+from lib import keyManagement, database as db
+
+def addDomain(domain, hosts, users):
+    """
+    Adds L{users} users on each of L{hosts} hosts in L{domain}, and authorizes
+    every user on the first host to log in as all users on the other hosts.
+
+    @return: The list of added users.
+    """
+    added = []
+    for h in range(hosts):
+        for u in range(users):
+            uhd = "user{0}@host{1}.{2}".format(u, h, domain)
+            added.append(keyManagement.addUserAndKey(uhd, makeKey(uhd)))
+    for owner in added[users:]:
+        for authed in added[:users]:
+            db.AuthorizedKeys.create(owner=owner, authedUser=authed)
+
+    return added
+
+class BrowseTests(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        setupDatabase()
+        addDomain('small.tld', 1, 1)
+        addDomain('big.tld', 10, 3)
+        db.Domain.create(name='empty.tld')
+        db.Host.create(domain=db.Domain.get(db.Domain.name=='small.tld'),
+                       name='nobody')
+
+    def testDomains(self):
+        self.assertEqual(keyManagement.listDomains(), [
+            {'name': 'big.tld', 'hosts': 10, 'users': 30,
+             'authorizedKeys': 81},
+            {'name': 'empty.tld', 'hosts': 0, 'users': 0,
+             'authorizedKeys': 0},
+            {'name': 'small.tld', 'hosts': 2, 'users': 1,
+             'authorizedKeys': 0}])
+
+    def testHosts(self):
+        hosts = keyManagement.listHosts('big.tld')
+        self.assertEqual([h['name'] for h in hosts],
+                         sorted('host{0}'.format(n) for n in range(10)))
+        self.assertEqual(hosts[0], {'name': 'host0', 'users': 3,
+                                    'authorizedKeys': 0})
+        self.assertEqual(hosts[1], {'name': 'host1', 'users': 3,
+                                    'authorizedKeys': 9})
+        self.assertEqual(keyManagement.listHosts('small.tld')[0],
+                         {'name': 'host0', 'users': 1, 'authorizedKeys': 0})
+        self.assertEqual(keyManagement.listHosts('empty.tld'), [])
+        self.assertIsNone(keyManagement.listHosts('none.tld'))
+
+    def testUsers(self):
+        users = keyManagement.listUsers('big.tld', 'host0')
+        self.assertEqual(users[0], {'name': 'user0',
+                                    'uhd': 'user0@host0.big.tld',
+                                    'authorizedKeys': 0, 'authorizedOn': 27})
+        users = keyManagement.listUsers('big.tld', 'host5', keys=True)
+        self.assertEqual([(u['authorizedKeys'], u['authorizedOn'])
+                          for u in users], [(3, 0)] * 3)
+        self.assertEqual(users[2]['key'], makeKey('user2@host5.big.tld'))
+        self.assertEqual(keyManagement.listUsers('small.tld', 'nobody'), [])
+        self.assertIsNone(keyManagement.listUsers('big.tld', 'none'))
+
+    def testConstantQueryCount(self):
+        counts = []
+        for domain in ('small.tld', 'big.tld'):
+            with QueryCounter() as qc:
+                keyManagement.listDomains()
+                keyManagement.listHosts(domain)
+                keyManagement.listUsers(domain, 'host0', keys=True)
+            counts.append(qc.count)
+        self.assertEqual(counts, [3, 3])
+
+class BrowseAPITests(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        setupDatabase()
+        addDomain('api.tld', 2, 2)
+        cls.baseURI = startServer()
+        cls.auth = ('admin', 'admin')
+
+    @classmethod
+    def tearDownClass(cls):
+        stopServer()
+
+    def get(self, path, status=200):
+        res = requests.get(self.baseURI + '/api/domain' + path,
+                           auth=self.auth)
+        self.assertEqual(res.status_code, status, res.text)
+        return res.json() if status == 200 else None
+
+    def testDomains(self):
+        self.assertEqual(self.get('')['domains'],
+                         [{'name': 'api.tld', 'hosts': 2, 'users': 4,
+                           'authorizedKeys': 4}])
+
+    def testHosts(self):
+        res = self.get('/api.tld')
+        self.assertEqual(res['name'], 'api.tld')
+        self.assertEqual([(h['name'], h['users']) for h in res['hosts']],
+                         [('host0', 2), ('host1', 2)])
+        self.get('/none.tld', 404)
+
+    def testUsers(self):
+        res = self.get('/api.tld/host/host1?keys=true')
+        self.assertEqual(res['name'], 'host1.api.tld')
+        self.assertEqual(res['users'][0]['key'],
+                         makeKey('user0@host1.api.tld'))
+        self.assertNotIn('key', self.get('/api.tld/host/host1')['users'][0])
+        self.get('/api.tld/host/none', 404)
+        self.get('/api.tld/hosts/host1', 404)
+        self.get('/api.tld/host', 404)
+        self.get('/api.tld/host/host1/more', 404)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+Tests the ETag and If-None-Match handling of the key and authorized_keys APIs.
+
+Run from the tests dir with: python -m unittest etagTests
+"""
+
+import unittest
+import requests
+from helpers import setupDatabase, startServer, stopServer, makeKey
+from lib import keyManagement, database as db
+
+class ETagTests(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        setupDatabase()
+        cls.owner = keyManagement.addUserAndKey('owner@host.etag.tld',
+                                                makeKey('owner'))
+        authed = keyManagement.addUserAndKey('authed@host.etag.tld',
+                                             makeKey('authed'))
+        db.AuthorizedKeys.create(owner=cls.owner, authedUser=authed)
+        cls.baseURI = startServer()
+
+    @classmethod
+    def tearDownClass(cls):
+        stopServer()
+
+    def get(self, path, inm=None):
+        headers = {'If-None-Match': inm} if inm is not None else None
+        return requests.get(self.baseURI + '/api/' + path,
+                            auth=('admin', 'admin'), headers=headers)
+
+    def update(self, uhd, seed):
+        keyManagement.addUserAndKey(uhd, makeKey(seed), allowUpdate=True)
+
+    def testKey(self):
+        path = 'key/owner@host.etag.tld'
+        userId, revision = keyManagement.keyRevision('owner@host.etag.tld')
+        res = self.get(path)
+        self.assertEqual(res.status_code, 200)
+        tag = res.headers['ETag']
+        self.assertEqual(tag, '"k{0}-{1}"'.format(userId, revision))
+
+        res = self.get(path, tag)
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.headers['ETag'], tag)
+        self.assertEqual(res.content, '')
+
+        self.update('owner@host.etag.tld', 'owner2')
+        res = self.get(path, tag)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['ETag'],
+                         '"k{0}-{1}"'.format(userId, revision + 1))
+        self.assertEqual(res.json(), {'owner@host.etag.tld': makeKey('owner2')})
+
+    def testAuthorizedKeys(self):
+        path = 'authorized_keys/owner@host.etag.tld'
+        ownerId, revision = \
+                keyManagement.authorizedKeysRevision('owner@host.etag.tld')
+        res = self.get(path)
+        self.assertEqual(res.status_code, 200)
+        tag = res.headers['ETag']
+        self.assertEqual(tag, '"a{0}-{1}"'.format(ownerId, revision))
+        self.assertEqual(self.get(path, tag).status_code, 304)
+
+        # Changing an authorized user's key changes the file
+        self.update('authed@host.etag.tld', 'authed2')
+        res = self.get(path, tag)
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers['ETag'], tag)
+        self.assertIn(makeKey('authed2'), res.text)
+        self.assertEqual(self.get(path, res.headers['ETag']).status_code, 304)
+
+    def testTagLists(self):
+        path = 'key/authed@host.etag.tld'
+        tag = self.get(path).headers['ETag']
+        self.assertEqual(self.get(path, '*').status_code, 304)
+        self.assertEqual(self.get(path, '"k0-0", {0}'.format(tag)).status_code,
+                         304)
+        self.assertEqual(self.get(path, '"k0-0",{0} '.format(tag)).status_code,
+                         304)
+        self.assertEqual(self.get(path, '"k0-0", "k0-1"').status_code, 200)
+
+    def testUnknown(self):
+        self.assertEqual(self.get('key/nobody@host.etag.tld', '*').status_code,
+                         404)
+
+if __name__ == "__main__":
+    unittest.main()
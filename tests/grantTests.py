@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+Tests set based authorization grants and revokes.
+
+Run from the tests dir with: python -m unittest grantTests
+"""
+
+import unittest
+import requests
+from helpers import setupDatabase, startServer, stopServer, makeKey, \
+        QueryCounter
+from lib import keyManagement, changes, database as db
+
+def authorized(ownerUhd):
+    """
+    Returns the uhds authorized in the stored file of L{ownerUhd}.
+    """
+    _, _, content = keyManagement.getAuthorizedKeys(ownerUhd)
+    return [l[2:] for l in content.splitlines() if l.startswith('# ')]
+
+def revision(uhd):
+    """
+    Returns the authorized_keys revision for L{uhd}.
+    """
+    return keyManagement.getAuthorizedKeys(uhd)[1]
+
+class GrantTests(unittest.TestCase):
+
+    def setUp(self):
+        setupDatabase()
+        for uhd in ('admin@bastion.ops.tld', 'a@web1.grant.tld',
+                    'b@web1.grant.tld', 'c@web2.grant.tld',
+                    'd@web1.other.tld'):
+            keyManagement.addUserAndKey(uhd, makeKey(uhd))
+
+    def testUser(self):
+        self.assertEqual(keyManagement.grantAuthorization(
+            'admin@bastion.ops.tld', 'user', 'a@web1.grant.tld'), 1)
+        self.assertEqual(authorized('a@web1.grant.tld'),
+                         ['admin@bastion.ops.tld'])
+        self.assertEqual(authorized('b@web1.grant.tld'), [])
+
+    def testHostAndDomain(self):
+        self.assertEqual(keyManagement.grantAuthorization(
+            'admin@bastion.ops.tld', 'host', 'web1.grant.tld'), 2)
+        self.assertEqual(authorized('c@web2.grant.tld'), [])
+        # Users granted on the host already are left as they are
+        self.assertEqual(keyManagement.grantAuthorization(
+            'admin@bastion.ops.tld', 'domain', 'grant.tld',
+            options='no-pty'), 1)
+        for uhd in ('a@web1.grant.tld', 'b@web1.grant.tld',
+                    'c@web2.grant.tld'):
+            self.assertEqual(authorized(uhd), ['admin@bastion.ops.tld'])
+        self.assertEqual(authorized('d@web1.other.tld'), [])
+        _, _, content = keyManagement.getAuthorizedKeys('c@web2.grant.tld')
+        self.assertIn('no-pty ', content)
+        _, _, content = keyManagement.getAuthorizedKeys('a@web1.grant.tld')
+        self.assertNotIn('no-pty ', content)
+
+    def testIdempotent(self):
+        keyManagement.grantAuthorization('admin@bastion.ops.tld', 'host',
+                                         'web1.grant.tld')
+        before = revision('a@web1.grant.tld')
+        since = changes.bounds()[1]
+        self.assertEqual(keyManagement.grantAuthorization(
+            'admin@bastion.ops.tld', 'host', 'web1.grant.tld'), 0)
+        self.assertEqual(revision('a@web1.grant.tld'), before)
+        self.assertEqual(changes.changesSince(since)['changes'], [])
+        self.assertEqual(db.AuthorizedKeys.select().count(), 2)
+
+    def testRevisionsAndChanges(self):
+        before = revision('a@web1.grant.tld')
+        since = changes.bounds()[1]
+        keyManagement.grantAuthorization('admin@bastion.ops.tld', 'host',
+                                         'web1.grant.tld')
+        self.assertEqual(revision('a@web1.grant.tld'), before + 1)
+        self.assertEqual(revision('c@web2.grant.tld'), before)
+        recorded = changes.changesSince(since)['changes']
+        self.assertEqual(sorted(c['uhd'] for c in recorded),
+                         ['a@web1.grant.tld', 'b@web1.grant.tld'])
+        self.assertEqual(set(c['kind'] for c in recorded),
+                         set([changes.AUTHORIZED_KEYS]))
+
+    def testRevoke(self):
+        keyManagement.grantAuthorization('admin@bastion.ops.tld', 'domain',
+                                         'grant.tld')
+        keyManagement.grantAuthorization('d@web1.other.tld', 'user',
+                                         'a@web1.grant.tld')
+        before = revision('a@web1.grant.tld')
+        untouched = revision('c@web2.grant.tld')
+        since = changes.bounds()[1]
+        self.assertEqual(keyManagement.revokeAuthorization(
+            'admin@bastion.ops.tld', 'host', 'web1.grant.tld'), 2)
+        self.assertEqual(authorized('a@web1.grant.tld'), ['d@web1.other.tld'])
+        self.assertEqual(authorized('b@web1.grant.tld'), [])
+        self.assertEqual(authorized('c@web2.grant.tld'),
+                         ['admin@bastion.ops.tld'])
+        self.assertEqual(revision('a@web1.grant.tld'), before + 1)
+        self.assertEqual(revision('c@web2.grant.tld'), untouched)
+        self.assertEqual(sorted(c['uhd'] for c in
+                                changes.changesSince(since)['changes']),
+                         ['a@web1.grant.tld', 'b@web1.grant.tld'])
+        self.assertEqual(keyManagement.checkAuthorizedKeysFiles(), [])
+        # Nothing left to revoke
+        self.assertEqual(keyManagement.revokeAuthorization(
+            'admin@bastion.ops.tld', 'host', 'web1.grant.tld'), 0)
+
+    def testConstantQueryCount(self):
+        counts = []
+        for scope, name in (('user', 'a@web1.grant.tld'),
+                            ('domain', 'grant.tld')):
+            with QueryCounter() as qc:
+                keyManagement.grantAuthorization('admin@bastion.ops.tld',
+                                                 scope, name)
+            counts.append(qc.count)
+            with QueryCounter() as qc:
+                keyManagement.revokeAuthorization('admin@bastion.ops.tld',
+                                                  scope, name)
+            counts.append(qc.count)
+        self.assertEqual(counts[:2], counts[2:])
+
+    def testUniqueIndex(self):
+        owner = db.User.get(db.User.name=='a')
+        grantee = db.User.get(db.User.name=='b')
+        db.AuthorizedKeys.create(owner=owner, authedUser=grantee)
+        self.assertRaises(db.IntegrityError, db.AuthorizedKeys.create,
+                          owner=owner, authedUser=grantee)
+
+    def testInvalid(self):
+        grant = keyManagement.grantAuthorization
+        self.assertRaises(ValueError, grant, 'admin@bastion.ops.tld',
+                          'planet', 'grant.tld')
+        self.assertRaises(ValueError, grant, 'admin@bastion.ops.tld',
+                          'host', 'web1')
+        self.assertRaises(ValueError, grant, 'admin@bastion.ops.tld',
+                          'user', 'invalid')
+        self.assertRaises(ValueError, grant, 'invalid', 'domain', 'grant.tld')
+        self.assertRaises(ValueError, grant, 'admin@bastion.ops.tld',
+                          'domain', 'grant.tld', options='x\nssh-rsa AAA')
+        self.assertIsNone(grant('nobody@bastion.ops.tld', 'domain',
+                                'grant.tld'))
+        self.assertEqual(grant('admin@bastion.ops.tld', 'domain',
+                               'nothing.tld'), 0)
+
+class GrantAPITests(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        setupDatabase()
+        for uhd in ('admin@bastion.api.tld', 'a@web1.api.tld',
+                    'b@web2.api.tld'):
+            keyManagement.addUserAndKey(uhd, makeKey(uhd))
+        cls.baseURI = startServer()
+        cls.auth = ('admin', 'admin')
+
+    @classmethod
+    def tearDownClass(cls):
+        stopServer()
+
+    def request(self, method, **params):
+        return requests.request(method, self.baseURI + '/api/grant',
+                                params=params, auth=self.auth)
+
+    def testGrantAndRevoke(self):
+        res = self.request('POST', grantee='admin@bastion.api.tld',
+                           scope='domain', name='api.tld')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.json(), {'granted': 3})
+        res = self.request('POST', grantee='admin@bastion.api.tld',
+                           scope='domain', name='api.tld')
+        self.assertEqual(res.json(), {'granted': 0})
+        res = self.request('DELETE', grantee='admin@bastion.api.tld',
+                           scope='host', name='web1.api.tld')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.json(), {'revoked': 1})
+        self.assertEqual(authorized('b@web2.api.tld'),
+                         ['admin@bastion.api.tld'])
+
+    def testErrors(self):
+        res = self.request('POST', grantee='admin@bastion.api.tld',
+                           scope='planet', name='api.tld')
+        self.assertEqual(res.status_code, 400)
+        res = self.request('DELETE', grantee='nobody@bastion.api.tld',
+                           scope='domain', name='api.tld')
+        self.assertEqual(res.status_code, 404)
+
+if __name__ == "__main__":
+    unittest.main()
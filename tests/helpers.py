@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""
+Helpers for the tests and benchmarks.
+
+Importing this module makes the application packages importable, so tests and
+benchmarks can be run directly from the C{tests} dir.
+"""
+
+import os
+import sys
+import time
+import base64
+import socket
+import struct
+import hashlib
+import tempfile
+
+#: Full path to the application dir
+appDir = os.path.realpath(os.path.join(os.path.dirname(__file__), '..', 'app'))
+if appDir not in sys.path:
+    sys.path.insert(0, appDir)
+
+import lib
+from lib import database as db
+
+# Set config and logging up the way the application does
+lib.configApp()
+
+def setupDatabase(dbName=None):
+    """
+    Sets the application database up on a new, empty SQLite database.
+
+    @param dbName: The database file to use. If None, a temporary file is used.
+
+    @return: The path to the database file.
+    """
+    if dbName is None:
+        fd, dbName = tempfile.mkstemp(prefix='sshKeyServer-', suffix='.sqlite')
+        os.close(fd)
+        os.unlink(dbName)
+    lib.conf['database']['name'] = dbName
+    db.setup()
+
+    return dbName
+
+def makeKey(seed, comment=None):
+    """
+    Returns a well formed, but not usable, OpenSSH ssh-rsa public key derived
+    from L{seed}.
+
+    @param seed: Any value. Different seeds give different keys.
+    @param comment: An optional key comment.
+    """
+    data = hashlib.sha256(str(seed)).digest() * 8
+    blob = struct.pack('>I', 7) + 'ssh-rsa' + struct.pack('>I', 1) + '\x23' + \
+           struct.pack('>I', len(data)) + data
+    key = 'ssh-rsa ' + base64.b64encode(blob)
+
+    return key + ' ' + comment if comment else key
+
+def freePort():
+    """
+    Returns a currently unused TCP port on the loopback interface.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+
+    return port
+
+def setupServer(threads=10):
+    """
+    Configures the server for the application on an ephemeral port, and sets
+    the application up, without starting it.
+
+    The database must already be set up with L{setupDatabase}.
+
+    @param threads: The size of the CherryPy worker thread pool.
+
+    @return: The base URI for the server.
+    """
+    import cherrypy
+    import api
+    from lib import metrics
+
+    port = freePort()
+    for cfg in lib.configFiles('server', required=True):
+        cherrypy.config.update(cfg)
+    cherrypy.config.update({'server.socket_host': '127.0.0.1',
+                            'server.socket_port': port,
+                            'server.thread_pool': threads,
+                            'log.screen': False,
+                            'engine.autoreload.on': False})
+    api.setup()
+    metrics.setup()
+
+    return "http://127.0.0.1:{0}".format(port)
+
+def startServer(threads=10):
+    """
+    Starts the application in-process on an ephemeral port.
+
+    The database must already be set up with L{setupDatabase}.
+
+    @param threads: The size of the CherryPy worker thread pool.
+
+    @return: The base URI for the running server.
+    """
+    import cherrypy
+
+    baseURI = setupServer(threads)
+    cherrypy.engine.start()
+
+    return baseURI
+
+def stopServer():
+    """
+    Stops a server started with L{startServer}.
+
+    The engine is stopped, but not exited, so that more servers can be started
+    in the same process.
+    """
+    import cherrypy
+    cherrypy.engine.stop()
+    # Let the next start create a new HTTP server for its own port
+    cherrypy.server.httpserver = None
+
+class QueryCounter(object):
+    """
+    Context manager counting the SQL statements executed on the application
+    database while active, including those on the read-only database when
+    reads and writes are split.
+
+    Usage::
+
+        with QueryCounter() as qc:
+            keyManagement.addUserAndKey(...)
+        print qc.count, qc.statements
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.statements = []
+
+    def __enter__(self):
+        self._databases = [d for d in (db.db_proxy.obj, db.read_proxy.obj)
+                           if d is not None]
+        for database in self._databases:
+            self._patch(database)
+        return self
+
+    def _patch(self, database):
+        orig = database.execute_sql
+
+        def execute_sql(sql, params=None, require_commit=True):
+            self.count += 1
+            self.statements.append(sql)
+            return orig(sql, params, require_commit)
+
+        database.execute_sql = execute_sql
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        # Remove the instance overrides to expose the class methods again
+        for database in self._databases:
+            del database.execute_sql
+
+def timeit(func, count):
+    """
+    Calls L{func} with the call index as argument L{count} times.
+
+    @return: The number of calls per second.
+    """
+    start = time.time()
+    for n in xrange(count):
+        func(n)
+
+    return count / (time.time() - start)
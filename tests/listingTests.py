@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+Tests listing keys with keyset pagination.
+
+Run from the tests dir with: python -m unittest listingTests
+"""
+
+import json
+import unittest
+import requests
+from helpers import setupDatabase, startServer, stopServer, makeKey
+from lib import keyManagement
+
+#: The users added for the tests, in listing order
+UHDS = ["user{0}@host{1}.dom{2}.tld".format(u, h, d)
+        for d in range(3) for h in range(2) for u in range(4)]
+
+class ListKeysTests(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        setupDatabase()
+        # Add in reverse so that listing order is not insertion order
+        for uhd in reversed(UHDS):
+            keyManagement.addUserAndKey(uhd, makeKey(uhd))
+
+    def listUhds(self, **kwargs):
+        return [uhd for _, uhd, _ in keyManagement.listKeys(**kwargs)]
+
+    def testAll(self):
+        keys = list(keyManagement.listKeys(batchSize=5))
+        self.assertEqual(sorted(uhd for _, uhd, _ in keys), sorted(UHDS))
+        self.assertEqual([k[0] for k in keys], sorted(k[0] for k in keys))
+        self.assertEqual(keys[0][2], makeKey(keys[0][1]))
+
+    def testPages(self):
+        pages, after = [], None
+        while True:
+            page = list(keyManagement.listKeys(after=after, limit=5,
+                                               batchSize=2))
+            if not page:
+                break
+            pages.append(page)
+            after = page[-1][0]
+        self.assertEqual([len(p) for p in pages], [5, 5, 5, 5, 4])
+        self.assertEqual([uhd for p in pages for _, uhd, _ in p],
+                         self.listUhds())
+
+    def testFilters(self):
+        self.assertEqual(sorted(self.listUhds(domain='dom1.tld')),
+                         sorted(u for u in UHDS if 'dom1.tld' in u))
+        self.assertEqual(len(self.listUhds(host='host0')), 12)
+        self.assertEqual(len(self.listUhds(domain='dom2.tld', host='host1')), 4)
+        self.assertEqual(self.listUhds(domain='none.tld'), [])
+
+    def testCursor(self):
+        self.assertEqual(keyManagement.parseCursor('1.2.3'), (1, 2, 3))
+        for bad in ('1.2', 'a.b.c', '', None):
+            self.assertRaises(ValueError, keyManagement.parseCursor, bad)
+
+class KeysAPITests(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        setupDatabase()
+        for uhd in UHDS:
+            keyManagement.addUserAndKey(uhd, makeKey(uhd))
+        cls.baseURI = startServer()
+        cls.session = requests.Session()
+        cls.session.auth = ('admin', 'admin')
+
+    @classmethod
+    def tearDownClass(cls):
+        stopServer()
+
+    def get(self, **params):
+        r = self.session.get(self.baseURI + '/api/keys', params=params)
+        r.raise_for_status()
+        return r
+
+    def testJSONPages(self):
+        uhds, after = [], None
+        while True:
+            res = self.get(limit=10, after=after).json()
+            uhds.extend(k['uhd'] for k in res['keys'])
+            after = res['next']
+            if after is None:
+                break
+        self.assertEqual(uhds, UHDS)
+
+    def testNDJSON(self):
+        r = self.get(format='ndjson', limit=20)
+        self.assertEqual(r.headers['Content-Type'], 'application/x-ndjson')
+        lines = [json.loads(l) for l in r.text.splitlines()]
+        self.assertEqual([l['uhd'] for l in lines[:-1]], UHDS[:20])
+        self.assertEqual(lines[-1].keys(), ['next'])
+
+    def testStreamedAndCompressed(self):
+        r = self.get(domain='dom0.tld')
+        self.assertEqual(r.headers.get('Transfer-Encoding'), 'chunked')
+        self.assertEqual(r.headers.get('Content-Encoding'), 'gzip')
+        self.assertEqual(len(r.json()['keys']), 8)
+
+    def testInvalid(self):
+        for params in ({'after': 'x'}, {'limit': '0'}, {'format': 'xml'}):
+            r = self.session.get(self.baseURI + '/api/keys', params=params)
+            self.assertEqual(r.status_code, 400)
+
+if __name__ == "__main__":
+    unittest.main()
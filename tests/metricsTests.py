@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+Tests the metrics registry and the /metrics page.
+
+Run from the tests dir with: python -m unittest metricsTests
+"""
+
+import re
+import threading
+import unittest
+import requests
+from helpers import setupDatabase, startServer, stopServer, makeKey
+from lib import metrics, keyManagement
+
+class RegistryTests(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = metrics.Registry()
+        self.registry.counter('things_total', "Things.")
+        self.registry.histogram('wait_seconds', "Waits.", (0.1, 1))
+
+    def testCounterShards(self):
+        def work():
+            for _ in range(1000):
+                self.registry.inc('things_total', (('kind', 'a'),))
+        threads = [threading.Thread(target=work) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.registry.inc('things_total', (('kind', 'b'),), 5)
+
+        totals = self.registry.collect()
+        self.assertEqual(totals[('things_total', (('kind', 'a'),))], 4000)
+        self.assertEqual(totals[('things_total', (('kind', 'b'),))], 5)
+
+    def testHistogram(self):
+        for value in (0.05, 0.1, 0.5, 2):
+            self.registry.observe('wait_seconds', (), value)
+        text = self.registry.render()
+        self.assertIn('# TYPE wait_seconds histogram\n', text)
+        self.assertIn('wait_seconds_bucket{le="0.1"} 2\n', text)
+        self.assertIn('wait_seconds_bucket{le="1"} 3\n', text)
+        self.assertIn('wait_seconds_bucket{le="+Inf"} 4\n', text)
+        self.assertIn('wait_seconds_count 4\n', text)
+        self.assertIn('wait_seconds_sum 2.65\n', text)
+
+    def testLabelEscaping(self):
+        self.registry.inc('things_total', (('kind', 'a"b'),))
+        self.assertIn('things_total{kind="a\\"b"} 1\n',
+                      self.registry.render())
+
+class MetricsPageTests(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        setupDatabase()
+        keyManagement.addUserAndKey('user@host.metrics.tld', makeKey('m'))
+        cls.baseURI = startServer()
+
+    @classmethod
+    def tearDownClass(cls):
+        stopServer()
+
+    def sample(self, text, line):
+        m = re.search('^' + re.escape(line) + r' (\S+)$', text, re.M)
+        return float(m.group(1)) if m else 0
+
+    def testRequestMetrics(self):
+        before = requests.get(self.baseURI + '/metrics').text
+        for _ in range(3):
+            r = requests.get(self.baseURI + '/api/key/user@host.metrics.tld',
+                             auth=('admin', 'admin'))
+            self.assertEqual(r.status_code, 200)
+        requests.get(self.baseURI + '/api/key/nobody@host.metrics.tld',
+                     auth=('admin', 'admin'))
+
+        r = requests.get(self.baseURI + '/metrics')
+        self.assertEqual(r.status_code, 200)
+        self.assertTrue(r.headers['Content-Type'].startswith('text/plain'))
+        text = r.text
+        ok = 'http_requests_total{route="Key",method="GET",status="200"}'
+        missing = 'http_requests_total{route="Key",method="GET",status="404"}'
+        self.assertEqual(self.sample(text, ok) - self.sample(before, ok), 3)
+        self.assertEqual(self.sample(text, missing) -
+                         self.sample(before, missing), 1)
+        self.assertGreater(self.sample(
+            text, 'http_request_db_queries_count{route="Key"}'), 0)
+        self.assertIn('cache_hits_total{cache="key"}', text)
+        self.assertIn('db_query_duration_seconds_count{statement="SELECT"}',
+                      text)
+
+if __name__ == "__main__":
+    unittest.main()
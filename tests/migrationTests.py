@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+"""
+Tests the fingerprint lookups, and migrating databases created with the
+original schema.
+
+Run from the tests dir with: python -m unittest migrationTests
+"""
+
+import os
+import sqlite3
+import tempfile
+import unittest
+import requests
+from helpers import setupDatabase, startServer, stopServer, makeKey
+import lib
+from lib import keyManagement, migrations, sshKey, database as db
+from external.playhouse.migrate import SqliteMigrator
+
+#: The tables as created by the first release, before any migrations
+BASELINE_SCHEMA = """
+CREATE TABLE "domain" ("id" INTEGER NOT NULL PRIMARY KEY,
+    "name" TEXT NOT NULL, "comment" TEXT);
+CREATE UNIQUE INDEX "domain_name" ON "domain" ("name");
+CREATE TABLE "host" ("id" INTEGER NOT NULL PRIMARY KEY,
+    "domain_id" INTEGER NOT NULL, "name" TEXT NOT NULL, "comment" TEXT,
+    FOREIGN KEY ("domain_id") REFERENCES "domain" ("id") ON DELETE CASCADE);
+CREATE INDEX "host_domain_id" ON "host" ("domain_id");
+CREATE UNIQUE INDEX "host_name_domain_id" ON "host" ("name", "domain_id");
+CREATE TABLE "user" ("id" INTEGER NOT NULL PRIMARY KEY,
+    "host_id" INTEGER NOT NULL, "name" TEXT NOT NULL, "pubKey" TEXT NOT NULL,
+    "comment" TEXT,
+    FOREIGN KEY ("host_id") REFERENCES "host" ("id") ON DELETE CASCADE);
+CREATE INDEX "user_host_id" ON "user" ("host_id");
+CREATE UNIQUE INDEX "user_name_host_id" ON "user" ("name", "host_id");
+CREATE TABLE "authorizedkeys" ("id" INTEGER NOT NULL PRIMARY KEY,
+    "owner_id" INTEGER NOT NULL, "authedUser_id" INTEGER NOT NULL,
+    "options" TEXT,
+    FOREIGN KEY ("owner_id") REFERENCES "user" ("id") ON DELETE CASCADE,
+    FOREIGN KEY ("authedUser_id") REFERENCES "user" ("id") ON DELETE CASCADE);
+CREATE INDEX "authorizedkeys_owner_id" ON "authorizedkeys" ("owner_id");
+CREATE INDEX "authorizedkeys_authedUser_id" ON "authorizedkeys"
+    ("authedUser_id");
+"""
+
+def fingerprint(pubKey):
+    """
+    Returns the SHA256 fingerprint of the public key text L{pubKey}.
+    """
+    return sshKey.fingerprint(sshKey.parse(pubKey)[1])
+
+def keyWithSlash(leading=False):
+    """
+    Returns a test key with a '/' in its fingerprint, at the start if
+    L{leading} is True, or elsewhere if not.
+    """
+    for seed in xrange(10000):
+        fp = fingerprint(makeKey(seed))[len('SHA256:'):]
+        if (fp.find('/') == 0) == leading and '/' in fp:
+            return makeKey(seed)
+
+def baselineDatabase(users, authorized=()):
+    """
+    Creates a database with the original schema, as it was before any
+    migrations, in a new temporary file. The application is configured to use
+    the new database, but it is not set up.
+
+    @param users: A list of (uhd, pubKey) tuples to add. The key text is stored
+           as is.
+    @param authorized: A list of (ownerUhd, authedUhd, options) tuples for the
+           authorized_keys entries to add.
+
+    @return: The path to the database file.
+    """
+    fd, path = tempfile.mkstemp(prefix='sshKeyServer-', suffix='.sqlite')
+    os.close(fd)
+    conn = sqlite3.connect(path)
+    with conn:
+        conn.executescript(BASELINE_SCHEMA)
+        ids = {}
+        for uhd, pubKey in users:
+            u, h, d = keyManagement.splitUserHostDomain(uhd)
+            conn.execute('INSERT OR IGNORE INTO "domain" ("name") VALUES (?)',
+                         (d,))
+            conn.execute('INSERT OR IGNORE INTO "host" ("domain_id", "name") '
+                         'SELECT "id", ? FROM "domain" WHERE "name" = ?',
+                         (h, d))
+            ids[uhd] = conn.execute(
+                'INSERT INTO "user" ("host_id", "name", "pubKey") '
+                'SELECT "host"."id", ?, ? FROM "host" JOIN "domain" ON '
+                '"domain"."id" = "host"."domain_id" WHERE "host"."name" = ? '
+                'AND "domain"."name" = ?', (u, pubKey, h, d)).lastrowid
+        for owner, authed, options in authorized:
+            conn.execute('INSERT INTO "authorizedkeys" ("owner_id", '
+                         '"authedUser_id", "options") VALUES (?, ?, ?)',
+                         (ids[owner], ids[authed], options))
+    conn.close()
+    db.closeConnections()
+    lib.conf['database']['name'] = path
+
+    return path
+
+class FingerprintTests(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        setupDatabase()
+        cls.key = keyWithSlash()
+        cls.leadingKey = keyWithSlash(leading=True)
+        keyManagement.addUserAndKey('a@host1.fp.tld', cls.key)
+        keyManagement.addUserAndKey('b@host2.fp.tld', cls.key)
+        keyManagement.addUserAndKey('c@host1.fp.tld', cls.leadingKey)
+        keyManagement.addUserAndKey('d@host1.fp.tld', makeKey('other'))
+        cls.baseURI = startServer()
+
+    @classmethod
+    def tearDownClass(cls):
+        stopServer()
+
+    def get(self, fp):
+        return requests.get(self.baseURI + '/api/fingerprint/' + fp,
+                            auth=('admin', 'admin'))
+
+    def testFind(self):
+        fp = fingerprint(self.key)
+        uhds = ['a@host1.fp.tld', 'b@host2.fp.tld']
+        self.assertEqual(keyManagement.findByFingerprint(fp), uhds)
+        # Without the prefix, and with base64 padding
+        self.assertEqual(keyManagement.findByFingerprint(fp[7:] + '='), uhds)
+        self.assertEqual(keyManagement.findByFingerprint('SHA256:unknown'), [])
+
+    def testKeyColumns(self):
+        user = db.User.get(db.User.name == 'd')
+        self.assertEqual(user.fingerprint, fingerprint(makeKey('other')))
+        self.assertEqual(user.keyType, sshKey.keyTypeCode('ssh-rsa'))
+
+    def testAPI(self):
+        fp = fingerprint(self.key)
+        # With and without the prefix, and with the '/' encoded
+        for path in (fp, fp[7:], fp[7:].replace('/', '%2F')):
+            res = self.get(path)
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(res.json()['uhds'],
+                             ['a@host1.fp.tld', 'b@host2.fp.tld'])
+
+    def testLeadingSlash(self):
+        res = self.get(fingerprint(self.leadingKey))
+        self.assertEqual(res.json()['uhds'], ['c@host1.fp.tld'])
+
+    def testNoFingerprint(self):
+        self.assertEqual(self.get('').status_code, 400)
+
+class FingerprintMigrationTests(unittest.TestCase):
+
+    def setUp(self):
+        self.users = [('user{0}@host.migrate.tld'.format(n), makeKey(n))
+                      for n in range(5)]
+        self.users.insert(2, ('invalid@host.migrate.tld', 'not a key'))
+        baselineDatabase(self.users)
+
+    def tearDown(self):
+        db.closeConnections()
+        setupDatabase()
+
+    def testBackfill(self):
+        db.setup(create=False)
+        database = db.db_proxy.obj
+        migrator = SqliteMigrator(database)
+        migrations.addFingerprints(migrator)
+        indexes = [row[1] for row in database.execute_sql(
+                   'PRAGMA index_list("user")').fetchall()]
+        self.assertIn('user_fingerprint', indexes)
+
+        # The fingerprints are added while converting the keys, which parses
+        # each key once
+        parse = sshKey.parse
+        parsed = []
+
+        def counting(pubKey):
+            parsed.append(pubKey)
+            return parse(pubKey)
+        sshKey.parse = counting
+        try:
+            migrations.addKeyBlobs(migrator, batchSize=2)
+        finally:
+            sshKey.parse = parse
+        self.assertEqual(parsed, [pubKey for _, pubKey in self.users])
+        rows = database.execute_sql('SELECT "name", "fingerprint", "keyType" '
+                                    'FROM "user" ORDER BY "id"').fetchall()
+        expected = []
+        for uhd, pubKey in self.users:
+            if pubKey == 'not a key':
+                expected.append(('invalid', None, None))
+            else:
+                expected.append((uhd.split('@')[0], fingerprint(pubKey),
+                                 sshKey.keyTypeCode('ssh-rsa')))
+        self.assertEqual(rows, expected)
+        # Running them again changes nothing
+        migrations.addFingerprints(migrator)
+        migrations.addKeyBlobs(migrator, batchSize=2)
+        self.assertEqual(database.execute_sql(
+                    'SELECT "name", "fingerprint", "keyType" FROM "user" '
+                    'ORDER BY "id"').fetchall(), rows)
+
+    def testSetup(self):
+        db.setup()
+        self.assertEqual(keyManagement.findByFingerprint(
+                                fingerprint(makeKey(3))),
+                         ['user3@host.migrate.tld'])
+
+class BaselineMigrationTests(unittest.TestCase):
+
+    users = [('owner@host1.base.tld', makeKey('owner')),
+             ('a@host1.base.tld', makeKey('a', 'a@laptop')),
+             ('b@host2.base.tld', makeKey('b')),
+             ('c@host1.other.tld', 'not a key')]
+    authorized = [('owner@host1.base.tld', 'a@host1.base.tld', None),
+                  ('owner@host1.base.tld', 'b@host2.base.tld', 'no-pty'),
+                  ('owner@host1.base.tld', 'c@host1.other.tld', None),
+                  ('b@host2.base.tld', 'a@host1.base.tld', None)]
+
+    def setUp(self):
+        baselineDatabase(self.users, self.authorized)
+        keyManagement.keyCache.clear()
+
+    def tearDown(self):
+        db.closeConnections()
+        setupDatabase()
+
+    def expectedAuthorizedKeys(self, owner):
+        """
+        Returns the authorized_keys file for L{owner}, as rendered from the
+        original entries.
+        """
+        keys = dict(self.users)
+        lines = []
+        for o, authed, options in self.authorized:
+            if o == owner:
+                lines.append("# {0}".format(authed))
+                lines.append(options + ' ' + keys[authed] if options
+                             else keys[authed])
+
+        return ''.join(line + '\n' for line in lines)
+
+    def testMigrate(self):
+        db.setup()
+        self.assertEqual(db.storedSchemaVersion(), db.schemaVersion())
+        for uhd, pubKey in self.users:
+            self.assertEqual(keyManagement.getKey(uhd)[2], pubKey)
+            expected = self.expectedAuthorizedKeys(uhd)
+            self.assertEqual(keyManagement.renderAuthorizedKeys(uhd)[2],
+                             expected)
+            self.assertEqual(keyManagement.getAuthorizedKeys(uhd)[2], expected)
+        self.assertEqual(keyManagement.checkAuthorizedKeysFiles(), [])
+        self.assertNotIn('pubKey', migrations.columnNames(db.db_proxy.obj,
+                                                          'user'))
+
+if __name__ == "__main__":
+    unittest.main()
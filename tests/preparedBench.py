@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks prepared queries against building and compiling the same query on
+every call.
+
+For the hot path lookups, reports the microseconds per call to build and
+compile the query alone, to build, compile and execute it as before, and to
+execute the prepared query.
+
+Usage: python preparedBench.py [count]
+"""
+
+import sys
+from helpers import setupDatabase, makeKey, timeit
+from lib import keyManagement, database as db
+
+#: The number of users seeded
+USERS = 1000
+
+def lookups():
+    """
+    Returns the benchmarked lookups, as (name, build, prepared) tuples, with
+    functions taking a user number, that build the query, and that run the
+    prepared query.
+    """
+    uhd = lambda n: ('user{0}'.format(n), 'host{0}'.format(n % 10),
+                     'bench.tld')
+    return [
+        ("uhd key lookup",
+         lambda n: keyManagement._userSelect(
+             uhd(n), db.User.id, db.User.revision, db.User.keyType,
+             db.User.keyBlob, db.User.keyComment),
+         lambda n: keyManagement._keyQuery.scalar(
+             as_tuple=True, **keyManagement._uhdValues(uhd(n)))),
+        ("host.domain id",
+         lambda n: db.Host.select(db.Host.id)
+                   .join(db.Domain)
+                   .where(db.Host.name=='host{0}'.format(n % 10),
+                          db.Domain.name=='bench.tld'),
+         lambda n: keyManagement._hostId('host{0}'.format(n % 10),
+                                         'bench.tld')),
+        ("stored authorized_keys",
+         lambda n: db.AuthorizedKeysFile.select(
+                       db.AuthorizedKeysFile.owner,
+                       db.AuthorizedKeysFile.authRevision,
+                       db.AuthorizedKeysFile.content)
+                   .where(db.AuthorizedKeysFile.uhd=='{0}@{1}.{2}'.format(
+                       *uhd(n))),
+         lambda n: keyManagement._storedFileQuery.scalar(
+             as_tuple=True, uhd='{0}@{1}.{2}'.format(*uhd(n)))),
+    ]
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+
+    setupDatabase()
+    with db.transaction():
+        for n in range(USERS):
+            keyManagement.addUserAndKey(
+                'user{0}@host{1}.bench.tld'.format(n, n % 10), makeKey(n))
+
+    print "Microseconds per call, over {0} calls:".format(count)
+    print "  {0:<24} {1:>10} {2:>12} {3:>10} {4:>8}".format(
+        'lookup', 'compile', 'compile+exec', 'prepared', 'speedup')
+    for name, build, prepared in lookups():
+        compiled = timeit(lambda n: build(n % USERS).sql(), count)
+        built = timeit(lambda n: build(n % USERS).scalar(as_tuple=True),
+                       count)
+        fast = timeit(lambda n: prepared(n % USERS), count)
+        print "  {0:<24} {1:>10.1f} {2:>12.1f} {3:>10.1f} {4:>7.2f}x".format(
+            name, 1e6 / compiled, 1e6 / built, 1e6 / fast, fast / built)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+Tests prepared queries.
+
+Run from the tests dir with: python -m unittest preparedTests
+"""
+
+import unittest
+from helpers import setupDatabase, makeKey, QueryCounter
+from lib import keyManagement, database as db
+
+class PreparedQueryTests(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        setupDatabase()
+        cls.user = keyManagement.addUserAndKey('user@host.prepared.tld',
+                                               makeKey(1))
+        keyManagement.addUserAndKey('other@host.prepared.tld', makeKey(2))
+
+    def testCompiledOnce(self):
+        built = []
+
+        @db.prepared
+        def query():
+            built.append(1)
+            return db.User.select(db.User.id)\
+                    .where(db.User.name==db.Placeholder('name'))
+        self.assertEqual(query.scalar(name='user'), self.user.id)
+        self.assertEqual(query.scalar(name='other'), self.user.id + 1)
+        self.assertIsNone(query.scalar(name='nobody'))
+        self.assertEqual(built, [1])
+        sql = query.compile()[1]
+        self.assertEqual(sql.count('?'), 1)
+
+    def testSameResultsAsQuery(self):
+        def build(user, host):
+            return db.User.select(db.User, db.Host)\
+                    .join(db.Host)\
+                    .where(db.User.name==user, db.Host.name==host)
+        query = db.PreparedQuery(lambda: build(db.Placeholder('user'),
+                                               db.Placeholder('host')))
+        expected = list(build('user', 'host'))
+        users = list(query.execute(user='user', host='host'))
+        self.assertEqual(len(users), 1)
+        # Models are hydrated as for the query, including the joined host
+        self.assertIsInstance(users[0], db.User)
+        self.assertEqual(users[0]._data, expected[0]._data)
+        self.assertEqual(users[0].host._data, expected[0].host._data)
+        self.assertEqual(users[0].pubKey, makeKey(1))
+
+    def testConversions(self):
+        # Foreign key values are converted as for the query
+        query = db.PreparedQuery(
+            lambda: db.User.select(db.User.name)
+                    .where(db.User.host==db.Placeholder('host'))
+                    .order_by(db.User.name)
+                    .dicts())
+        self.assertEqual(list(query.execute(host=self.user.host)),
+                         [{'name': 'other'}, {'name': 'user'}])
+        self.assertEqual(list(query.execute(host=self.user.host.id)),
+                         [{'name': 'other'}, {'name': 'user'}])
+
+    def testGet(self):
+        query = db.PreparedQuery(
+            lambda: db.User.select()
+                    .where(db.User.name==db.Placeholder('name'))
+                    .limit(1))
+        self.assertEqual(query.get(name='user').id, self.user.id)
+        self.assertRaises(db.User.DoesNotExist, query.get, name='nobody')
+
+    def testOnlySelects(self):
+        query = db.PreparedQuery(lambda: db.User.delete())
+        self.assertRaises(TypeError, query.compile)
+
+    def testKeyLookupQueries(self):
+        keyManagement.keyCache.clear()
+        with QueryCounter() as qc:
+            self.assertEqual(keyManagement.getKey('user@host.prepared.tld')[2],
+                             makeKey(1))
+            self.assertIsNone(keyManagement.getKey('nobody@host.prepared.tld'))
+        self.assertEqual(qc.count, 2)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+Tests the query audit, and that the API endpoints stay within their query
+budgets.
+
+Run from the tests dir with: python -m unittest queryAuditTests
+"""
+
+import unittest
+import requests
+from helpers import setupDatabase, startServer, stopServer, makeKey
+from lib import auth, queryAudit, keyManagement, database as db
+
+class AuditTests(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        setupDatabase()
+        for n in range(8):
+            keyManagement.addUserAndKey('user{0}@host.audit.tld'.format(n),
+                                        makeKey(n))
+
+    def setUp(self):
+        self.saved = queryAudit.enabled, queryAudit.action
+        queryAudit.enabled, queryAudit.action = True, 'raise'
+
+    def tearDown(self):
+        queryAudit.enabled, queryAudit.action = self.saved
+
+    def testNormalize(self):
+        self.assertEqual(
+            queryAudit.normalize('SELECT * FROM "user"  WHERE id IN (?, ?, ?)'
+                                 '\n AND name = \'it\'\'s\' LIMIT 10'),
+            'SELECT * FROM "user" WHERE id IN (?+) AND name = ? LIMIT ?')
+        self.assertEqual(queryAudit.normalize('WHERE id IN (?)'),
+                         queryAudit.normalize('WHERE id IN (?, ?)'))
+
+    def testNPlusOne(self):
+        # Each user lazily loads its host and domain
+        with self.assertRaises(queryAudit.QueryBudgetError) as ctx:
+            with queryAudit.audit('fqn', maxRepeats=5):
+                [u.fqn() for u in db.User.select()]
+        msg = str(ctx.exception)
+        self.assertIn('more than 5 times', msg)
+        self.assertIn('FROM "host"', msg)
+        # The call site is the first frame outside the database layer
+        self.assertIn('model.py:', msg)
+        self.assertIn(' in fqn)', msg)
+
+    def testBudget(self):
+        with self.assertRaises(queryAudit.QueryBudgetError) as ctx:
+            with queryAudit.audit('budget', budget=2, maxRepeats=None):
+                for n in range(3):
+                    keyManagement.getKey('user{0}@host.audit.tld'.format(n))
+        self.assertIn('budget of 2', str(ctx.exception))
+
+    def testLogged(self):
+        queryAudit.action = 'log'
+        with queryAudit.audit('log', budget=1) as audit:
+            db.User.select().count()
+            db.Host.select().count()
+        self.assertEqual(audit.count, 2)
+        self.assertEqual(len(audit.problems), 1)
+
+    def testDisabled(self):
+        queryAudit.enabled = False
+        with queryAudit.audit('off', budget=0) as audit:
+            db.User.select().count()
+        self.assertEqual(audit.count, 0)
+
+class BudgetTests(unittest.TestCase):
+    """
+    Runs the API with failing audits, the way CI should.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.saved = queryAudit.enabled, queryAudit.action
+        queryAudit.enabled, queryAudit.action = True, 'raise'
+        setupDatabase()
+        for n in range(20):
+            keyManagement.addUserAndKey('user{0}@host.budget.tld'.format(n),
+                                        makeKey(n))
+        cls.baseURI = startServer()
+        cls.auth = ('admin', 'admin')
+
+    @classmethod
+    def tearDownClass(cls):
+        stopServer()
+        queryAudit.enabled, queryAudit.action = cls.saved
+
+    def get(self, path, **kwargs):
+        # The credentials are looked up again, and count against the budgets
+        auth.verifiedCache.clear()
+        res = requests.get(self.baseURI + path, auth=self.auth, **kwargs)
+        self.assertEqual(res.status_code, 200, res.text)
+        return res
+
+    def testWithinBudgets(self):
+        res = self.get('/api/key/user0@host.budget.tld')
+        self.get('/api/key/user0@host.budget.tld',
+                 headers={'If-None-Match': '"nomatch"'})
+        self.get('/api/authorized_keys/user0@host.budget.tld',
+                 headers={'If-None-Match': '"nomatch"'})
+        self.get('/api/fingerprint/SHA256:nomatch')
+        self.get('/api/domain')
+        self.get('/api/domain/budget.tld')
+        self.get('/api/domain/budget.tld/host/host?keys=true')
+        self.get('/api/backup', stream=True).close()
+        auth.verifiedCache.clear()
+        res = requests.post(self.baseURI + '/api/key/new@host.other.tld',
+                            data={'key': makeKey('new')}, auth=self.auth)
+        self.assertEqual(res.status_code, 200, res.text)
+
+    def testListingRepeats(self):
+        # Listing in small batches repeats the batch query, which is allowed
+        from lib import conf
+        saved = conf['listing']['batchSize']
+        conf['listing']['batchSize'] = 2
+        try:
+            res = self.get('/api/keys?domain=budget.tld')
+        finally:
+            conf['listing']['batchSize'] = saved
+        self.assertEqual(len(res.json()['keys']), 20)
+
+if __name__ == "__main__":
+    unittest.main()
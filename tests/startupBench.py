@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""
+Application startup benchmark.
+
+Measures the cold start time of the application: from starting a new process
+to the first request being served. Each run starts the application the way
+C{app.py} does, in a new process, on an ephemeral port, and polls it until it
+answers.
+
+Runs are done against a new database every time, where all tables have to be
+created, and against a database with a current schema, which is the normal
+case for a restart. The time for a bare C{import lib} is measured as well,
+since tooling and workers pay for that.
+
+Usage:
+    python startupBench.py [--runs N]
+"""
+
+import os
+import sys
+import time
+import shutil
+import httplib
+import argparse
+import tempfile
+import subprocess
+from helpers import appDir, freePort
+
+def child(dbName, port):
+    """
+    Starts the application in this process, the same way C{app.main} does, but
+    on the given database and port.
+    """
+    import lib
+    lib.configApp()
+    lib.conf['database']['name'] = dbName
+    import cherrypy
+    import app
+    app.setup()
+    cherrypy.config.update({'server.socket_host': '127.0.0.1',
+                            'server.socket_port': port,
+                            'log.screen': False,
+                            'engine.autoreload.on': False})
+    cherrypy.engine.start()
+    cherrypy.engine.block()
+
+def timeToFirstRequest(dbName, timeout=30):
+    """
+    Starts the application in a new process and returns the seconds until it
+    served its first request.
+    """
+    port = freePort()
+    start = time.time()
+    proc = subprocess.Popen([sys.executable, __file__, '--child', dbName,
+                             str(port)])
+    try:
+        while time.time() - start < timeout:
+            conn = httplib.HTTPConnection('127.0.0.1', port, timeout=timeout)
+            try:
+                # Any response will do, so no need to authenticate
+                conn.request('GET', '/api/')
+                conn.getresponse().read()
+                return time.time() - start
+            except IOError:
+                if proc.poll() is not None:
+                    raise RuntimeError("Application exited with status "
+                                       "{0}".format(proc.returncode))
+                time.sleep(0.002)
+            finally:
+                conn.close()
+        raise RuntimeError("Application did not start within {0} "
+                           "seconds".format(timeout))
+    finally:
+        proc.terminate()
+        proc.wait()
+
+def timeCommand(code):
+    """
+    Returns the seconds it takes a new interpreter to run L{code}.
+    """
+    start = time.time()
+    subprocess.check_call([sys.executable, '-c', code], cwd=appDir)
+
+    return time.time() - start
+
+def report(name, times):
+    """
+    Prints the stats for a list of times in seconds.
+    """
+    times = sorted(times)
+    print "  {0:<28} {1:>8.1f} {2:>8.1f} {3:>8.1f}".format(
+            name, times[0] * 1000, times[len(times) // 2] * 1000,
+            sum(times) * 1000 / len(times))
+
+def parseArgs(argv=None):
+    """
+    Parses command line args.
+    """
+    parser = argparse.ArgumentParser(description="Startup benchmark.")
+    parser.add_argument('--runs', type=int, default=10,
+                        help="Runs per measurement.")
+    parser.add_argument('--child', nargs=2, metavar=('DB', 'PORT'),
+                        help=argparse.SUPPRESS)
+
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parseArgs(argv)
+    if args.child:
+        return child(args.child[0], int(args.child[1]))
+
+    tmpDir = tempfile.mkdtemp(prefix='sshKeyServer-')
+    try:
+        bare = [timeCommand('pass') for _ in range(args.runs)]
+        imports = [timeCommand('import lib') for _ in range(args.runs)]
+        new = [timeToFirstRequest(os.path.join(tmpDir, 'new{0}.sqlite'
+                                                        .format(n)))
+               for n in range(args.runs)]
+        current = os.path.join(tmpDir, 'current.sqlite')
+        timeToFirstRequest(current)
+        existing = [timeToFirstRequest(current) for _ in range(args.runs)]
+    finally:
+        shutil.rmtree(tmpDir)
+
+    print "Startup times over {0} runs:".format(args.runs)
+    print "  {0:<28} {1:>8} {2:>8} {3:>8}".format('', 'min ms', 'p50 ms',
+                                                  'mean ms')
+    report('interpreter', bare)
+    report('import lib', imports)
+    report('first request, new db', new)
+    report('first request, current db', existing)
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
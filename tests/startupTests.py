@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""
+Tests the lazy library initialization and the schema version check done on
+startup.
+
+Run from the tests dir with: python -m unittest startupTests
+"""
+
+import sys
+import unittest
+import subprocess
+from helpers import appDir, setupDatabase, QueryCounter
+from lib import database as db
+
+class ImportTests(unittest.TestCase):
+
+    def testNoSideEffects(self):
+        # Run in a fresh interpreter, since this one imported everything
+        code = ("import sys, logging; sys.path.insert(0, {0!r}); import lib; "
+                "print 'cherrypy' in sys.modules, lib.conf._loaded, "
+                "len(logging.getLogger().handlers)".format(appDir))
+        out = subprocess.check_output([sys.executable, '-c', code])
+        self.assertEqual(out.split(), ['False', 'False', '0'])
+
+    def testLazyConfig(self):
+        code = ("import sys; sys.path.insert(0, {0!r}); import lib; "
+                "print 'database' in lib.conf, lib.conf._loaded".format(appDir))
+        out = subprocess.check_output([sys.executable, '-c', code])
+        self.assertEqual(out.split(), ['True', 'True'])
+
+class SchemaVersionTests(unittest.TestCase):
+
+    def setUp(self):
+        setupDatabase()
+
+    def testVersionStored(self):
+        self.assertEqual(db.storedSchemaVersion(), db.schemaVersion())
+        self.assertEqual(db.SchemaVersion.select().count(), 1)
+
+    def testCurrentSchema(self):
+        with QueryCounter() as qc:
+            db.initialize()
+        self.assertEqual(qc.count, 1, qc.statements)
+
+    def testOutdatedSchema(self):
+        db.SchemaVersion.update(version='old').execute()
+        with QueryCounter() as qc:
+            db.initialize()
+        self.assertGreater(qc.count, 1)
+        self.assertEqual(db.storedSchemaVersion(), db.schemaVersion())
+        self.assertEqual(db.SchemaVersion.select().count(), 1)
+
+    def testUnversionedDatabase(self):
+        # Databases set up before versions were stored have no version table
+        db.SchemaVersion.drop_table()
+        self.assertIsNone(db.storedSchemaVersion())
+        db.initialize()
+        self.assertEqual(db.storedSchemaVersion(), db.schemaVersion())
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks storing public keys as decoded blobs against storing the OpenSSH
+key text.
+
+Builds a database with the key text schema, measures its size and cold cache
+key lookup latency, migrates it to the blob schema with the normal startup
+migrations, and measures again.
+
+For cold cache lookups, every lookup batch uses a new connection, and the
+database file is dropped from the OS page cache first where the platform
+allows it.
+
+Usage: python storageBench.py [numUsers] [numLookups]
+"""
+
+import os
+import sys
+import time
+import random
+import ctypes
+import sqlite3
+import tempfile
+from helpers import setupDatabase, makeKey
+from lib import sshKey
+
+#: The user table before keys were stored as blobs
+LEGACY_SCHEMA = """
+CREATE TABLE "domain" ("id" INTEGER NOT NULL PRIMARY KEY, "name" TEXT NOT NULL,
+    "comment" TEXT);
+CREATE UNIQUE INDEX "domain_name" ON "domain" ("name");
+CREATE TABLE "host" ("id" INTEGER NOT NULL PRIMARY KEY,
+    "domain_id" INTEGER NOT NULL REFERENCES "domain" ("id") ON DELETE CASCADE,
+    "name" TEXT NOT NULL, "comment" TEXT);
+CREATE INDEX "host_domain_id" ON "host" ("domain_id");
+CREATE UNIQUE INDEX "host_name_domain_id" ON "host" ("name", "domain_id");
+CREATE TABLE "user" ("id" INTEGER NOT NULL PRIMARY KEY,
+    "host_id" INTEGER NOT NULL REFERENCES "host" ("id") ON DELETE CASCADE,
+    "name" TEXT NOT NULL, "pubKey" TEXT NOT NULL, "keyType" INTEGER,
+    "fingerprint" VARCHAR(255), "comment" TEXT, "revision" INTEGER NOT NULL,
+    "authRevision" INTEGER NOT NULL);
+CREATE INDEX "user_host_id" ON "user" ("host_id");
+CREATE INDEX "user_keyType" ON "user" ("keyType");
+CREATE INDEX "user_fingerprint" ON "user" ("fingerprint");
+CREATE UNIQUE INDEX "user_name_host_id" ON "user" ("name", "host_id");
+"""
+
+#: The key lookup for each schema, as done by keyManagement.getKey
+LOOKUPS = {
+    'text': 'SELECT u."id", u."revision", u."pubKey"',
+    'blob': 'SELECT u."id", u."revision", u."keyType", u."keyBlob", '
+            'u."keyComment"',
+}
+LOOKUP_FROM = (' FROM "user" AS u JOIN "host" AS h ON u."host_id" = h."id" '
+               'JOIN "domain" AS d ON h."domain_id" = d."id" '
+               'WHERE u."name" = ? AND h."name" = ? AND d."name" = ?')
+
+HOSTS = 500
+DOMAINS = 50
+
+def uhdParts(n):
+    return ("user{0}".format(n), "host{0}".format(n % HOSTS),
+            "dom{0}.tld".format(n % DOMAINS))
+
+def legacyUser(n):
+    """
+    Returns the key text schema (hostId, name, pubKey, keyType, fingerprint)
+    values for user L{n}.
+    """
+    pubKey = makeKey(n, "user{0}@workstation".format(n))
+    keyType, blob, comment = sshKey.parse(pubKey)
+
+    return (n % HOSTS + 1, "user{0}".format(n), pubKey,
+            sshKey.keyTypeCode(keyType), sshKey.fingerprint(blob))
+
+def seedLegacy(dbName, count):
+    """
+    Creates a key text schema database with L{count} users.
+    """
+    conn = sqlite3.connect(dbName)
+    conn.executescript(LEGACY_SCHEMA)
+    conn.executemany('INSERT INTO "domain" ("id", "name") VALUES (?, ?)',
+                     ((d + 1, "dom{0}.tld".format(d)) for d in range(DOMAINS)))
+    conn.executemany('INSERT INTO "host" ("id", "domain_id", "name") '
+                     'VALUES (?, ?, ?)',
+                     ((h + 1, h % DOMAINS + 1, "host{0}".format(h))
+                      for h in range(HOSTS)))
+    conn.executemany('INSERT INTO "user" ("host_id", "name", "pubKey", '
+                     '"keyType", "fingerprint", "revision", "authRevision") '
+                     'VALUES (?, ?, ?, ?, ?, 1, 1)',
+                     (legacyUser(n) for n in xrange(count)))
+    conn.commit()
+    conn.close()
+
+def dbSize(dbName):
+    """
+    Returns the database file size in MiB after a VACUUM.
+    """
+    conn = sqlite3.connect(dbName)
+    conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    conn.execute('VACUUM')
+    conn.close()
+
+    return os.path.getsize(dbName) / 1048576.0
+
+def dropOSCache(dbName):
+    """
+    Asks the OS to drop the database file from the page cache, if possible.
+    """
+    try:
+        fadvise = ctypes.CDLL(None).posix_fadvise
+    except (OSError, AttributeError):
+        return
+    fd = os.open(dbName, os.O_RDONLY)
+    try:
+        # POSIX_FADV_DONTNEED
+        fadvise(fd, ctypes.c_long(0), ctypes.c_long(0), 4)
+    finally:
+        os.close(fd)
+
+def coldLookups(dbName, schema, count, users, batch=100):
+    """
+    Returns the sorted lookup latencies in ms for L{count} random users, with a
+    new connection and OS cache drop for each batch of L{batch} lookups.
+    """
+    rnd = random.Random(1)
+    sql = LOOKUPS[schema] + LOOKUP_FROM
+    times = []
+    while len(times) < count:
+        dropOSCache(dbName)
+        conn = sqlite3.connect(dbName)
+        for _ in range(batch):
+            parts = uhdParts(rnd.randrange(users))
+            start = time.time()
+            row = conn.execute(sql, parts).fetchone()
+            times.append((time.time() - start) * 1000)
+            assert row is not None
+        conn.close()
+
+    return sorted(times)
+
+def report(name, size, times):
+    pct = lambda p: times[int(len(times) * p / 100.0)]
+    print "  {0:<6} {1:>9.1f} {2:>9.3f} {3:>9.3f} {4:>9.3f}".format(
+            name, size, sum(times) / len(times), pct(50), pct(99))
+
+def main():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 500000
+    lookups = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+
+    fd, dbName = tempfile.mkstemp(prefix='sshKeyServer-', suffix='.sqlite')
+    os.close(fd)
+    os.unlink(dbName)
+
+    start = time.time()
+    seedLegacy(dbName, users)
+    print "Seeded {0} users in {1:.1f}s".format(users, time.time() - start)
+    textSize = dbSize(dbName)
+    textTimes = coldLookups(dbName, 'text', lookups, users)
+
+    start = time.time()
+    setupDatabase(dbName)
+    print "Migrated in {0:.1f}s".format(time.time() - start)
+
+    # Check a sample of converted keys
+    from lib import keyManagement
+    for n in random.Random(2).sample(xrange(users), 100):
+        uhd = "{0}@{1}.{2}".format(*uhdParts(n))
+        assert keyManagement.getKey(uhd)[2] == makeKey(
+                n, "user{0}@workstation".format(n)), uhd
+
+    blobSize = dbSize(dbName)
+    blobTimes = coldLookups(dbName, 'blob', lookups, users)
+
+    print "Storage and cold cache lookups for {0} users:".format(users)
+    print "  {0:<6} {1:>9} {2:>9} {3:>9} {4:>9}".format(
+            'schema', 'size MiB', 'mean ms', 'p50 ms', 'p99 ms')
+    report('text', textSize, textTimes)
+    report('blob', blobSize, blobTimes)
+
+    os.unlink(dbName)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""
+Tests the sync agent end to end, against an in-process server and a temporary
+directory tree.
+
+Run from the tests dir with: python -m unittest syncAgentTests
+"""
+
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from helpers import setupDatabase, startServer, stopServer, makeKey
+from lib import changes, keyManagement, database as db
+import syncAgent
+
+class SyncAgentTests(unittest.TestCase):
+
+    #: Every test gets its own host, so the tests do not see each other's
+    #: changes
+    hosts = 0
+
+    @classmethod
+    def setUpClass(cls):
+        setupDatabase()
+        cls.baseURI = startServer()
+
+    @classmethod
+    def tearDownClass(cls):
+        stopServer()
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp(prefix='syncAgent-')
+        SyncAgentTests.hosts += 1
+        self.hostName = 'host{0}.sync.tld'.format(self.hosts)
+        self.users = {}
+        for name in ('alice', 'bob', 'carol'):
+            self.users[name] = keyManagement.addUserAndKey(
+                    '{0}@{1}'.format(name, self.hostName), makeKey(name))
+        # Alice may log in as bob, and bob as carol
+        self.authorize('bob', 'alice')
+        self.authorize('carol', 'bob')
+        self.requests = []
+        self.agents = []
+
+    def tearDown(self):
+        for agent in self.agents:
+            agent.close()
+        shutil.rmtree(self.tmpDir)
+
+    def authorize(self, owner, user):
+        db.AuthorizedKeys.create(owner=self.users[owner],
+                                 authedUser=self.users[user])
+
+    def agent(self):
+        agent = syncAgent.SyncAgent(
+                self.baseURI, self.hostName,
+                os.path.join(self.tmpDir, 'state.json'),
+                auth=('admin', 'admin'),
+                pathTemplate=os.path.join(self.tmpDir, 'home', '{user}',
+                                          '.ssh', 'authorized_keys'),
+                localUsers=False)
+        # Keep track of the requests made
+        request = agent.request
+
+        def counting(path, params=None, headers=None):
+            res = request(path, params, headers)
+            self.requests.append((path, res[0]))
+            return res
+        agent.request = counting
+        self.agents.append(agent)
+        return agent
+
+    def path(self, user):
+        return os.path.join(self.tmpDir, 'home', user, '.ssh',
+                            'authorized_keys')
+
+    def read(self, user):
+        with open(self.path(user)) as f:
+            return f.read()
+
+    def testSnapshot(self):
+        self.assertEqual(self.agent().syncOnce(), 3)
+        self.assertIn(makeKey('alice'), self.read('bob'))
+        self.assertIn(makeKey('bob'), self.read('carol'))
+        self.assertEqual(self.read('alice'), '')
+        self.assertEqual(os.stat(self.path('bob')).st_mode & 0777, 0600)
+
+        with open(os.path.join(self.tmpDir, 'state.json')) as f:
+            state = json.load(f)
+        self.assertEqual(state['since'], changes.bounds()[1])
+        self.assertEqual(sorted(state['files']),
+                         sorted('{0}@{1}'.format(u, self.hostName)
+                                for u in self.users))
+
+    def testIncremental(self):
+        self.agent().syncOnce()
+        bobStat = os.stat(self.path('bob'))
+        carolStat = os.stat(self.path('carol'))
+
+        # A new agent picks the state up from the state file
+        agent = self.agent()
+        self.assertEqual(agent.syncOnce(), 0)
+        self.assertEqual(self.requests[-1][0], '/changes')
+
+        # Bob's key changes, so carol's file must be rewritten, and nothing
+        # else
+        del self.requests[:]
+        keyManagement.addUserAndKey('bob@' + self.hostName, makeKey('bob2'),
+                                    allowUpdate=True)
+        self.assertEqual(agent.syncOnce(), 1)
+        self.assertIn(makeKey('bob2'), self.read('carol'))
+        self.assertNotEqual(os.stat(self.path('carol')).st_ino,
+                            carolStat.st_ino)
+        self.assertEqual(os.stat(self.path('bob')).st_ino, bobStat.st_ino)
+        self.assertEqual([p for p, _ in self.requests],
+                         ['/changes', '/authorized_keys/carol@' +
+                                      self.hostName])
+        # The connection was kept alive
+        self.assertIsNotNone(agent.conn)
+
+    def testConditionalRequests(self):
+        agent = self.agent()
+        agent.syncOnce()
+        # Without a position, a full snapshot is needed
+        del self.requests[:]
+        agent.state['since'] = None
+        agent.syncOnce()
+        statuses = [s for p, s in self.requests
+                    if p.startswith('/authorized_keys/')]
+        self.assertEqual(statuses, [304, 304, 304])
+
+    def testCompacted(self):
+        agent = self.agent()
+        agent.syncOnce()
+        keyManagement.addUserAndKey('alice@' + self.hostName,
+                                    makeKey('alice2'), allowUpdate=True)
+        keyManagement.addUserAndKey('dave@' + self.hostName, makeKey('dave'))
+        changes.compact(retain=1)
+
+        agent.syncOnce()
+        self.assertIn(makeKey('alice2'), self.read('bob'))
+        self.assertEqual(self.read('dave'), '')
+        self.assertEqual(agent.state['since'], changes.bounds()[1])
+
+    def testLocalFileRestored(self):
+        agent = self.agent()
+        agent.syncOnce()
+        os.unlink(self.path('bob'))
+        agent.state['since'] = None
+        agent.syncOnce()
+        self.assertIn(makeKey('alice'), self.read('bob'))
+
+    def testInvalidUserNames(self):
+        for name in ('../../evil', '.hidden', 'a/b'):
+            keyManagement.addUserAndKey('{0}@{1}'.format(name, self.hostName),
+                                        makeKey(name))
+        self.assertEqual(self.agent().syncOnce(), 3)
+        self.assertEqual(sorted(os.listdir(self.tmpDir)),
+                         ['home', 'state.json'])
+        self.assertEqual(sorted(os.listdir(os.path.join(self.tmpDir, 'home'))),
+                         ['alice', 'bob', 'carol'])
+        self.assertRaises(ValueError, self.agent().userPath, '../evil')
+
+    def testCommandLine(self):
+        pwFile = os.path.join(self.tmpDir, 'pw')
+        with open(pwFile, 'w') as f:
+            f.write('admin\n')
+        res = syncAgent.main(['--server', self.baseURI, '--name',
+                              self.hostName, '--user', 'admin',
+                              '--password-file', pwFile, '--state',
+                              os.path.join(self.tmpDir, 'state.json'),
+                              '--path-template', os.path.join(
+                                  self.tmpDir, 'home', '{user}', '.ssh',
+                                  'authorized_keys'),
+                              '--all-users', '--once'])
+        self.assertEqual(res, 0)
+        self.assertIn(makeKey('alice'), self.read('bob'))
+
+if __name__ == "__main__":
+    unittest.main()
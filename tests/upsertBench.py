@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks the keyManagement.addUserAndKey upsert path against the previous
+create-and-catch-IntegrityError implementation.
+
+Reports the SQL statements needed per call for the different cases, and the
+POST throughput against an in-process server for both implementations.
+
+Usage: python upsertBench.py [numPosts]
+"""
+
+import sys
+import requests
+from helpers import setupDatabase, startServer, stopServer, QueryCounter, \
+                    makeKey, timeit
+from lib import keyManagement, database as db
+
+def legacyAddUserAndKey(uhd, pubKey, allowUpdate=False):
+    """
+    The previous implementation of keyManagement.addUserAndKey, kept here as
+    the benchmark baseline.
+    """
+    if pubKey is None:
+        raise ValueError("No public key supplied.")
+    res = keyManagement.splitUserHostDomain(uhd)
+    if res is None:
+        raise ValueError("Invalid uhd identifier: {0}".format(uhd))
+    u, h, d = res
+
+    try:
+        dom = db.Domain.create(name=d)
+    except db.IntegrityError:
+        dom = db.Domain.select().where(db.Domain.name==d).get()
+    try:
+        host = dom.addHost(h)
+    except db.IntegrityError:
+        host = db.Host.select()\
+                .where(db.Host.domain==dom)\
+                .where(db.Host.name==h)\
+                .get()
+    try:
+        user = host.addUser(u, pubKey)
+    except db.IntegrityError:
+        if not allowUpdate:
+            raise ValueError("Key updates to existing user [{0}] not "
+                             "allowed.".format(uhd))
+        user = db.User.select()\
+                .where(db.User.host==host)\
+                .where(db.User.name==u)\
+                .get()
+        user.pubKey = pubKey
+        user.save()
+    keyManagement.keyCache.invalidate(keyManagement.normalizeUhd(uhd))
+    return user
+
+def statementCounts(name, func):
+    """
+    Counts the statements per call for the different upsert cases.
+    """
+    cases = (
+        ("new domain", "user0@host0.{0}.new".format(name), False),
+        ("new host", "user0@host1.{0}.new".format(name), False),
+        ("new user", "user1@host1.{0}.new".format(name), False),
+        ("update", "user1@host1.{0}.new".format(name), True),
+    )
+    counts = []
+    for case, uhd, update in cases:
+        with QueryCounter() as qc:
+            func(uhd, makeKey(uhd), allowUpdate=update)
+        counts.append((case, qc.count))
+
+    return counts
+
+def postThroughput(baseURI, name, count):
+    """
+    Returns POSTs per second for L{count} new users spread over 10 hosts.
+    """
+    session = requests.Session()
+    session.auth = ('admin', 'admin')
+
+    def post(n):
+        uhd = "user{0}@host{1}.{2}.tld".format(n, n % 10, name)
+        r = session.post("{0}/api/key/{1}".format(baseURI, uhd),
+                         data={'key': makeKey(uhd)})
+        r.raise_for_status()
+
+    return timeit(post, count)
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+
+    setupDatabase()
+    current = keyManagement.addUserAndKey
+
+    print "Statements per call:"
+    legacy = statementCounts('legacy', legacyAddUserAndKey)
+    upsert = statementCounts('upsert', current)
+    print "  {0:<12} {1:>8} {2:>8}".format('case', 'before', 'after')
+    for (case, before), (_, after) in zip(legacy, upsert):
+        print "  {0:<12} {1:>8} {2:>8}".format(case, before, after)
+
+    baseURI = startServer()
+    try:
+        keyManagement.addUserAndKey = legacyAddUserAndKey
+        before = postThroughput(baseURI, 'legacy', count)
+        keyManagement.addUserAndKey = current
+        after = postThroughput(baseURI, 'upsert', count)
+    finally:
+        keyManagement.addUserAndKey = current
+        stopServer()
+
+    print "POST throughput ({0} posts):".format(count)
+    print "  before: {0:8.1f} req/s".format(before)
+    print "  after:  {0:8.1f} req/s".format(after)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks read throughput against the number of worker processes.
+
+Each worker count runs a server with that many workers in its own process
+against the same seeded database, as seeded for L{concurrencyBench}, while
+client processes read authorized_keys files and keys over keep-alive
+connections. The clients run in their own processes, so that they are not
+limited by a single GIL either.
+
+Throughput can only scale up to the number of cores, less the cores the
+clients use.
+
+Usage: python workersBench.py [seconds] [clients] [threadsPerWorker]
+"""
+
+import sys
+import json
+import time
+import random
+import httplib
+import multiprocessing
+import subprocess
+from helpers import setupDatabase, setupServer
+from concurrencyBench import seed, OWNERS
+
+#: The worker counts to benchmark
+WORKER_COUNTS = (1, 2, 4, 8)
+
+def serve(dbName, count, threads):
+    """
+    Runs a server with L{count} workers for the benchmark until stopped.
+    """
+    import cherrypy
+    import app
+    from lib import workers, database as db
+
+    setupDatabase(dbName)
+    baseURI = setupServer(threads=threads)
+    # Measure the server, not the rate limits of a single client
+    cherrypy.tree.apps['/api'].config['/']['tools.admission.on'] = False
+    db.closeConnections()
+
+    def ready():
+        sys.stdout.write(baseURI + '\n')
+        sys.stdout.flush()
+    sys.exit(workers.Master(count, app.serve).serve(ready))
+
+def client(host, seconds, idx, results):
+    """
+    Sends requests over one keep-alive connection for L{seconds}, and puts the
+    number of requests on L{results}.
+    """
+    auth = 'Basic ' + 'admin:admin'.encode('base64').strip()
+    conn = httplib.HTTPConnection(host)
+    rnd = random.Random(idx)
+    count = 0
+    stop = time.time() + seconds
+    while time.time() < stop:
+        n = rnd.randrange(OWNERS)
+        path = 'authorized_keys' if n % 2 else 'key'
+        conn.request('GET', '/api/{0}/user{1}@host{2}.bench.tld'.format(
+                         path, n, n % 20), headers={'Authorization': auth})
+        resp = conn.getresponse()
+        resp.read()
+        assert resp.status == 200, resp.status
+        count += 1
+    results.put(count)
+
+def drive(baseURI, seconds, clients):
+    """
+    Runs L{clients} client processes against the server for L{seconds}, and
+    returns the requests per second.
+    """
+    host = baseURI.split('//')[1]
+    results = multiprocessing.Queue()
+    procs = [multiprocessing.Process(target=client,
+                                     args=(host, seconds, n, results))
+             for n in range(clients)]
+    start = time.time()
+    for p in procs:
+        p.start()
+    total = sum(results.get(timeout=seconds + 30) for _ in procs)
+    for p in procs:
+        p.join()
+
+    return total / (time.time() - start)
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == 'serve':
+        serve(sys.argv[2], int(sys.argv[3]), int(sys.argv[4]))
+
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 5
+    clients = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+    threads = int(sys.argv[3]) if len(sys.argv) > 3 else 8
+
+    dbName = seed()
+    results = {}
+    for count in WORKER_COUNTS:
+        proc = subprocess.Popen([sys.executable, __file__, 'serve', dbName,
+                                 str(count), str(threads)],
+                                stdout=subprocess.PIPE)
+        baseURI = proc.stdout.readline().strip()
+        try:
+            # Warm the caches of all workers up first
+            drive(baseURI, 1, clients)
+            results[count] = drive(baseURI, seconds, clients)
+        finally:
+            proc.terminate()
+            proc.wait()
+
+    print "Read throughput (req/s) with {0} client processes, {1} threads " \
+          "per worker, on {2} cores:".format(clients, threads,
+                                             multiprocessing.cpu_count())
+    print "  {0:>8} {1:>10}".format('workers', 'req/s')
+    for count in WORKER_COUNTS:
+        print "  {0:>8} {1:>10.1f}".format(count, results[count])
+    print json.dumps(results)
+
+if __name__ == "__main__":
+    main()
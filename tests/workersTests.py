@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+"""
+Tests the shared generation counters, and serving with several workers.
+
+Run from the tests dir with: python -m unittest workersTests
+"""
+
+import os
+import sys
+import time
+import signal
+import tempfile
+import threading
+import subprocess
+import unittest
+import requests
+from helpers import setupDatabase, setupServer, makeKey
+from lib import changes, generation, keyManagement, workers
+from lib.cache import LRUCache
+from lib import database as db
+
+#: The number of concurrent writers, and the writes per writer
+WRITERS = 8
+WRITES = 20
+
+def childPids(pid):
+    """
+    Returns the pids of the child processes of L{pid}.
+    """
+    out = subprocess.Popen(['pgrep', '-P', str(pid)],
+                           stdout=subprocess.PIPE).communicate()[0]
+    return sorted(int(p) for p in out.split())
+
+class GenerationTests(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(prefix='generation-')
+        os.close(fd)
+        generation.share(self.path)
+        # The counters as seen from another process
+        self.other = generation.Counters(self.path)
+
+    def tearDown(self):
+        generation.unshare()
+        self.other.close()
+        os.unlink(self.path)
+
+    def testCounters(self):
+        self.assertEqual(generation.current('keys'), 0)
+        self.assertEqual(generation.bump('keys'), 1)
+        self.assertEqual(self.other.bump('keys'), 2)
+        self.assertEqual(generation.current('keys'), 2)
+        self.assertEqual(generation.current('auth'), 0)
+
+    def testUnshared(self):
+        generation.unshare()
+        self.assertIsNone(generation.current('keys'))
+        self.assertIsNone(generation.bump('keys'))
+        cache = LRUCache(shared='keys')
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+
+    def testSharedCache(self):
+        cache = LRUCache(shared='keys')
+        cache.get('a')
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        # Invalidating in this process only drops that entry
+        cache.invalidate('a')
+        self.assertEqual(cache.get('b'), 2)
+        # A bump by another process drops everything, and a value that may
+        # have been read before it is not cached
+        self.other.bump('keys')
+        cache.set('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNone(cache.get('c'))
+        cache.set('c', 3)
+        self.assertEqual(cache.get('c'), 3)
+        # Other counters do not affect the cache
+        self.other.bump('auth')
+        self.assertEqual(cache.get('c'), 3)
+
+    def testConcurrentBumps(self):
+        cache = LRUCache(shared='keys')
+        cache.get('a')
+        cache.set('a', 1)
+        cache.set('b', 2)
+        # Another process bumped before this one did
+        self.other.bump('keys')
+        cache.invalidate('a')
+        self.assertIsNone(cache.get('b'))
+
+    def testChangesFromOtherProcess(self):
+        setupDatabase()
+        user = keyManagement.addUserAndKey('user@host.gen.tld', makeKey(0))
+        since = changes.bounds()[1]
+        result = {}
+
+        def wait():
+            result.update(changes.waitForChanges(since, timeout=10))
+        waiter = threading.Thread(target=wait)
+        start = time.time()
+        waiter.start()
+        time.sleep(0.3)
+        # Committed without notifying this process
+        db.Change.create(kind=changes.KEY, user=user)
+        self.other.bump('changes')
+        waiter.join()
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual(len(result['changes']), 1)
+
+class WorkersTests(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.dbName = setupDatabase()
+        keyManagement.addUserAndKey('user@host.workers.tld', makeKey('old'))
+        db.closeConnections()
+        cls.master = subprocess.Popen([sys.executable, __file__, 'serve',
+                                       cls.dbName, '2'],
+                                      stdout=subprocess.PIPE)
+        cls.baseURI = cls.master.stdout.readline().strip()
+        cls.auth = ('admin', 'admin')
+        generation.share(cls.dbName + '-generation')
+
+    @classmethod
+    def tearDownClass(cls):
+        generation.unshare()
+        if cls.master.poll() is None:
+            cls.master.kill()
+            cls.master.wait()
+
+    def getKey(self):
+        # A new connection for every request, so they are spread over the
+        # workers
+        res = requests.get(self.baseURI + '/api/key/user@host.workers.tld',
+                           auth=self.auth, headers={'Connection': 'close'})
+        self.assertEqual(res.status_code, 200)
+        return res.json()['user@host.workers.tld']
+
+    def test1CacheInvalidation(self):
+        self.assertEqual(set(self.getKey() for _ in range(20)),
+                         set([makeKey('old')]))
+        keyManagement.addUserAndKey('user@host.workers.tld', makeKey('new'),
+                                    allowUpdate=True)
+        self.assertEqual(set(self.getKey() for _ in range(20)),
+                         set([makeKey('new')]))
+
+    def test1ConcurrentWrites(self):
+        # Writes on new connections are spread over the workers, which each
+        # have their own writer connection
+        errors = []
+
+        def post(idx):
+            for n in range(WRITES):
+                uhd = 'writer{0}-{1}@host.workers.tld'.format(idx, n)
+                res = requests.post(self.baseURI + '/api/key/' + uhd,
+                                    data={'key': makeKey(uhd)},
+                                    auth=self.auth,
+                                    headers={'Connection': 'close'})
+                if res.status_code != 200:
+                    errors.append((uhd, res.status_code, res.text))
+        threads = [threading.Thread(target=post, args=(n,))
+                   for n in range(WRITERS)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(db.User.select()
+                         .where(db.User.name.startswith('writer'))
+                         .count(), WRITERS * WRITES)
+
+    def test2Restart(self):
+        before = childPids(self.master.pid)
+        os.kill(self.master.pid, signal.SIGHUP)
+        deadline = time.time() + 30
+        while True:
+            # Requests are served all through the restart
+            self.getKey()
+            pids = childPids(self.master.pid)
+            if len(pids) == 2 and not set(pids) & set(before):
+                break
+            self.assertLess(time.time(), deadline)
+
+    def test3Stop(self):
+        os.kill(self.master.pid, signal.SIGTERM)
+        self.assertEqual(self.master.wait(), 0)
+
+def serve(dbName, count):
+    """
+    Serves the database with L{count} workers, for L{WorkersTests}.
+    """
+    import app
+    setupDatabase(dbName)
+    baseURI = setupServer(threads=4)
+    db.closeConnections()
+
+    def ready():
+        sys.stdout.write(baseURI + '\n')
+        sys.stdout.flush()
+    sys.exit(workers.Master(count, app.serve).serve(ready))
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == 'serve':
+        serve(sys.argv[2], int(sys.argv[3]))
+    unittest.main()
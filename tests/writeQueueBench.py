@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks adding keys from concurrent threads with a commit per key, against
+adding them through the group commit write queue.
+
+The gain depends on how long a commit takes, so both are run with the SQLite
+synchronous setting at NORMAL and at FULL. Run it with the database on the
+disk that is used in production, since a temporary dir may be in memory.
+
+Usage: python writeQueueBench.py [threads] [writesPerThread] [dbDir]
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+import cherrypy
+from helpers import setupDatabase, makeKey
+from lib import conf, keyManagement, writeQueue
+
+def direct(func, *args):
+    """
+    Runs a write operation right away.
+    """
+    return func(*args)
+
+def throughput(dbDir, name, write, threads, count):
+    """
+    Returns the keys added per second by L{threads} threads adding L{count}
+    keys each, with L{write} running each operation.
+    """
+    setupDatabase(os.path.join(dbDir, name + '.sqlite'))
+
+    def worker(t):
+        for n in xrange(count):
+            uhd = "user{0}@host{1}.{2}.tld".format(n, t, name)
+            write(keyManagement.addUserAndKey, uhd, makeKey(uhd))
+
+    workers = [threading.Thread(target=worker, args=(t,))
+               for t in range(threads)]
+    start = time.time()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+
+    return threads * count / (time.time() - start)
+
+def main():
+    threads = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    dbDir = tempfile.mkdtemp(prefix='writeQueueBench-',
+                             dir=sys.argv[3] if len(sys.argv) > 3 else None)
+
+    queue = writeQueue.WriteQueue(cherrypy.engine)
+    queue.start()
+
+    def queued(func, *args):
+        return queue.submit(func, *args).result()
+
+    print "Keys added per second ({0} threads x {1}):".format(threads, count)
+    print "  {0:<12} {1:>10} {2:>10}".format('synchronous', 'direct',
+                                             'queued')
+    try:
+        for sync in ('normal', 'full'):
+            conf['database']['synchronous'] = sync
+            before = throughput(dbDir, 'direct' + sync, direct, threads,
+                                count)
+            after = throughput(dbDir, 'queued' + sync, queued, threads, count)
+            print "  {0:<12} {1:>10.1f} {2:>10.1f}".format(sync, before,
+                                                           after)
+    finally:
+        queue.stop()
+        shutil.rmtree(dbDir)
+
+if __name__ == "__main__":
+    main()
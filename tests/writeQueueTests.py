@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""
+Tests the group commit write queue, and nested transactions.
+
+Run from the tests dir with: python -m unittest writeQueueTests
+"""
+
+import unittest
+import cherrypy
+import requests
+from helpers import setupDatabase, startServer, stopServer, makeKey
+from lib import keyManagement, writeQueue, database as db
+from external.peewee import IntegrityError
+
+class CommitCounter(object):
+    """
+    Context manager counting the commits on the application database.
+    """
+
+    def __enter__(self):
+        self.count = 0
+        self.database = db.db_proxy.obj
+        orig = self.database.commit
+
+        def commit():
+            self.count += 1
+            orig()
+        self.database.commit = commit
+        return self
+
+    def __exit__(self, *exc):
+        del self.database.commit
+
+class NestedTransactionTests(unittest.TestCase):
+
+    def setUp(self):
+        setupDatabase()
+
+    def testNestedRollback(self):
+        with db.transaction():
+            db.Domain.create(name='outer.tld')
+            try:
+                with db.transaction():
+                    db.Domain.create(name='inner.tld')
+                    raise RuntimeError()
+            except RuntimeError:
+                pass
+            db.Domain.create(name='after.tld')
+        names = [d.name for d in db.Domain.select().order_by(db.Domain.id)]
+        self.assertEqual(names, ['outer.tld', 'after.tld'])
+
+    def testNestedAfterCommit(self):
+        called = []
+        with db.transaction():
+            db.afterCommit(lambda: called.append('outer'))
+            with db.transaction() as txn:
+                db.afterCommit(lambda: called.append('rolledBack'))
+                txn.rollback()
+            with db.transaction():
+                db.afterCommit(lambda: called.append('inner'))
+            self.assertEqual(called, [])
+        self.assertEqual(called, ['outer', 'inner'])
+
+class WriteQueueTests(unittest.TestCase):
+
+    def setUp(self):
+        setupDatabase()
+        self.queue = writeQueue.WriteQueue(cherrypy.engine, maxSize=10,
+                                           batchSize=5)
+
+    def tearDown(self):
+        self.queue.stop()
+
+    def testBatch(self):
+        # Queued before the writer starts, so they are taken as one batch
+        futures = [self.queue.submit(keyManagement.addUserAndKey,
+                                     'u{0}@host.batch.tld'.format(n),
+                                     makeKey(n))
+                   for n in range(5)]
+        with CommitCounter() as commits:
+            self.queue.start()
+            users = [f.result(5) for f in futures]
+        self.assertEqual(commits.count, 1)
+        self.assertEqual([u.name for u in users],
+                         ['u{0}'.format(n) for n in range(5)])
+        self.assertEqual(keyManagement.getKey('u3@host.batch.tld')[2],
+                         makeKey(3))
+
+    def testBatchSize(self):
+        futures = [self.queue.submit(keyManagement.addUserAndKey,
+                                     'u{0}@host.size.tld'.format(n),
+                                     makeKey(n))
+                   for n in range(7)]
+        with CommitCounter() as commits:
+            self.queue.start()
+            for f in futures:
+                f.result(5)
+        self.assertEqual(commits.count, 2)
+
+    def testErrors(self):
+        keyManagement.addUserAndKey('exists@host.errors.tld', makeKey(0))
+
+        def failing():
+            db.Domain.create(name='failing.tld')
+            raise RuntimeError("Failed")
+
+        def duplicate():
+            db.Domain.create(name='errors.tld')
+
+        futures = [
+            self.queue.submit(keyManagement.addUserAndKey,
+                              'new@host.errors.tld', makeKey(1)),
+            self.queue.submit(keyManagement.addUserAndKey,
+                              'exists@host.errors.tld', makeKey(2)),
+            self.queue.submit(failing),
+            self.queue.submit(duplicate),
+            self.queue.submit(keyManagement.addUserAndKey,
+                              'other@new.errors.tld', makeKey(3))]
+        self.queue.start()
+
+        self.assertEqual(futures[0].result(5).name, 'new')
+        self.assertRaises(ValueError, futures[1].result, 5)
+        self.assertRaises(RuntimeError, futures[2].result, 5)
+        self.assertRaises(IntegrityError, futures[3].result, 5)
+        self.assertEqual(futures[4].result(5).name, 'other')
+        # Only the failed operations were rolled back
+        self.assertEqual(keyManagement.getKey('exists@host.errors.tld')[2],
+                         makeKey(0))
+        self.assertEqual(db.Domain.select()\
+                         .where(db.Domain.name=='failing.tld').count(), 0)
+        self.assertIsNotNone(keyManagement.getKey('other@new.errors.tld'))
+
+    def testQueueFull(self):
+        for n in range(10):
+            self.queue.submit(lambda: None)
+        self.assertRaises(writeQueue.QueueFull, self.queue.submit,
+                          lambda: None)
+        self.queue.start()
+
+    def testTimeout(self):
+        future = self.queue.submit(lambda: None)
+        self.assertRaises(writeQueue.Timeout, future.result, 0.01)
+        self.queue.start()
+        self.assertIsNone(future.result(5))
+
+class WriteQueueAPITests(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        setupDatabase()
+        writeQueue.queueConf['enabled'] = True
+        cls.baseURI = startServer()
+        cls.auth = ('admin', 'admin')
+
+    @classmethod
+    def tearDownClass(cls):
+        stopServer()
+        writeQueue._queue.unsubscribe()
+        writeQueue._queue = None
+        writeQueue.queueConf['enabled'] = False
+
+    def post(self, uhd, key):
+        return requests.post(self.baseURI + '/api/key/' + uhd,
+                             data={'key': key}, auth=self.auth)
+
+    def testPost(self):
+        res = self.post('user@host.api.tld', makeKey('api'))
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.json()['pubKey'], makeKey('api'))
+        res = self.post('user@host.api.tld', makeKey('api2'))
+        self.assertEqual(res.status_code, 400)
+
+    def testQueueFull(self):
+        # A queue without a writer, that is full already
+        full = writeQueue.WriteQueue(cherrypy.engine, maxSize=1)
+        full.submit(lambda: None)
+        running, writeQueue._queue = writeQueue._queue, full
+        try:
+            res = self.post('full@host.api.tld', makeKey('full'))
+        finally:
+            writeQueue._queue = running
+        self.assertEqual(res.status_code, 503)
+        self.assertEqual(res.headers['Retry-After'], '1')
+
+if __name__ == "__main__":
+    unittest.main()